@@ -1,6 +1,7 @@
 import env
 from app import app
 from celery import Celery
+from utils.constant import GitHubRateLimitError
 
 app.config.setdefault("CELERY_BROKER_URL", "redis://redis:6379/0")
 app.config.setdefault("CELERY_RESULT_BACKEND", "redis://redis:6379/0")
@@ -23,3 +24,20 @@ class ContextTask(TaskBase):
 
 
 celery.Task = ContextTask
+
+
+class GitHubSyncTask(ContextTask):
+    """Retry the task later when it is rate limited by GitHub.
+
+    A retry runs the whole task again, so only use it for idempotent tasks,
+    e.g. the background sync: `@celery.task(base=GitHubSyncTask)`.
+    """
+
+    abstract = True
+
+    def __call__(self, *args, **kwargs):
+        try:
+            return ContextTask.__call__(self, *args, **kwargs)
+        except GitHubRateLimitError as e:
+            # 被 GitHub 限流时不占用 worker 等待，延后重试
+            raise self.retry(exc=e, countdown=e.retry_after)
@@ -0,0 +1,86 @@
+import time
+
+import click
+from app import app
+from model.repo import get_permission
+from utils.github.client import get_client
+from utils.github.organization import GitHubAppOrg
+from utils.github.repo import GitHubAppRepo
+
+
+def measure(func):
+    """Run func, count the GitHub http requests and the wall time.
+
+    Returns:
+        tuple: (result, requests, seconds)
+    """
+    requests = []
+
+    def on_response(response):
+        requests.append(response.request.url)
+
+    hooks = get_client().event_hooks["response"]
+    hooks.append(on_response)
+    start = time.perf_counter()
+    try:
+        result = func()
+    finally:
+        hooks.remove(on_response)
+    return result, len(requests), time.perf_counter() - start
+
+
+def _permissions(collaborators):
+    return {(c["id"], get_permission(c["permissions"])) for c in collaborators}
+
+
+@app.cli.command(name="github-sync-benchmark")
+@click.option("-i", "--installation-id", "installation_id", required=True)
+@click.option("-o", "--org", "org_name", required=True)
+def github_sync_benchmark(installation_id, org_name):
+    """Compare REST and GraphQL collaborator fetching of an org, read only."""
+    github_app = GitHubAppRepo(installation_id)
+    # 先拿到 installation token，不计入请求数
+    github_app.installation_token
+
+    repos, calls, seconds = measure(
+        lambda: list(GitHubAppOrg(installation_id).get_org_repos_accessible())
+    )
+    click.echo(f"list repos: {len(repos)} repos, {calls} requests, {seconds:.2f}s")
+
+    rest, rest_calls, rest_seconds = measure(
+        lambda: {
+            str(repo["id"]): list(
+                github_app.get_repo_collaborators(repo["name"], org_name)
+            )
+            for repo in repos
+        }
+    )
+    click.echo(f"REST:    {rest_calls} requests, {rest_seconds:.2f}s")
+
+    graphql, graphql_calls, graphql_seconds = measure(
+        lambda: github_app.get_org_repo_collaborators(org_name)
+    )
+    # GraphQL 拿不到的仓库走 REST
+    fallback = [repo for repo in repos if str(repo["id"]) not in graphql]
+    _, fallback_calls, fallback_seconds = measure(
+        lambda: [
+            list(github_app.get_repo_collaborators(repo["name"], org_name))
+            for repo in fallback
+        ]
+    )
+    click.echo(
+        f"GraphQL: {graphql_calls + fallback_calls} requests, "
+        f"{graphql_seconds + fallback_seconds:.2f}s "
+        f"({len(fallback)} repos fallback to REST, "
+        f"{fallback_calls} requests, {fallback_seconds:.2f}s)"
+    )
+
+    mismatched = [
+        repo["name"]
+        for repo in repos
+        if str(repo["id"]) in graphql
+        and _permissions(graphql[str(repo["id"])])
+        != _permissions(rest[str(repo["id"])])
+    ]
+    if mismatched:
+        click.echo(f"permissions mismatched: {', '.join(mismatched)}")
@@ -0,0 +1,277 @@
+import json
+import logging
+
+from app import app, db
+from sqlalchemy import and_, or_, select
+from utils.redis import client, incr_metrics
+
+from .schema import (
+    ChatGroup,
+    CodeApplication,
+    IMApplication,
+    Issue,
+    PullRequest,
+    Repo,
+    Team,
+)
+
+app.config.setdefault("RESOLVED_CONTEXT_EXPIRE", 60 * 5)
+
+# 快照里保留的字段，只放卡片和任务里会读到的
+CONTEXT_FIELDS = {
+    "repo": (
+        Repo,
+        [
+            "id",
+            "repo_id",
+            "application_id",
+            "chat_group_id",
+            "message_id",
+            "name",
+            "description",
+            "extra",
+        ],
+    ),
+    "code_application": (CodeApplication, ["id", "team_id", "installation_id"]),
+    "team": (Team, ["id", "name"]),
+    "im_application": (IMApplication, ["id", "team_id", "app_id"]),
+    "chat_group": (ChatGroup, ["id", "im_application_id", "chat_id", "name"]),
+}
+
+
+class Snapshot(dict):
+    """Read-only copy of a row, fields can be read like an ORM object."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class ResolvedContext(Snapshot):
+    """Snapshot of repo -> code_application -> team -> im_application -> chat_group.
+
+    The snapshot is not bound to the session, use the ids to load the ORM
+    object before changing it.
+    """
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(
+            {name: Snapshot(item) if item else None for name, item in value.items()}
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        row = row._mapping
+        value = {}
+        for name, (_, fields) in CONTEXT_FIELDS.items():
+            item = {
+                field: row.get(f"{name}__{field}")
+                for field in fields
+                if f"{name}__{field}" in row
+            }
+            value[name] = item if item.get("id") else None
+        return cls.from_dict(value)
+
+    @property
+    def repo_url(self):
+        if self.team and self.repo:
+            return f"https://github.com/{self.team.name}/{self.repo.name}"
+        return None
+
+    @property
+    def tags(self):
+        tags = []
+        if self.repo:
+            tags.append(_context_tag("repo", self.repo.id))
+        if self.team:
+            tags.append(_context_tag("team", self.team.id))
+        return tags
+
+
+def _context_key(name, value):
+    return f"context:{name}:{value}"
+
+
+def _context_tag(name, value):
+    return f"context:tag:{name}:{value}"
+
+
+def _context_columns(*names):
+    return [
+        getattr(model, field).label(f"{name}__{field}")
+        for name in names
+        for model, fields in [CONTEXT_FIELDS[name]]
+        for field in fields
+    ]
+
+
+def _repo_context_query():
+    return (
+        db.session.query(*_context_columns(*CONTEXT_FIELDS.keys()))
+        .select_from(Repo)
+        .outerjoin(CodeApplication, CodeApplication.id == Repo.application_id)
+        .outerjoin(
+            Team,
+            and_(
+                Team.id == CodeApplication.team_id,
+                Team.status == 0,
+            ),
+        )
+        .outerjoin(ChatGroup, ChatGroup.id == Repo.chat_group_id)
+        .outerjoin(
+            IMApplication,
+            and_(
+                IMApplication.team_id == Team.id,
+                IMApplication.status.in_([0, 1]),
+            ),
+        )
+        .filter(Repo.status == 0)
+        # 一个 team 绑定了多个飞书应用时，优先使用项目群所在的应用
+        .order_by((IMApplication.id == ChatGroup.im_application_id).desc())
+    )
+
+
+def _installation_context_query():
+    return (
+        db.session.query(
+            *_context_columns("code_application", "team", "im_application")
+        )
+        .select_from(CodeApplication)
+        .outerjoin(
+            Team,
+            and_(
+                Team.id == CodeApplication.team_id,
+                Team.status == 0,
+            ),
+        )
+        .outerjoin(
+            IMApplication,
+            and_(
+                IMApplication.team_id == Team.id,
+                IMApplication.status.in_([0, 1]),
+            ),
+        )
+        .filter(CodeApplication.status.in_([0, 1]))
+    )
+
+
+def _query_context(name, value):
+    if "installation_id" == name:
+        return _installation_context_query().filter(
+            CodeApplication.installation_id == value
+        )
+
+    query = _repo_context_query()
+    if "repo_id" == name:
+        return query.filter(Repo.id == value)
+    elif "github_repo_id" == name:
+        return query.filter(Repo.repo_id == value)
+    elif "chat_id" == name:
+        return query.filter(ChatGroup.chat_id == value)
+    elif "message_id" == name:
+        # repo 卡片，或者 issue/pr 卡片所在的 repo
+        return query.filter(
+            or_(
+                Repo.message_id == value,
+                Repo.id.in_(select(Issue.repo_id).where(Issue.message_id == value)),
+                Repo.id.in_(
+                    select(PullRequest.repo_id).where(PullRequest.message_id == value)
+                ),
+            )
+        )
+    raise ValueError(f"unknown context key {name}")
+
+
+def resolve_context(
+    repo_id=None,
+    github_repo_id=None,
+    installation_id=None,
+    message_id=None,
+    chat_id=None,
+) -> ResolvedContext | None:
+    """Resolve repo, code application, team, im application and chat group at once.
+
+    Exactly one key should be given. A cache miss costs one joined query.
+
+    Args:
+        repo_id (str): Repo.id.
+        github_repo_id (str): Repo.repo_id, the repository id on GitHub.
+        installation_id (str): CodeApplication.installation_id, repo and
+            chat_group of the context are None.
+        message_id (str): Lark message id of a repo/issue/pr card.
+        chat_id (str): ChatGroup.chat_id.
+
+    Returns:
+        ResolvedContext: The context, None if not found.
+    """
+    keys = [
+        (name, value)
+        for name, value in [
+            ("repo_id", repo_id),
+            ("github_repo_id", github_repo_id),
+            ("installation_id", installation_id),
+            ("message_id", message_id),
+            ("chat_id", chat_id),
+        ]
+        if value
+    ]
+    if len(keys) != 1:
+        raise ValueError("resolve_context need exactly one key")
+    name, value = keys[0]
+    value = str(value)
+    cache_key = _context_key(name, value)
+
+    try:
+        cached = client.get(cache_key)
+        if cached:
+            incr_metrics("context", "hit")
+            return ResolvedContext.from_dict(json.loads(cached))
+    except Exception as e:
+        logging.error(e)
+
+    incr_metrics("context", "miss")
+    row = _query_context(name, value).first()
+    if not row:
+        return None
+
+    context = ResolvedContext.from_row(row)
+    expire = app.config["RESOLVED_CONTEXT_EXPIRE"]
+    try:
+        pipeline = client.pipeline()
+        pipeline.set(cache_key, json.dumps(context), ex=expire)
+        for tag in context.tags:
+            pipeline.sadd(tag, cache_key)
+            pipeline.expire(tag, expire)
+        pipeline.execute()
+    except Exception as e:
+        logging.error(e)
+    return context
+
+
+def invalidate_context(repo_id=None, team_id=None):
+    """Drop the cached contexts of the repo or the whole team.
+
+    Call this after the repo, its chat group, or the applications of the team
+    are changed.
+
+    Args:
+        repo_id (str): Repo.id.
+        team_id (str): Team.id.
+    """
+    tags = []
+    if repo_id:
+        tags.append(_context_tag("repo", repo_id))
+    if team_id:
+        tags.append(_context_tag("team", team_id))
+    if not tags:
+        return
+    try:
+        keys = set()
+        for tag in tags:
+            keys.update(client.smembers(tag))
+        client.delete(*keys, *tags)
+    except Exception as e:
+        logging.error(e)
@@ -0,0 +1,224 @@
+import logging
+from datetime import datetime
+
+import click
+from app import db
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+
+from .schema import (
+    BindUser,
+    ChatGroup,
+    CodeApplication,
+    IMApplication,
+    Issue,
+    PullRequest,
+    Repo,
+    RepoUser,
+    TeamMember,
+    User,
+)
+
+
+class SchemaMigration(db.Model):
+    """已经执行过的迁移版本"""
+
+    __tablename__ = "schema_migration"
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(128), nullable=True, comment="迁移名称")
+    created = db.Column(
+        db.TIMESTAMP,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=text("CURRENT_TIMESTAMP"),
+        comment="执行时间",
+    )
+
+
+# (version, name, func)，按 version 顺序执行，已经执行过的不会重复执行
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def decorate(func):
+        MIGRATIONS.append((version, name, func))
+        return func
+
+    return decorate
+
+
+def create_index_online(index):
+    """Create an index if it does not exist yet.
+
+    On MySQL the index is added with `ALGORITHM=INPLACE, LOCK=NONE`, so the
+    table stays readable and writable. A unique index is created as a normal
+    index when the table already contains duplicated rows, and upgraded to a
+    unique index by a later call once the duplicates are removed.
+
+    Args:
+        index (sqlalchemy.Index): The index declared on the model.
+
+    Returns:
+        bool: False if the index should be unique but is not yet.
+    """
+    table = index.table
+    existing = {
+        i["name"]: i["unique"] for i in inspect(db.engine).get_indexes(table.name)
+    }
+    if index.name in existing and (existing[index.name] or not index.unique):
+        logging.info("index %s already exists", index.name)
+        return True
+
+    columns = [column.name for column in index.columns]
+    unique = index.unique
+    if unique:
+        duplicated = db.session.execute(
+            text(
+                f"SELECT 1 FROM {table.name} "
+                f"WHERE {' AND '.join(f'{c} IS NOT NULL' for c in columns)} "
+                f"GROUP BY {', '.join(columns)} HAVING COUNT(*) > 1 LIMIT 1"
+            )
+        ).first()
+        if duplicated:
+            logging.warning(
+                "duplicated rows in %s(%s), %s is not unique yet",
+                table.name,
+                ", ".join(columns),
+                index.name,
+            )
+            if index.name in existing:
+                return False
+            unique = False
+
+    # 之前因为重复数据建成了普通索引，重复数据清理之后换成唯一索引
+    replace = index.name in existing
+    if db.engine.dialect.name == "mysql":
+        db.session.execute(
+            text(
+                f"ALTER TABLE {table.name} "
+                f"{f'DROP INDEX {index.name}, ' if replace else ''}"
+                f"ADD {'UNIQUE ' if unique else ''}INDEX "
+                f"{index.name} ({', '.join(columns)}), ALGORITHM=INPLACE, LOCK=NONE"
+            )
+        )
+    else:
+        if replace:
+            db.session.execute(text(f"DROP INDEX {index.name}"))
+        db.Index(index.name, *index.columns, unique=unique).create(db.engine)
+    logging.info("index %s created", index.name)
+    return unique == index.unique
+
+
+@migration(1, "add indexes for hot lookup columns")
+def add_lookup_indexes():
+    pending = []
+    for model in [
+        User,
+        BindUser,
+        TeamMember,
+        Repo,
+        RepoUser,
+        CodeApplication,
+        IMApplication,
+        ChatGroup,
+        Issue,
+        PullRequest,
+    ]:
+        for index in sorted(model.__table__.indexes, key=lambda i: i.name):
+            if not create_index_online(index):
+                pending.append(index.name)
+    # 不记录为已执行，清理重复数据之后再次 migrate 会重试
+    if pending:
+        raise click.ClickException(
+            f"duplicated rows block unique indexes {', '.join(pending)}, "
+            "remove the duplicates and run migrate again"
+        )
+
+
+def upgrade():
+    """Run all migrations which are not applied yet."""
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    applied = {version for version, in db.session.query(SchemaMigration.version)}
+    for version, name, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        logging.info("apply migration %r %r", version, name)
+        func()
+        db.session.add(SchemaMigration(version=version, name=name))
+        db.session.commit()
+        click.echo(f"migration {version} applied: {name}")
+
+
+@click.command(name="migrate")
+@with_appcontext
+def migrate():
+    upgrade()
+
+
+# 热点查询，用来检查是否都使用了索引
+HOT_QUERIES = [
+    ("Repo.repo_id", "SELECT id FROM repo WHERE repo_id = :v"),
+    ("Repo.message_id", "SELECT id FROM repo WHERE message_id = :v"),
+    (
+        "Issue(repo_id, issue_number)",
+        "SELECT id FROM issue WHERE repo_id = :v AND issue_number = :v",
+    ),
+    ("Issue.message_id", "SELECT id FROM issue WHERE message_id = :v"),
+    (
+        "PullRequest(repo_id, pull_request_number)",
+        "SELECT id FROM pull_request WHERE repo_id = :v AND pull_request_number = :v",
+    ),
+    (
+        "PullRequest(repo_id, head, state)",
+        "SELECT id FROM pull_request WHERE repo_id = :v AND head = :v AND state = :v",
+    ),
+    ("PullRequest.message_id", "SELECT id FROM pull_request WHERE message_id = :v"),
+    ("ChatGroup.chat_id", "SELECT id FROM chat_group_v1 WHERE chat_id = :v"),
+    ("BindUser.openid", "SELECT id FROM bind_user WHERE openid = :v"),
+    (
+        "BindUser(user_id, platform)",
+        "SELECT id FROM bind_user WHERE user_id = :v AND platform = :v",
+    ),
+    ("User.unionid", "SELECT id FROM user WHERE unionid = :v"),
+    (
+        "TeamMember(team_id, code_user_id)",
+        "SELECT id FROM team_member WHERE team_id = :v AND code_user_id = :v",
+    ),
+    (
+        "TeamMember(team_id, im_user_id)",
+        "SELECT id FROM team_member WHERE team_id = :v AND im_user_id = :v",
+    ),
+    (
+        "RepoUser(repo_id, bind_user_id)",
+        "SELECT id FROM repo_user WHERE repo_id = :v AND bind_user_id = :v",
+    ),
+    (
+        "CodeApplication.installation_id",
+        "SELECT id FROM code_application WHERE installation_id = :v",
+    ),
+    ("IMApplication.app_id", "SELECT id FROM im_application WHERE app_id = :v"),
+]
+
+
+@click.command(name="explain")
+@with_appcontext
+def explain():
+    """EXPLAIN every hot query and check that each one can use an index."""
+    if db.engine.dialect.name != "mysql":
+        click.echo(f"skip explain on {db.engine.dialect.name}")
+        return
+
+    failed = []
+    for name, sql in HOT_QUERIES:
+        for row in db.session.execute(text(f"EXPLAIN {sql}"), {"v": ""}):
+            row = row._mapping
+            key = row["key"] or row["possible_keys"]
+            # 唯一索引查不到数据时，优化器直接返回 const 结果
+            if not key and "const table" in (row["Extra"] or ""):
+                key = "const"
+            click.echo(f"{name:<45} {row['type'] or '':<8} {key or 'FULL SCAN'}")
+            if not key:
+                failed.append(name)
+
+    if failed:
+        raise click.ClickException(f"queries without index: {', '.join(failed)}")
@@ -1,120 +1,354 @@
+from time import time
+
 from app import app, db
+from model.context import invalidate_context
 from model.schema import BindUser, ObjID, Repo, RepoUser, User
+from sqlalchemy import insert, update
+from utils.constant import GitHubRateLimitError, GitHubRequestError
+from utils.github.client import run_async
 from utils.github.model import Repository
-from utils.github.repo import GitHubAppRepo
+from utils.github.repo import AsyncGitHubAppRepo, GitHubAppRepo
 
 
-def create_repo_from_github(
-    repo: dict, org_name: str, application_id: str, github_app: GitHubAppRepo
-) -> Repo:
-    """Create repo from github
+def get_permission(permissions: dict) -> str | None:
+    """GitHub collaborator permissions -> RepoUser.permission"""
+    if permissions.get("admin"):
+        return "admin"
+    elif permissions.get("maintain"):
+        return "maintain"
+    elif permissions.get("push"):
+        return "push"
+    return None
+
+
+def load_github_bind_users(github_ids: list) -> dict:
+    """Load github_id -> BindUser.id of GitHub users.
 
     Args:
-        repo (dict): repo info from github
-        org_name (str): organization name
-        application_id (str): application id
-        github_app (GitHubAppRepo): github app instance
+        github_ids (list): GitHub user ids.
 
     Returns:
-        Repo: repo instance
+        dict: github_id -> BindUser.id, github_id without bind user is missing.
     """
+    if not github_ids:
+        return {}
+    return {
+        github_id: bind_user_id
+        for github_id, bind_user_id in db.session.query(User.unionid, BindUser.id)
+        .join(BindUser, BindUser.user_id == User.id)
+        .filter(
+            User.unionid.in_(github_ids),
+            BindUser.platform == "github",
+        )
+        .all()
+    }
 
-    repo_extra = Repository(**repo).model_dump()
 
-    # 检查是否已经存在
-    try:
-        current_repo = Repo.query.filter_by(repo_id=str(repo["id"])).first()
+def load_repo_users(application_id: str, repo_ids: list) -> dict:
+    """Load RepoUser of the repos.
+
+    Returns:
+        dict: Repo.id -> {BindUser.id: (RepoUser.id, permission, status)}
+    """
+    repo_users = {repo_id: {} for repo_id in repo_ids}
+    if not repo_ids:
+        return repo_users
+    for repo_user_id, repo_id, bind_user_id, permission, status in db.session.query(
+        RepoUser.id,
+        RepoUser.repo_id,
+        RepoUser.bind_user_id,
+        RepoUser.permission,
+        RepoUser.status,
+    ).filter(
+        RepoUser.application_id == application_id,
+        RepoUser.repo_id.in_(repo_ids),
+    ):
+        repo_users[repo_id][bind_user_id] = (repo_user_id, permission, status)
+    return repo_users
 
+
+class RepoSyncer(object):
+    """Sync repos and collaborators of one GitHub installation in bulk.
+
+    Bind users and repo users are preloaded into maps, changes of each repo are
+    computed in memory and written with multi-row INSERT/UPDATE statements and
+    one commit per repo.
+    """
+
+    def __init__(
+        self,
+        org_name: str,
+        application_id: str,
+        github_app: GitHubAppRepo,
+        collaborators: dict = None,
+    ):
+        self.org_name = org_name
+        self.application_id = application_id
+        self.github_app = github_app
+        # GitHub repo id -> collaborators，GraphQL 预先拉取的，没有的仓库走 REST
+        self.collaborators = collaborators or {}
+        # github_id -> BindUser.id，None 表示没有绑定用户
+        self.bind_users = {}
+        self.repo_users = {}
+        # 成员列表拉取失败、跳过了成员同步的 GitHub repo id
+        self.skipped_repos = set()
+        self.stats = dict(
+            repo_inserted=0,
+            repo_updated=0,
+            repo_user_inserted=0,
+            repo_user_updated=0,
+            repo_user_deleted=0,
+            repo_user_skipped=0,
+            repo_failed=0,
+        )
+
+    def resolve_bind_users(self, github_ids: list):
+        missing = [i for i in set(github_ids) if i not in self.bind_users]
+        if missing:
+            found = load_github_bind_users(missing)
+            for github_id in missing:
+                self.bind_users[github_id] = found.get(github_id)
+
+    def sync_repo_row(self, repo: dict, current_repo) -> str:
+        repo_extra = Repository(**repo).model_dump()
         if current_repo is None:
-            new_repo = Repo(
-                id=ObjID.new_id(),
-                application_id=application_id,
-                repo_id=str(repo["id"]),
-                name=repo["name"],
-                description=repo["description"],
-                extra=repo_extra,
+            repo_id = ObjID.new_id()
+            db.session.execute(
+                insert(Repo),
+                [
+                    dict(
+                        id=repo_id,
+                        application_id=self.application_id,
+                        repo_id=str(repo["id"]),
+                        name=repo["name"],
+                        description=repo["description"],
+                        extra=repo_extra,
+                    )
+                ],
             )
-            db.session.add(new_repo)
-            db.session.flush()
-
-            current_repo = new_repo
-            app.logger.debug(f"Repo {current_repo.id} created")
-        else:
-            # 更新 repo 信息
-            # 暂不支持更新 repo 名称
-            current_repo.description = repo["description"]
-            current_repo.extra = repo_extra
-            db.session.add(current_repo)
-            db.session.flush()
-
-        # 拉取仓库成员，创建 RepoUser
-        repo_users = github_app.get_repo_collaborators(repo["name"], org_name)
-
-        for repo_user in repo_users:
-            # 检查是否有 bind_user，没有则跳过
-            bind_user = (
-                db.session.query(BindUser)
-                .filter(
-                    User.unionid == str(repo_user["id"]),
-                    BindUser.platform == "github",
-                    # 通过 GitHub 创建的 BindUser 不再写入更新 application_id
-                    # BindUser.application_id == application_id,
-                    BindUser.user_id == User.id,
-                )
-                .first()
+            self.stats["repo_inserted"] += 1
+            app.logger.debug(f"Repo {repo_id} created")
+            return repo_id
+
+        repo_id, description, extra = current_repo
+        # 更新 repo 信息
+        # 暂不支持更新 repo 名称
+        if description != repo["description"] or extra != repo_extra:
+            db.session.execute(
+                update(Repo),
+                [dict(id=repo_id, description=repo["description"], extra=repo_extra)],
             )
-            if bind_user is None:
-                app.logger.debug(f"RepoUser {repo_user['login']} has no bind user")
+            self.stats["repo_updated"] += 1
+        return repo_id
+
+    def sync_repo_users(self, repo_id: str, collaborators: list):
+        self.resolve_bind_users([str(c["id"]) for c in collaborators])
+
+        permissions = {}
+        for collaborator in collaborators:
+            # 检查是否有 bind_user，没有则跳过
+            bind_user_id = self.bind_users.get(str(collaborator["id"]))
+            if bind_user_id is None:
+                app.logger.debug(f"RepoUser {collaborator['login']} has no bind user")
                 continue
+            permission = get_permission(collaborator["permissions"])
+            if permission:
+                permissions[bind_user_id] = permission
 
-            # 检查是否有 repo_user
-            current_repo_user = (
-                db.session.query(RepoUser)
-                .filter(
-                    RepoUser.repo_id == current_repo.id,
-                    RepoUser.bind_user_id == bind_user.id,
-                    RepoUser.application_id == application_id,
+        current = self.repo_users.get(repo_id, {})
+        inserts, updates, deletes = [], [], []
+        for bind_user_id, permission in permissions.items():
+            if bind_user_id not in current:
+                inserts.append(
+                    dict(
+                        id=ObjID.new_id(),
+                        application_id=self.application_id,
+                        repo_id=repo_id,
+                        bind_user_id=bind_user_id,
+                        permission=permission,
+                    )
                 )
-                .first()
+                continue
+            repo_user_id, current_permission, status = current[bind_user_id]
+            if current_permission != permission or status != 0:
+                updates.append(dict(id=repo_user_id, permission=permission, status=0))
+        # 已经不是协作者的用户标记删除
+        for bind_user_id, (repo_user_id, _, status) in current.items():
+            if bind_user_id not in permissions and status == 0:
+                deletes.append(dict(id=repo_user_id, status=1))
+
+        if inserts:
+            db.session.execute(insert(RepoUser), inserts)
+        if updates:
+            db.session.execute(update(RepoUser), updates)
+        if deletes:
+            db.session.execute(update(RepoUser), deletes)
+
+        self.stats["repo_user_inserted"] += len(inserts)
+        self.stats["repo_user_updated"] += len(updates)
+        self.stats["repo_user_deleted"] += len(deletes)
+
+    def get_collaborators(self, repo: dict) -> list | None:
+        """The complete collaborators of the repo, None if they can not be listed.
+
+        RepoUser missing from the list are deleted, so a partial list must
+        never be returned.
+        """
+        collaborators = self.collaborators.get(str(repo["id"]))
+        if collaborators is not None:
+            return collaborators
+        try:
+            return list(
+                self.github_app.get_repo_collaborators(repo["name"], self.org_name)
+            )
+        except GitHubRequestError as e:
+            # 列表不完整时跳过成员同步，保留现有的 RepoUser
+            self.stats["repo_user_skipped"] += 1
+            self.skipped_repos.add(str(repo["id"]))
+            app.logger.warning(
+                f"Skip collaborators of repo {repo['name']}, listing failed: {e}"
             )
+            return None
+
+    def sync_collaborators(self, repo_id: str, repo: dict) -> bool:
+        """Sync only the collaborators of a repo already in the database.
+
+        Args:
+            repo_id (str): Repo.id.
+            repo (dict): The GitHub repo, only id and name are used.
+
+        Returns:
+            bool: False if the collaborators can not be listed.
+        """
+        self.repo_users.update(load_repo_users(self.application_id, [repo_id]))
+        collaborators = self.get_collaborators(repo)
+        if collaborators is None:
+            return False
+        try:
+            self.sync_repo_users(repo_id, collaborators)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            raise e
+        invalidate_context(repo_id=repo_id)
+        return True
 
-            # 根据 permission 创建 repo_user
-            permissions = repo_user["permissions"]
-            app.logger.debug(
-                f"RepoUser {repo_user['login']} permissions: {permissions}"
+    def prefetch_collaborators(self, repos: list):
+        """List the collaborators of the repos concurrently.
+
+        Repos fetched by GraphQL are skipped, repos failed here are listed
+        again one by one in `sync`.
+        """
+        missing = {
+            repo["name"]: str(repo["id"])
+            for repo in repos
+            if str(repo["id"]) not in self.collaborators
+        }
+        if len(missing) < 2:
+            return
+        github_app = AsyncGitHubAppRepo(self.github_app.installation_id)
+        try:
+            (collaborators,) = run_async(
+                github_app.get_repos_collaborators(list(missing), self.org_name)
             )
-            if permissions["admin"]:
-                permission = "admin"
-            elif permissions["maintain"]:
-                permission = "maintain"
-            elif permissions["push"]:
-                permission = "push"
-            else:
-                continue
+        except GitHubRateLimitError as e:
+            raise e
+        except Exception as e:
+            # 预取失败不影响同步，每个仓库在 sync 里单独拉取
+            app.logger.exception(f"Failed to prefetch collaborators: {e}")
+            return
+        for repo_name, value in collaborators.items():
+            self.collaborators[missing[repo_name]] = value
 
-            if current_repo_user is not None:
-                # 更新权限
-                current_repo_user.permission = permission
-                db.session.add(current_repo_user)
-                db.session.flush()
-                continue
+    def sync(self, repos: list, callback=None) -> dict:
+        """Sync repos and their collaborators.
+
+        Args:
+            repos (list): repo info from github.
+            callback (callable, optional): Called with (repo, Repo.id) after
+                each repo, Repo.id is None if the repo failed.
 
-            new_repo_user = RepoUser(
-                id=ObjID.new_id(),
-                application_id=application_id,
-                repo_id=current_repo.id,
-                bind_user_id=bind_user.id,
-                permission=permission,
+        Returns:
+            dict: GitHub repo id -> Repo.id, the statistics are in `self.stats`.
+        """
+        start = time()
+        repos = list(repos)
+        current_repos = {
+            github_repo_id: (repo_id, description, extra)
+            for github_repo_id, repo_id, description, extra in db.session.query(
+                Repo.repo_id,
+                Repo.id,
+                Repo.description,
+                Repo.extra,
+            ).filter(
+                Repo.repo_id.in_([str(repo["id"]) for repo in repos]),
             )
-            db.session.add(new_repo_user)
-            db.session.flush()
+        }
+        self.repo_users.update(
+            load_repo_users(
+                self.application_id,
+                [repo_id for repo_id, _, _ in current_repos.values()],
+            )
+        )
+
+        self.prefetch_collaborators(repos)
+
+        repo_ids = {}
+        for repo in repos:
+            try:
+                repo_id = self.sync_repo_row(repo, current_repos.get(str(repo["id"])))
+                # 拉取仓库成员，同步 RepoUser
+                collaborators = self.get_collaborators(repo)
+                if collaborators is not None:
+                    self.sync_repo_users(repo_id, collaborators)
+                db.session.commit()
+                invalidate_context(repo_id=repo_id)
+                repo_ids[str(repo["id"])] = repo_id
+            except GitHubRateLimitError as e:
+                # 限流时剩下的仓库也会失败，交给任务延后重试
+                db.session.rollback()
+                raise e
+            except Exception as e:
+                db.session.rollback()
+                self.stats["repo_failed"] += 1
+                app.logger.exception(f"Failed to sync repo {repo['name']}: {e}")
+                repo_id = None
+            if callback:
+                callback(repo, repo_id)
 
-            app.logger.debug(f"RepoUser {new_repo_user.id} created")
+        seconds = time() - start
+        rows = sum(
+            v
+            for k, v in self.stats.items()
+            if k not in ["repo_failed", "repo_user_skipped"]
+        )
+        self.stats.update(
+            repos=len(repos),
+            rows=rows,
+            seconds=round(seconds, 3),
+            rows_per_second=round(rows / seconds, 1) if seconds > 0 else rows,
+        )
+        app.logger.info(f"Sync repos of {self.org_name}: {self.stats}")
+        return repo_ids
 
-        db.session.commit()
 
-    except Exception as e:
-        db.session.rollback()
-        raise e
+def create_repo_from_github(
+    repo: dict, org_name: str, application_id: str, github_app: GitHubAppRepo
+) -> Repo:
+    """Create repo from github
+
+    Args:
+        repo (dict): repo info from github
+        org_name (str): organization name
+        application_id (str): application id
+        github_app (GitHubAppRepo): github app instance
+
+    Returns:
+        Repo: repo instance
+    """
+    syncer = RepoSyncer(org_name, application_id, github_app)
+    repo_id = syncer.sync([repo]).get(str(repo["id"]))
+    if repo_id is None:
+        raise Exception(f"Failed to sync repo {repo['name']}.")
 
-    return current_repo
+    return db.session.query(Repo).filter(Repo.id == repo_id).first()
@@ -101,7 +101,10 @@ class Base(db.Model):
 class User(Base):
     __tablename__ = "user"
     unionid = db.Column(
-        db.String(128), nullable=True, comment="GitHub ID/lark union_id, 作为唯一标识"
+        db.String(128),
+        nullable=True,
+        index=True,
+        comment="GitHub ID/lark union_id, 作为唯一标识",
     )
     email = db.Column(db.String(128), nullable=True, comment="邮箱,这里考虑一下如何做唯一的用户")
     telephone = db.Column(db.String(128), nullable=True, comment="手机号")
@@ -120,6 +123,10 @@ class Account(User):
 
 class BindUser(Base):
     __tablename__ = "bind_user"
+    __table_args__ = (
+        db.Index("ix_bind_user_openid", "openid"),
+        db.Index("ix_bind_user_user_id_platform", "user_id", "platform"),
+    )
     user_id = db.Column(ObjID(12), ForeignKey("user.id"), nullable=True, comment="用户ID")
     # 这里还是用platform标记一下
     platform = db.Column(db.String(128), nullable=True, comment="平台：github/lark")
@@ -180,6 +187,10 @@ class TeamContact(Base):
 
 class TeamMember(Base):
     __tablename__ = "team_member"
+    __table_args__ = (
+        db.Index("ix_team_member_team_id_code_user_id", "team_id", "code_user_id"),
+        db.Index("ix_team_member_team_id_im_user_id", "team_id", "im_user_id"),
+    )
     team_id = db.Column(
         ObjID(12), ForeignKey("team.id"), nullable=True, comment="属于哪一个组"
     )
@@ -199,6 +210,10 @@ class TeamMember(Base):
 
 class Repo(Base):
     __tablename__ = "repo"
+    __table_args__ = (
+        db.Index("uq_repo_repo_id", "repo_id", unique=True),
+        db.Index("ix_repo_message_id", "message_id"),
+    )
     application_id = db.Column(
         ObjID(12),
         ForeignKey("code_application.id"),
@@ -222,6 +237,9 @@ class Repo(Base):
 
 class RepoUser(Base):
     __tablename__ = "repo_user"
+    __table_args__ = (
+        db.Index("ix_repo_user_repo_id_bind_user_id", "repo_id", "bind_user_id"),
+    )
     application_id = db.Column(
         ObjID(12),
         ForeignKey("code_application.id"),
@@ -241,6 +259,9 @@ class RepoUser(Base):
 
 class CodeApplication(Base):
     __tablename__ = "code_application"
+    __table_args__ = (
+        db.Index("ix_code_application_installation_id", "installation_id"),
+    )
     team_id = db.Column(
         ObjID(12), ForeignKey("team.id"), nullable=True, comment="属于哪一个组"
     )
@@ -253,6 +274,7 @@ class CodeApplication(Base):
 
 class IMApplication(Base):
     __tablename__ = "im_application"
+    __table_args__ = (db.Index("ix_im_application_app_id", "app_id"),)
     team_id = db.Column(
         ObjID(12), ForeignKey("team.id"), nullable=True, comment="属于哪一个组"
     )
@@ -266,6 +288,7 @@ class IMApplication(Base):
 
 class ChatGroup(Base):
     __tablename__ = "chat_group_v1"
+    __table_args__ = (db.Index("uq_chat_group_v1_chat_id", "chat_id", unique=True),)
     im_application_id = db.Column(
         ObjID(12), ForeignKey("im_application.id"), nullable=True, comment="哪一个项目创建的"
     )
@@ -279,6 +302,12 @@ class ChatGroup(Base):
 
 class Issue(Base):
     __tablename__ = "issue"
+    __table_args__ = (
+        db.Index(
+            "uq_issue_repo_id_issue_number", "repo_id", "issue_number", unique=True
+        ),
+        db.Index("ix_issue_message_id", "message_id"),
+    )
     repo_id = db.Column(
         ObjID(12),
         ForeignKey("repo.id"),
@@ -298,6 +327,16 @@ class Issue(Base):
 
 class PullRequest(Base):
     __tablename__ = "pull_request"
+    __table_args__ = (
+        db.Index(
+            "uq_pull_request_repo_id_pull_request_number",
+            "repo_id",
+            "pull_request_number",
+            unique=True,
+        ),
+        db.Index("ix_pull_request_repo_id_head", "repo_id", "head", "state"),
+        db.Index("ix_pull_request_message_id", "message_id"),
+    )
     repo_id = db.Column(
         ObjID(12),
         ForeignKey("repo.id"),
@@ -384,30 +423,56 @@ def create():
                     comment="其他字段",
                 )
 
-            for group in db.session.query(ChatGroupOld).all():
-                if (
-                    not db.session.query(ChatGroup)
-                    .filter(ChatGroup.id == group.id)
-                    .limit(1)
-                    .scalar()
-                ):
-                    db.session.add(
-                        ChatGroup(
-                            id=group.id,
-                            im_application_id=group.im_application_id,
-                            chat_id=group.chat_id,
-                            name=group.name,
-                            description=group.description,
-                            extra=group.extra,
-                            created=group.created,
-                            modified=group.modified,
-                        )
+            # chat_group_v1.chat_id 是唯一索引，同一个群只复制最新的一条，
+            # 重复的旧数据对应的 repo 都指向保留的那一条
+            kept = {}
+            for group in (
+                db.session.query(ChatGroupOld)
+                .order_by(ChatGroupOld.modified.desc())
+                .all()
+            ):
+                group_id = kept.get(group.chat_id) if group.chat_id else None
+                if group_id:
+                    logging.warning(
+                        "skip duplicated chat_group %r of chat %r",
+                        group.id,
+                        group.chat_id,
                     )
+                else:
+                    group_id = group.id
+                    if group.chat_id:
+                        kept[group.chat_id] = group.id
+                    if (
+                        not db.session.query(ChatGroup)
+                        .filter(ChatGroup.id == group.id)
+                        .limit(1)
+                        .scalar()
+                    ):
+                        db.session.add(
+                            ChatGroup(
+                                id=group.id,
+                                im_application_id=group.im_application_id,
+                                chat_id=group.chat_id,
+                                name=group.name,
+                                description=group.description,
+                                extra=group.extra,
+                                created=group.created,
+                                modified=group.modified,
+                            )
+                        )
                 db.session.query(Repo).filter(Repo.id == group.repo_id).update(
-                    dict(chat_group_id=group.id)
+                    dict(chat_group_id=group_id)
                 )
             db.session.commit()
 
+    # 按版本执行还没有执行过的迁移（索引等）
+    upgrade()
+
 
 # add command function to cli commands
 app.cli.add_command(create)
+
+from .migrate import explain, migrate, upgrade  # noqa: E402
+
+app.cli.add_command(migrate)
+app.cli.add_command(explain)
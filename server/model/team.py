@@ -1,8 +1,18 @@
+import json
+import logging
+import threading
+from time import time
+
+from app import app
 from flask import abort, session
 from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import aliased, joinedload, relationship
+from utils.lark.bot import invalidate_bot_registry
+from utils.redis import client
 from utils.utils import query_one_page
 
+from .context import invalidate_context
 from .schema import *
 
 CodeUser = aliased(BindUser)
@@ -266,6 +276,7 @@ def set_team_member(team_id, code_user_id, im_user_id):
         TeamMember.status == 0,
     ).update(dict(im_user_id=im_user_id))
     db.session.commit()
+    invalidate_team_identity_map(team_id)
 
 
 def add_team_member(team_id, code_user_id):
@@ -293,6 +304,7 @@ def add_team_member(team_id, code_user_id):
     )
     db.session.add(new_team_member)
     db.session.commit()
+    invalidate_team_identity_map(team_id)
 
 
 def create_team(app_info: dict, contact_id=None) -> Team:
@@ -363,6 +375,7 @@ def create_team(app_info: dict, contact_id=None) -> Team:
 
     db.session.add(new_team_member)
     db.session.commit()
+    invalidate_team_identity_map(new_team.id)
 
     return new_team
 
@@ -391,6 +404,7 @@ def create_code_application(team_id: str, installation_id: str) -> CodeApplicati
         # 更新 installation_id
         current_code_application.installation_id = installation_id
         db.session.commit()
+        invalidate_context(team_id=team_id)
         return current_code_application
 
     new_code_application = CodeApplication(
@@ -402,6 +416,7 @@ def create_code_application(team_id: str, installation_id: str) -> CodeApplicati
 
     db.session.add(new_code_application)
     db.session.commit()
+    invalidate_context(team_id=team_id)
 
     return new_code_application
 
@@ -435,6 +450,7 @@ def save_im_application(
         db.session.add(application)
         db.session.commit()
     else:
+        old_team_id = application.team_id
         db.session.query(IMApplication).filter(
             IMApplication.id == application.id,
         ).update(
@@ -449,6 +465,11 @@ def save_im_application(
             )
         )
         db.session.commit()
+        # 应用换绑到别的 team 时，原来 team 的缓存也要清理
+        if old_team_id != team_id:
+            invalidate_context(team_id=old_team_id)
+    invalidate_context(team_id=team_id)
+    invalidate_bot_registry()
 
 
 def create_repo_chat_group_by_repo_id(user_id, team_id, repo_id, chat_name=None):
@@ -517,6 +538,7 @@ def create_repo_chat_group_by_repo_id(user_id, team_id, repo_id, chat_name=None)
                 .filter(
                     TeamMember.team_id == team.id,
                     RepoUser.repo_id == repo.id,
+                    RepoUser.status == 0,
                 )
             ]
         )
@@ -539,24 +561,55 @@ def create_repo_chat_group_by_repo_id(user_id, team_id, repo_id, chat_name=None)
     if not chat_id:
         logging.error("create chat_group error %r %r", data, result)
         return abort(400, "create chat group error")
-    chat_group_id = ObjID.new_id()
-    chat_group = ChatGroup(
-        id=chat_group_id,
-        im_application_id=application.id,
-        chat_id=chat_id,
-        name=name,
-        description=description,
-        extra=result,
+    save_repo_chat_group(
+        repo.id,
+        ChatGroup(
+            id=ObjID.new_id(),
+            im_application_id=application.id,
+            chat_id=chat_id,
+            name=name,
+            description=description,
+            extra=result,
+        ),
     )
+    # send card message, and pin repo card
+    tasks.send_repo_to_chat_group.delay(repo.id, app_id, chat_id)
+    return chat_id
+
+
+def save_repo_chat_group(repo_id: str, chat_group: ChatGroup) -> str:
+    """Save a new chat group and link it to the repo.
+
+    Args:
+        repo_id (str): Repo.id.
+        chat_group (ChatGroup): The new chat group.
+
+    Returns:
+        str: ChatGroup.id, the existing one if the same chat_id is saved
+        concurrently.
+    """
+    chat_group_id = chat_group.id
     db.session.add(chat_group)
     # 更改连表规则，创建新的群之后，需要更新repo.chat_group_id
     db.session.query(Repo).filter(
-        Repo.id == repo.id,
+        Repo.id == repo_id,
     ).update(dict(chat_group_id=chat_group_id))
-    db.session.commit()
-    # send card message, and pin repo card
-    tasks.send_repo_to_chat_group.delay(repo.id, app_id, chat_id)
-    return chat_id
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 同一个群被并发保存，chat_id 唯一索引冲突，使用已经存在的记录
+        db.session.rollback()
+        chat_group_id = (
+            db.session.query(ChatGroup.id)
+            .filter(ChatGroup.chat_id == chat_group.chat_id)
+            .scalar()
+        )
+        db.session.query(Repo).filter(
+            Repo.id == repo_id,
+        ).update(dict(chat_group_id=chat_group_id))
+        db.session.commit()
+    invalidate_context(repo_id=repo_id)
+    return chat_group_id
 
 
 def save_team_contact(user_id, first_name, last_name, email, role, newsletter):
@@ -576,7 +629,154 @@ def save_team_contact(user_id, first_name, last_name, email, role, newsletter):
     return contact_id
 
 
-def get_code_users_by_openid(users):
+app.config.setdefault("TEAM_IDENTITY_EXPIRE", 60 * 10)
+# 进程内缓存很短，同一次卡片渲染内多次查找只读一次 redis
+app.config.setdefault("TEAM_IDENTITY_LOCAL_EXPIRE", 5)
+
+_team_identities = {}
+_team_identities_lock = threading.Lock()
+
+
+class TeamIdentityMap(object):
+    """GitHub login <-> Lark openid of the members in one team."""
+
+    def __init__(self, team_id, members):
+        """
+        Args:
+            team_id (str): Team.id.
+            members (list): [(code_user.user_id, code_user.name, im_user.openid)]
+        """
+        self.team_id = team_id
+        self.members = members
+        self.openid_by_code_name = {
+            code_name: openid for _, code_name, openid in members if openid
+        }
+        self.code_user_by_openid = {
+            openid: (code_user_id, code_name)
+            for code_user_id, code_name, openid in members
+            if openid
+        }
+
+    def get_openid(self, code_name):
+        return self.openid_by_code_name.get(code_name)
+
+    def get_openids(self, code_names):
+        return [
+            self.openid_by_code_name[code_name]
+            for code_name in code_names
+            if code_name in self.openid_by_code_name
+        ]
+
+    def get_code_name(self, openid):
+        code_user = self.code_user_by_openid.get(openid)
+        return code_user[1] if code_user else None
+
+    def get_code_users(self, openids):
+        return {
+            openid: self.code_user_by_openid[openid]
+            for openid in openids
+            if openid in self.code_user_by_openid
+        }
+
+
+def _team_identity_key(team_id):
+    return f"team:identity:{team_id}"
+
+
+def _load_team_identity_members(team_id):
+    return [
+        list(member)
+        for member in db.session.query(
+            CodeUser.user_id,
+            CodeUser.name,
+            IMUser.openid,
+        )
+        .select_from(TeamMember)
+        .join(
+            CodeUser,
+            and_(
+                CodeUser.id == TeamMember.code_user_id,
+                CodeUser.status == 0,
+            ),
+        )
+        .outerjoin(
+            IMUser,
+            and_(
+                IMUser.id == TeamMember.im_user_id,
+                IMUser.status == 0,
+            ),
+        )
+        .filter(
+            TeamMember.team_id == team_id,
+            TeamMember.status == 0,
+        )
+        .all()
+    ]
+
+
+def get_team_identity_map(team_id) -> TeamIdentityMap:
+    """Get the identity map of the team, all members are loaded by one query.
+
+    Args:
+        team_id (str): Team.id.
+
+    Returns:
+        TeamIdentityMap: The identity map.
+    """
+    cached = _team_identities.get(team_id)
+    if cached and cached[0] > time():
+        return cached[1]
+
+    members = None
+    try:
+        value = client.get(_team_identity_key(team_id))
+        if value:
+            members = json.loads(value)
+    except Exception as e:
+        logging.error(e)
+
+    if members is None:
+        members = _load_team_identity_members(team_id)
+        try:
+            client.set(
+                _team_identity_key(team_id),
+                json.dumps(members),
+                ex=app.config["TEAM_IDENTITY_EXPIRE"],
+            )
+        except Exception as e:
+            logging.error(e)
+
+    identity_map = TeamIdentityMap(team_id, members)
+    with _team_identities_lock:
+        _team_identities[team_id] = (
+            time() + app.config["TEAM_IDENTITY_LOCAL_EXPIRE"],
+            identity_map,
+        )
+    return identity_map
+
+
+def invalidate_team_identity_map(*team_ids):
+    """Drop the cached identity map after team members changed.
+
+    Args:
+        team_ids (str): Team.id.
+    """
+    team_ids = [team_id for team_id in team_ids if team_id]
+    if not team_ids:
+        return
+    with _team_identities_lock:
+        for team_id in team_ids:
+            _team_identities.pop(team_id, None)
+    try:
+        client.delete(*[_team_identity_key(team_id) for team_id in team_ids])
+    except Exception as e:
+        logging.error(e)
+
+
+def get_code_users_by_openid(users, team_id=None):
+    if team_id:
+        return get_team_identity_map(team_id).get_code_users(users)
+
     code_users = {
         openid: (code_user_id, code_user_name)
         for openid, code_user_id, code_user_name in db.session.query(
@@ -598,7 +798,7 @@ def get_code_users_by_openid(users):
     return code_users
 
 
-def get_assignees_by_openid(users):
-    code_users = get_code_users_by_openid(users)
+def get_assignees_by_openid(users, team_id=None):
+    code_users = get_code_users_by_openid(users, team_id=team_id)
     assignees = [code_users[openid][1] for openid in users if openid in code_users]
     return assignees
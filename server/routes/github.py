@@ -13,8 +13,12 @@ from tasks.github.repo import on_fork, on_repository, on_star
 from utils.auth import authenticated
 from utils.github.application import verify_github_signature
 from utils.github.bot import BaseGitHubApp
+from utils.redis import incr_metrics, mark_once, unmark
 from utils.user import register
 
+# GitHub 重新投递同一个 X-GitHub-Delivery 时，在这个时间窗口内直接忽略
+app.config.setdefault("GITHUB_DELIVERY_DEDUP_TTL", 60 * 60 * 24)
+
 bp = Blueprint("github", __name__, url_prefix="/api/github")
 
 
@@ -147,39 +151,64 @@ def github_hook():
     """Receive GitHub webhook."""
 
     x_github_event = request.headers.get("x-github-event", None).lower()
+    x_github_delivery = request.headers.get("x-github-delivery", None)
 
     app.logger.info(x_github_event)
 
+    delivery_key = f"github:delivery:{x_github_delivery}"
+    if x_github_delivery and not mark_once(
+        delivery_key, app.config["GITHUB_DELIVERY_DEDUP_TTL"]
+    ):
+        app.logger.info(f"Duplicate GitHub delivery: {x_github_delivery}")
+        incr_metrics("github_delivery", "duplicate")
+        incr_metrics("github_delivery", f"duplicate:{x_github_event}")
+        return jsonify({"code": 0, "message": "duplicate delivery"})
+
+    try:
+        task = dispatch_github_event(x_github_event, request.json)
+    except Exception as e:
+        # 没有成功入队，允许 GitHub 重新投递
+        if x_github_delivery:
+            unmark(delivery_key)
+        raise e
+
+    if task is None:
+        app.logger.info(f"Unhandled GitHub webhook event: {x_github_event}")
+        return jsonify({"code": -1, "message": "Unhandled GitHub webhook event."})
+
+    incr_metrics("github_delivery", "accepted")
+    return jsonify({"code": 0, "message": "ok", "task_id": task.id})
+
+
+def dispatch_github_event(x_github_event: str, data: dict):
+    """Create the celery task for a GitHub webhook event.
+
+    Args:
+        x_github_event (str): The value of X-GitHub-Event header.
+        data (dict): Payload from GitHub webhook.
+
+    Returns:
+        AsyncResult | None: The celery task, None if the event is unhandled.
+    """
     match x_github_event:
         case "repository":
-            task = on_repository.delay(request.json)
-            return jsonify({"code": 0, "message": "ok", "task_id": task.id})
+            return on_repository.delay(data)
         case "issues":
-            task = on_issue.delay(request.json)
-            return jsonify({"code": 0, "message": "ok", "task_id": task.id})
+            return on_issue.delay(data)
         case "issue_comment":
-            task = on_issue_comment.delay(request.json)
-            return jsonify({"code": 0, "message": "ok", "task_id": task.id})
+            return on_issue_comment.delay(data)
         case "pull_request":
-            task = on_pull_request.delay(request.json)
-            return jsonify({"code": 0, "message": "ok", "task_id": task.id})
+            return on_pull_request.delay(data)
         case "organization":
-            task = on_organization.delay(request.json)
-            return jsonify({"code": 0, "message": "ok", "task_id": task.id})
+            return on_organization.delay(data)
         case "push":
-            task = on_push.delay(request.json)
-            return jsonify({"code": 0, "message": "ok", "task_id": task.id})
+            return on_push.delay(data)
         case "star":
-            task = on_star.delay(request.json)
-            return jsonify({"code": 0, "message": "ok", "task_id": task.id})
+            return on_star.delay(data)
         case "fork":
-            task = on_fork.delay(request.json)
-            return jsonify({"code": 0, "message": "ok", "task_id": task.id})
+            return on_fork.delay(data)
         case _:
-            app.logger.info(f"Unhandled GitHub webhook event: {x_github_event}")
-            return jsonify({"code": -1, "message": "Unhandled GitHub webhook event."})
-
-    return jsonify({"code": 0, "message": "ok"})
+            return None
 
 
 app.register_blueprint(bp)
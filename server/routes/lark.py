@@ -1,15 +1,90 @@
+import hashlib
+import hmac
 import os
 from argparse import ArgumentError
+from time import time
 
 from app import app
 from connectai.lark.oauth import Server as OauthServerBase
 from connectai.lark.sdk import Bot, MarketBot
 from connectai.lark.webhook import LarkServer as LarkServerBase
-from flask import session
+from flask import Blueprint, abort, jsonify, request, session
 from model.lark import get_bot_by_app_id
-from tasks.lark import get_bot_by_application_id, get_contact_by_lark_application
+from tasks.lark import (
+    get_bot_by_application_id,
+    get_card_action_command,
+    get_contact_by_lark_application,
+    process_card_action,
+)
 from utils.lark.parser import GitMayaLarkParser
 from utils.lark.post_message import post_content_to_markdown
+from utils.redis import incr_metrics, mark_once, observe_latency, unmark
+
+# 飞书重新推送同一个事件/消息时，在这个时间窗口内直接忽略
+app.config.setdefault("LARK_EVENT_DEDUP_TTL", 60 * 60 * 24)
+# 校验卡片回调的签名，没有签名头时比较回调里的 token
+app.config.setdefault("LARK_CARD_VERIFY_SIGNATURE", False)
+
+
+def mark_event(event_id=None, message_id=None):
+    """Mark the event and its message as handled.
+
+    Lark pushes the event again when the hook is slow, and the same message
+    may come with different event ids.
+
+    Returns:
+        list: The marked keys, None if the event or the message was handled.
+    """
+    keys = [
+        key
+        for key, value in [
+            (f"lark:dedup:event:{event_id}", event_id),
+            (f"lark:dedup:message:{message_id}", message_id),
+        ]
+        if value
+    ]
+    ttl = app.config["LARK_EVENT_DEDUP_TTL"]
+    # 每个 key 都要标记，不能短路
+    marked = [mark_once(key, ttl) for key in keys]
+    if not all(marked):
+        app.logger.info("Duplicate Lark event: %r %r", event_id, message_id)
+        incr_metrics("lark_event", "duplicate")
+        return None
+    incr_metrics("lark_event", "accepted")
+    return keys
+
+
+def unmark_event(keys):
+    # 没有处理成功，允许飞书重新推送
+    for key in keys:
+        unmark(key)
+
+
+def validate_card_action(bot, headers, raw_body, data):
+    """Check that a card action callback comes from Lark.
+
+    Card actions have no event header, so Bot._validate skips them. They are
+    signed with the verification token instead; callbacks without the
+    signature headers carry the verification token in the `token` field.
+    https://open.feishu.cn/document/ukTMukTMukTM/uYzM3QjL2MzN04iNzcDN/message-card-callback-signature
+
+    Raises:
+        Exception: The signature or the token does not match.
+    """
+    if not bot.verification_token:
+        return
+    signature = headers.get("x-lark-signature")
+    if not signature:
+        if not hmac.compare_digest(str(data.get("token", "")), bot.verification_token):
+            raise Exception("invalide token")
+        return
+    timestamp = headers.get("x-lark-request-timestamp", "")
+    nonce = headers.get("x-lark-request-nonce", "")
+    digest = hashlib.sha1(
+        (timestamp + nonce + bot.verification_token).encode() + raw_body
+    ).hexdigest()
+    if not hmac.compare_digest(signature, digest):
+        raise Exception("invalide signature")
 
 
 def get_bot(app_id):
@@ -22,6 +97,58 @@ class LarkServer(LarkServerBase):
     def get_bot(self, app_id):
         return get_bot(app_id)
 
+    def get_blueprint(self):
+        """Same as the blueprint of the SDK, but acknowledges card actions at once.
+
+        Card actions are handed over to a worker, the callback returns a toast
+        before the command is parsed, so that slow moments do not push the
+        callback past the deadline of Lark.
+        """
+        bp = Blueprint("lark-webhook", __name__)
+
+        def webhook_handler(app_id):
+            start = time()
+            bot = self.get_bot(app_id)
+            if not bot:
+                return ""
+            body = request.json
+            message = {
+                "headers": {
+                    key.lower(): value for key, value in request.headers.items()
+                },
+                "body": body,
+            }
+            data = body
+            if "encrypt" in body:
+                data = bot._decrypt_data(bot.encrypt_key, body["encrypt"])
+            if "action" in data:
+                if app.config["LARK_CARD_VERIFY_SIGNATURE"]:
+                    try:
+                        validate_card_action(
+                            bot, message["headers"], request.get_data(), data
+                        )
+                    except Exception as e:
+                        app.logger.warning("invalid lark card action %r %r", app_id, e)
+                        return abort(401)
+                result = on_card_action(bot, data, start)
+                observe_latency("lark_callback_card_action", time() - start)
+                return jsonify(result)
+
+            # 事件的签名由 process_message 校验
+            result = bot.process_message(message)
+            observe_latency("lark_callback_event", time() - start)
+            if result and "challenge" in result:
+                return jsonify(result)
+            return ""
+
+        bp.add_url_rule(
+            f"{self.prefix}/<app_id>",
+            "webhook_handler",
+            webhook_handler,
+            methods=["POST"],
+        )
+        return bp
+
 
 class OauthServer(OauthServerBase):
     def get_bot(self, app_id):
@@ -33,32 +160,24 @@ oauth = OauthServer(prefix="/api/feishu/oauth")
 parser = GitMayaLarkParser()
 
 
-@hook.on_bot_event(event_type="card:action")
-def on_card_action(bot, token, data, message, *args, **kwargs):
-    # TODO 将action中的按钮，或者选择的东西，重新组织成 command 继续走parser的逻辑
-    if "action" in data and "command" in data["action"].get("value", {}):
-        command = data["action"]["value"]["command"]
-        suffix = data["action"]["value"].get("suffix")
-        # 将选择的直接拼接到后面
-        if suffix == "$option" and "option" in data["action"]:
-            command = command + data["action"]["option"]
-        try:
-            parser.parse_args(
-                command,
-                bot.app_id,
-                data["open_message_id"],
-                data,
-                message,
-                **kwargs,
-            )
-        except Exception as e:
-            app.logger.exception(e)
-    else:
-        app.logger.error("unkown card_action %r", (bot, token, data, message, *args))
+def on_card_action(bot, data, received_at):
+    """Acknowledge the card action, the command is run by process_card_action."""
+    if not get_card_action_command(data):
+        app.logger.error("unkown card_action %r", (bot, data))
+        return {}
+    try:
+        process_card_action.delay(bot.app_id, data, received_at)
+    except Exception as e:
+        app.logger.exception(e)
+        return {"toast": {"type": "error", "content": "操作失败，请稍后重试"}}
+    return {"toast": {"type": "info", "content": "处理中…"}}
 
 
 @hook.on_bot_message(message_type="post")
 def on_post_message(bot, message_id, content, message, *args, **kwargs):
+    keys = mark_event(message.get("header", {}).get("event_id"), message_id)
+    if keys is None:
+        return
     text, title = post_content_to_markdown(content, False)
     content["text"] = text
     try:
@@ -68,10 +187,14 @@ def on_post_message(bot, message_id, content, message, *args, **kwargs):
         parser.on_comment(text, bot.app_id, message_id, content, message, **kwargs)
     except Exception as e:
         app.logger.exception(e)
+        unmark_event(keys)
 
 
 @hook.on_bot_message(message_type="text")
 def on_text_message(bot, message_id, content, message, *args, **kwargs):
+    keys = mark_event(message.get("header", {}).get("event_id"), message_id)
+    if keys is None:
+        return
     text = content["text"]
     # print("reply_text", message_id, text)
     # bot.reply_text(message_id, "reply: " + text)
@@ -82,11 +205,19 @@ def on_text_message(bot, message_id, content, message, *args, **kwargs):
         parser.on_comment(text, bot.app_id, message_id, content, message, **kwargs)
     except Exception as e:
         app.logger.exception(e)
+        unmark_event(keys)
 
 
 @hook.on_bot_event(event_type="p2p_chat_create")
 def on_bot_event(bot, event_id, event, message, *args, **kwargs):
-    parser.on_welcome(bot.app_id, event_id, event, message, **kwargs)
+    keys = mark_event(event_id)
+    if keys is None:
+        return
+    try:
+        parser.on_welcome(bot.app_id, event_id, event, message, **kwargs)
+    except Exception as e:
+        unmark_event(keys)
+        raise e
 
 
 @oauth.on_bot_event(event_type="oauth:user_info")
@@ -16,7 +16,12 @@ from model.team import (
     save_team_contact,
     set_team_member,
 )
-from tasks import get_contact_by_lark_application, get_status_by_id, pull_github_members
+from tasks import (
+    get_contact_by_lark_application,
+    get_status_by_id,
+    get_sync_progress,
+    pull_github_members,
+)
 from utils.auth import authenticated
 
 bp = Blueprint("team", __name__, url_prefix="/api/team")
@@ -261,8 +266,12 @@ def get_task_result_by_id(team_id, task_id):
                 "task_id": task.id,
                 "status": task.status,
                 "result": (
-                    task.result if isinstance(task.result, list) else str(task.result)
+                    task.result
+                    if isinstance(task.result, (list, dict))
+                    else str(task.result)
                 ),
+                # 同步仓库的任务，返回子任务的整体进度
+                "progress": get_sync_progress(task_id),
             },
         }
     )
@@ -1,6 +1,7 @@
 from datetime import timedelta
 
 from celery import chain
+from celery.signals import worker_ready
 from celery_app import celery
 
 from .github import *
@@ -13,10 +14,17 @@ celery.conf.beat_schedule = {
         "schedule": timedelta(minutes=10),  # 定时1minutes执行一次
         "args": (),  # 函数传参的值
     },
-    # 定时拉取（更新）所有 GitHub 侧信息
+    # 定时增量拉取 GitHub 侧变化（ETag + updated_at/pushed_at）
+    "pull_github_repo_incremental_all": {
+        "task": "tasks.github.github.pull_github_repo_incremental_all",
+        "schedule": timedelta(hours=1),
+        "args": (),
+    },
+    # 定时全量拉取（更新）所有 GitHub 侧信息
+    # 增量同步已经覆盖协作者/权限变化，全量同步只用来兜底
     "pull_github_repo_all": {
         "task": "tasks.github.github.pull_github_repo_all",
-        "schedule": timedelta(hours=24),
+        "schedule": timedelta(days=7),
         "args": (),
     },
 }
@@ -24,3 +32,9 @@ celery.conf.beat_schedule = {
 
 def get_status_by_id(task_id):
     return celery.AsyncResult(task_id)
+
+
+@worker_ready.connect
+def on_worker_ready(sender, **kwargs):
+    # worker 启动时预热飞书 tenant_access_token
+    prewarm_lark_tokens.delay()
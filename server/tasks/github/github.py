@@ -1,17 +1,190 @@
-from celery_app import celery
-from model.repo import create_repo_from_github
-from model.schema import CodeApplication, Team, db
+import json
+from time import time
+
+from app import app
+from celery import chord
+from celery_app import GitHubSyncTask, celery
+from model.repo import RepoSyncer
+from model.schema import CodeApplication, Repo, Team, db
+from utils.constant import GitHubRateLimitError
 from utils.github.organization import GitHubAppOrg
+from utils.github.ratelimit import background_priority
 from utils.github.repo import GitHubAppRepo
+from utils.redis import client
 from utils.user import create_github_member
 
+app.config.setdefault("GITHUB_SYNC_STATE_EXPIRE", 60 * 60 * 24 * 30)
+# 每个 installation 同时同步仓库的子任务数
+app.config.setdefault("GITHUB_SYNC_CONCURRENCY", 4)
+app.config.setdefault("GITHUB_SYNC_PROGRESS_EXPIRE", 60 * 60 * 24)
+# 同步的仓库数达到这个值时，用 GraphQL 批量拉取协作者，0 表示不使用 GraphQL
+app.config.setdefault("GITHUB_SYNC_GRAPHQL_MIN_REPOS", 10)
 
-@celery.task()
+
+def _sync_state_key(installation_id, name):
+    return f"github:sync:{installation_id}:{name}"
+
+
+def _repo_watermark(repo: dict) -> str:
+    return f"{repo.get('updated_at')}|{repo.get('pushed_at')}"
+
+
+def save_repo_watermarks(installation_id: str, repos: list):
+    """Remember updated_at/pushed_at of the synced repos."""
+    if not repos:
+        return
+    key = _sync_state_key(installation_id, "repo_watermark")
+    try:
+        client.hset(
+            key, mapping={str(repo["id"]): _repo_watermark(repo) for repo in repos}
+        )
+        client.expire(key, app.config["GITHUB_SYNC_STATE_EXPIRE"])
+    except Exception as e:
+        app.logger.error(f"Failed to save repo watermarks: {e}")
+
+
+def fetch_modified_pages(
+    github_app, url: str, state_key: str, items=None, force=False
+) -> tuple[list, dict]:
+    """Fetch the pages of a GitHub list API which changed since the last sync.
+
+    Every page is requested with the ETag of the last sync, unchanged pages
+    return 304 and cost nothing.
+
+    Args:
+        github_app: GitHub app instance.
+        url (str): The url of the list API, without page args.
+        state_key (str): Redis hash of page -> [etag, count].
+        items (callable, optional): Get the items from the response.
+        force (bool, optional): Ignore the saved ETags.
+
+    Returns:
+        tuple: (items of the changed pages, page states to save after the items
+        are handled).
+    """
+    state = {} if force else client.hgetall(state_key)
+    changed, pending = [], {}
+    page = 1
+    while True:
+        etag, count = json.loads(state[str(page)]) if str(page) in state else ("", 0)
+        modified, data, etag = github_app.get_if_modified(
+            f"{url}?per_page=100&page={page}", etag
+        )
+        if modified:
+            data = items(data) if items else data
+            count = len(data)
+            pending[str(page)] = json.dumps([etag, count])
+            changed.extend(data)
+        # 最后一页（不满 100 条）之后不再请求
+        if count < 100:
+            break
+        page = page + 1
+    return changed, pending
+
+
+def save_page_states(state_key: str, pending: dict):
+    if not pending:
+        return
+    client.hset(state_key, mapping=pending)
+    client.expire(state_key, app.config["GITHUB_SYNC_STATE_EXPIRE"])
+
+
+def _progress_key(task_id):
+    return f"github:sync:progress:{task_id}"
+
+
+def get_sync_progress(task_id: str) -> dict | None:
+    """Get the progress of pull_github_repo.
+
+    Args:
+        task_id (str): The id of the pull_github_repo task.
+
+    Returns:
+        dict: total/done/failed repos, the stats once finished. None if the
+        task is not a repo sync.
+    """
+    try:
+        progress = client.hgetall(_progress_key(task_id))
+    except Exception as e:
+        app.logger.error(f"Failed to get sync progress: {e}")
+        return None
+    if not progress:
+        return None
+
+    result = {name: int(progress.get(name, 0)) for name in ["total", "done", "failed"]}
+    result["finished"] = "stats" in progress
+    if result["finished"]:
+        result["stats"] = json.loads(progress["stats"])
+    return result
+
+
+def prefetch_collaborators(org_name: str, installation_id: str, repos: list) -> dict:
+    """Fetch the collaborators of many repos with GraphQL.
+
+    GraphQL always walks the whole org, so it is only used when enough repos
+    are synced. Repos missing in the result are synced through REST.
+
+    Returns:
+        dict: GitHub repo id -> collaborators.
+    """
+    min_repos = app.config["GITHUB_SYNC_GRAPHQL_MIN_REPOS"]
+    if not min_repos or len(repos) < min_repos:
+        return {}
+    try:
+        collaborators = GitHubAppRepo(installation_id).get_org_repo_collaborators(
+            org_name
+        )
+    except Exception as e:
+        app.logger.exception(f"Failed to get collaborators by GraphQL: {e}")
+        return {}
+
+    repo_ids = {str(repo["id"]) for repo in repos}
+    result = {
+        repo_id: value
+        for repo_id, value in collaborators.items()
+        if repo_id in repo_ids
+    }
+    app.logger.info(
+        "prefetch_collaborators %s: %d/%d repos by GraphQL",
+        org_name,
+        len(result),
+        len(repos),
+    )
+    return result
+
+
+def _sync_repos(
+    org_name, installation_id, application_id, repos, callback=None, collaborators=None
+) -> tuple[dict, bool]:
+    github_app = GitHubAppRepo(installation_id)
+    syncer = RepoSyncer(org_name, application_id, github_app, collaborators)
+    try:
+        repo_ids = syncer.sync(repos, callback=callback)
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    # 成员同步被跳过的仓库不记录水位，下一次增量同步时重试
+    synced = [
+        repo
+        for repo in repos
+        if str(repo["id"]) in repo_ids and str(repo["id"]) not in syncer.skipped_repos
+    ]
+    save_repo_watermarks(installation_id, synced)
+    return syncer.stats, len(synced) == len(repos)
+
+
+@celery.task(bind=True, base=GitHubSyncTask)
+@background_priority()
 def pull_github_repo(
-    org_name: str, installation_id: str, application_id: str, team_id: str
+    self, org_name: str, installation_id: str, application_id: str, team_id: str
 ):
     """Pull repo from GitHub, build Repo and RepoUser.
 
+    The repos are split into at most GITHUB_SYNC_CONCURRENCY chunks, every chunk
+    is synced by a sync_github_repo_chunk subtask and finish_github_repo_sync
+    aggregates the stats. Use get_sync_progress(task_id) to get the progress.
+
     Args:
         org_name: GitHub organization name.
         installation_id: GitHub App installation id.
@@ -31,23 +204,267 @@ def pull_github_repo(
     create_github_member(members, application_id, team_id)
 
     # 拉取所有组织仓库，创建 Repo
-    repos = github_app.get_org_repos_accessible()
-    github_app = GitHubAppRepo(installation_id)
-    try:
-        for repo in repos:
-            create_repo_from_github(
-                repo=repo,
-                org_name=org_name,
-                application_id=application_id,
-                github_app=github_app,
-            )
+    repos = list(github_app.get_org_repos_accessible())
 
-    except Exception as e:
-        db.session.rollback()
+    task_id = self.request.id
+    progress_key = _progress_key(task_id)
+    client.hset(
+        progress_key,
+        mapping=dict(total=len(repos), done=0, failed=0, started=time()),
+    )
+    client.expire(progress_key, app.config["GITHUB_SYNC_PROGRESS_EXPIRE"])
+
+    collaborators = prefetch_collaborators(org_name, installation_id, repos)
+
+    concurrency = max(1, app.config["GITHUB_SYNC_CONCURRENCY"])
+    chunks = [repos[i::concurrency] for i in range(min(concurrency, len(repos)))]
+    if not chunks:
+        return finish_github_repo_sync([], org_name, task_id)
+
+    chord(
+        sync_github_repo_chunk.s(
+            org_name,
+            installation_id,
+            application_id,
+            chunk,
+            task_id,
+            collaborators={
+                str(repo["id"]): collaborators[str(repo["id"])]
+                for repo in chunk
+                if str(repo["id"]) in collaborators
+            },
+        )
+        for chunk in chunks
+    )(finish_github_repo_sync.s(org_name, task_id))
+    return dict(total=len(repos), chunks=len(chunks))
+
+
+@celery.task(base=GitHubSyncTask)
+@background_priority()
+def sync_github_repo_chunk(
+    org_name: str,
+    installation_id: str,
+    application_id: str,
+    repos: list,
+    task_id: str,
+    collaborators: dict = None,
+) -> dict:
+    """Sync a chunk of repos of pull_github_repo.
+
+    Args:
+        org_name: GitHub organization name.
+        installation_id: GitHub App installation id.
+        application_id: Code application id.
+        repos: repo info from github.
+        task_id: The id of the pull_github_repo task.
+        collaborators: GitHub repo id -> collaborators fetched by GraphQL.
+
+    Returns:
+        dict: The stats of RepoSyncer.
+    """
+    progress_key = _progress_key(task_id)
+
+    def on_synced(repo, repo_id):
+        try:
+            client.hincrby(progress_key, "done" if repo_id else "failed")
+        except Exception as e:
+            app.logger.error(f"Failed to update sync progress: {e}")
+
+    try:
+        stats, _ = _sync_repos(
+            org_name,
+            installation_id,
+            application_id,
+            repos,
+            callback=on_synced,
+            collaborators=collaborators,
+        )
+    except GitHubRateLimitError as e:
+        # 延后重试这一批仓库，task id 不变，chord 会等重试完成
         raise e
+    except Exception as e:
+        # 不抛出异常，避免 chord 的汇总任务不执行
+        app.logger.exception(f"Failed to sync repos of {org_name}: {e}")
+        client.hincrby(progress_key, "failed", len(repos))
+        stats = dict(repos=len(repos), repo_failed=len(repos))
+    return stats
 
 
 @celery.task()
+def finish_github_repo_sync(results: list, org_name: str, task_id: str) -> dict:
+    """Aggregate the stats of sync_github_repo_chunk.
+
+    Args:
+        results: The stats of every chunk.
+        org_name: GitHub organization name.
+        task_id: The id of the pull_github_repo task.
+
+    Returns:
+        dict: The stats of the whole sync.
+    """
+    progress_key = _progress_key(task_id)
+    stats = {}
+    for result in results:
+        for name, value in result.items():
+            # 子任务是并发执行的，耗时按整体计算
+            if name not in ["seconds", "rows_per_second"]:
+                stats[name] = stats.get(name, 0) + value
+
+    started = client.hget(progress_key, "started")
+    seconds = time() - float(started) if started else 0
+    rows = stats.get("rows", 0)
+    stats.update(
+        seconds=round(seconds, 3),
+        rows_per_second=round(rows / seconds, 1) if seconds > 0 else rows,
+    )
+    client.hset(progress_key, "stats", json.dumps(stats))
+    client.expire(progress_key, app.config["GITHUB_SYNC_PROGRESS_EXPIRE"])
+
+    app.logger.info(
+        "pull_github_repo %s: %d repos, %d rows in %.2fs (%.1f rows/s)",
+        org_name,
+        stats.get("repos", 0),
+        rows,
+        stats["seconds"],
+        stats["rows_per_second"],
+    )
+    return stats
+
+
+def sync_collaborator_changes(
+    org_name: str, installation_id: str, application_id: str, skip=()
+) -> int:
+    """Sync the repos whose collaborators changed since the last sync.
+
+    Repo updated_at/pushed_at do not change when only collaborators or their
+    permissions change, so the collaborators of every repo are requested with
+    the ETag of the last sync. Unchanged lists return 304 and cost nothing.
+
+    Args:
+        org_name (str): GitHub organization name.
+        installation_id (str): GitHub App installation id.
+        application_id (str): Code application id.
+        skip (optional): GitHub repo ids which are already synced.
+
+    Returns:
+        int: The number of repos whose collaborators are synced.
+    """
+    github_app = GitHubAppRepo(installation_id)
+    syncer = RepoSyncer(org_name, application_id, github_app)
+    repos = (
+        db.session.query(Repo.id, Repo.repo_id, Repo.name)
+        .filter(
+            Repo.application_id == application_id,
+            Repo.status == 0,
+        )
+        .all()
+    )
+
+    synced = 0
+    for repo_id, github_repo_id, name in repos:
+        if github_repo_id in skip:
+            continue
+        state_key = _sync_state_key(installation_id, f"collaborators:{github_repo_id}")
+        try:
+            _, pending = fetch_modified_pages(
+                github_app,
+                f"https://api.github.com/repos/{org_name}/{name}/collaborators",
+                state_key,
+            )
+            if not pending:
+                continue
+            # 有变化的页不一定是完整列表，重新拉取全部协作者
+            if syncer.sync_collaborators(repo_id, dict(id=github_repo_id, name=name)):
+                save_page_states(state_key, pending)
+                synced = synced + 1
+        except GitHubRateLimitError as e:
+            raise e
+        except Exception as e:
+            app.logger.exception(f"Failed to sync collaborators of repo {name}: {e}")
+    return synced
+
+
+@celery.task(base=GitHubSyncTask)
+@background_priority()
+def pull_github_repo_incremental(
+    org_name: str, installation_id: str, application_id: str, team_id: str
+):
+    """Pull the changes from GitHub since the last sync.
+
+    1. 组织成员用 ETag 条件请求，没有变化时不会再拉取
+    2. 仓库列表用 ETag 条件请求，再对比 updated_at/pushed_at，只同步变化的仓库
+    3. 组织成员有变化时，新成员可能已经是仓库协作者，重新同步所有仓库的协作者
+    4. 其余仓库的协作者列表用 ETag 条件请求，只同步协作者有变化的仓库
+
+    Args:
+        org_name: GitHub organization name.
+        installation_id: GitHub App installation id.
+        application_id: Code application id.
+        team_id: Team id.
+    """
+    github_app = GitHubAppOrg(installation_id)
+
+    members_key = _sync_state_key(installation_id, "members")
+    members, members_pending = fetch_modified_pages(
+        github_app, f"https://api.github.com/orgs/{org_name}/members", members_key
+    )
+    if members:
+        create_github_member(members, application_id, team_id)
+
+    repos_key = _sync_state_key(installation_id, "repos")
+    repos, repos_pending = fetch_modified_pages(
+        github_app,
+        "https://api.github.com/installation/repositories",
+        repos_key,
+        items=lambda data: data.get("repositories", []),
+        force=len(members) > 0,
+    )
+    if members:
+        changed = repos
+    else:
+        watermarks = client.hgetall(_sync_state_key(installation_id, "repo_watermark"))
+        changed = [
+            repo
+            for repo in repos
+            if watermarks.get(str(repo["id"])) != _repo_watermark(repo)
+        ]
+
+    stats, success = _sync_repos(
+        org_name,
+        installation_id,
+        application_id,
+        changed,
+        collaborators=prefetch_collaborators(org_name, installation_id, changed),
+    )
+    # 有仓库同步失败时不保存 ETag，下次重新拉取这一页
+    # 成员的 ETag 也一样，否则下次不会再因为成员变化重新同步所有仓库的协作者
+    if success:
+        save_page_states(members_key, members_pending)
+        save_page_states(repos_key, repos_pending)
+
+    collaborators_changed = sync_collaborator_changes(
+        org_name,
+        installation_id,
+        application_id,
+        skip={str(repo["id"]) for repo in changed},
+    )
+
+    app.logger.info(
+        "pull_github_repo_incremental %s: %d members changed, %d/%d repos changed, "
+        "%d repos with collaborators changed, %d rows in %.2fs",
+        org_name,
+        len(members),
+        len(changed),
+        len(repos),
+        collaborators_changed,
+        stats["rows"],
+        stats["seconds"],
+    )
+    return stats
+
+
+@celery.task(base=GitHubSyncTask)
+@background_priority()
 def pull_github_members(
     installation_id: str, org_name: str, team_id: str, application_id: str = None
 ) -> list | None:
@@ -68,10 +485,7 @@ def pull_github_members(
     return True
 
 
-@celery.task()
-def pull_github_repo_all():
-    """Pull all repo from GitHub, build Repo and RepoUser."""
-
+def _pull_github_repo_for_all_teams(task) -> list:
     task_ids = []
     # 查询所有的 application 和对应的 team
     for team in db.session.query(Team).all():
@@ -82,12 +496,24 @@ def pull_github_repo_all():
         if application is None:
             continue
 
-        task = pull_github_repo.delay(
+        result = task.delay(
             org_name=team.name,
             installation_id=application.installation_id,
             application_id=application.id,
             team_id=team.id,
         )
-        task_ids.append(task.id)
+        task_ids.append(result.id)
 
     return task_ids
+
+
+@celery.task()
+def pull_github_repo_all():
+    """Pull all repo from GitHub, build Repo and RepoUser."""
+    return _pull_github_repo_for_all_teams(pull_github_repo)
+
+
+@celery.task()
+def pull_github_repo_incremental_all():
+    """Pull the changes of all teams from GitHub."""
+    return _pull_github_repo_for_all_teams(pull_github_repo_incremental)
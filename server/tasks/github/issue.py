@@ -3,6 +3,7 @@ import os
 from app import app, db
 from celery_app import celery
 from model.schema import Issue, ObjID, PullRequest, Repo
+from sqlalchemy.exc import IntegrityError
 from tasks.github.repo import on_repository_updated
 from tasks.lark.issue import send_issue_card, send_issue_comment, update_issue_card
 from tasks.lark.pull_request import send_pull_request_comment
@@ -165,7 +166,13 @@ def on_issue_opened(event_dict: dict | None) -> list:
         extra=issue_info.model_dump(),
     )
     db.session.add(new_issue)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 重复投递的事件并发创建了同一个 Issue，以先创建的为准
+        db.session.rollback()
+        app.logger.info(f"Issue already exists: {repo.id} {issue_info.number}")
+        return []
 
     task = send_issue_card.delay(issue_id=new_issue.id)
 
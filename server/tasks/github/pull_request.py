@@ -1,6 +1,7 @@
 from app import app, db
 from celery_app import celery
 from model.schema import ObjID, PullRequest, Repo
+from sqlalchemy.exc import IntegrityError
 from tasks.lark.pull_request import send_pull_request_card, update_pull_request_card
 from utils.github.model import PullRequestEvent
 
@@ -79,7 +80,13 @@ def on_pull_request_opened(event_dict: dict | list | None) -> list:
         extra=pr_info.model_dump(),
     )
     db.session.add(new_pr)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 重复投递的事件并发创建了同一个 PullRequest，以先创建的为准
+        db.session.rollback()
+        app.logger.info(f"PullRequest already exists: {repo.id} {pr_info.number}")
+        return []
 
     task = send_pull_request_card.delay(new_pr.id)
 
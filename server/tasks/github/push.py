@@ -1,8 +1,10 @@
 from app import app, db
 from celery_app import celery
-from model.schema import ChatGroup, PullRequest, Repo
+from model.context import resolve_context
+from model.schema import PullRequest
 from tasks.lark.base import get_bot_by_application_id
 from utils.github.model import PushEvent
+from utils.lark import ratelimit
 from utils.lark.pr_tip_commit_history import PrTipCommitHistory
 
 
@@ -15,10 +17,11 @@ def on_push(data: dict | None) -> list:
         raise e
 
     # 查找有没有对应的 repo
-    repo = db.session.query(Repo).filter(Repo.repo_id == event.repository.id).first()
-    if not repo:
+    context = resolve_context(github_repo_id=event.repository.id)
+    if not context:
         app.logger.info(f"Repo not found: {event.repository.name}")
         return []
+    repo = context.repo
 
     pr = (
         db.session.query(PullRequest)
@@ -35,19 +38,19 @@ def on_push(data: dict | None) -> list:
         return []
 
     # 发送 Commit Log 信息
-    chat_group = (
-        db.session.query(ChatGroup).filter(ChatGroup.id == repo.chat_group_id).first()
-    )
+    chat_group = context.chat_group
     if not chat_group:
         app.logger.info(f"ChatGroup not found: {repo.name}")
         return []
 
     bot, application = get_bot_by_application_id(chat_group.im_application_id)
-    reply_result = bot.reply(
-        pr.message_id,
-        PrTipCommitHistory(
-            commits=event.commits,
-        ),
-    )
+    # 大量 push 时按群限流
+    with ratelimit.chat(chat_group.chat_id):
+        reply_result = bot.reply(
+            pr.message_id,
+            PrTipCommitHistory(
+                commits=event.commits,
+            ),
+        )
     app.logger.info(f"Reply result: {reply_result}")
     return reply_result.json()
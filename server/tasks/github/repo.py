@@ -1,16 +1,9 @@
 from app import app, db
 from celery_app import celery
+from model.context import invalidate_context, resolve_context
 from model.repo import create_repo_from_github
-from model.schema import (
-    BindUser,
-    CodeApplication,
-    IMApplication,
-    Repo,
-    RepoUser,
-    Team,
-    TeamMember,
-)
-from tasks.lark import update_repo_info
+from model.schema import BindUser, Repo, RepoUser, TeamMember
+from tasks.lark import delay_update_repo_info
 from tasks.lark.manage import send_detect_repo
 from utils.github.model import ForkEvent, RepoEvent, StarEvent
 from utils.github.repo import GitHubAppRepo
@@ -59,26 +52,11 @@ def on_repository_created(event_dict: dict | list | None) -> list:
     # repo_info = github_app.get_repo_info(event.repository.id)
     repo_info = event.repository.model_dump()
 
-    code_application = (
-        db.session.query(CodeApplication)
-        .filter(
-            CodeApplication.installation_id == str(event.installation.id),
-            CodeApplication.status == 0,
-        )
-        .first()
-    )
-
-    team = (
-        db.session.query(Team)
-        .filter(
-            Team.id == code_application.team_id,
-            Team.status == 0,
-        )
-        .first()
-    )
-    if team is None:
-        app.logger.error(f"Team {code_application.team_id} not found")
+    context = resolve_context(installation_id=event.installation.id)
+    if context is None or context.team is None:
+        app.logger.error(f"Team of installation {event.installation.id} not found")
         return []
+    code_application, team = context.code_application, context.team
 
     # 创建 repo，同时创建配套的 repo_user
     new_repo = create_repo_from_github(
@@ -98,6 +76,7 @@ def on_repository_created(event_dict: dict | list | None) -> list:
         .filter(
             RepoUser.repo_id == new_repo.id,
             RepoUser.permission == "admin",
+            RepoUser.status == 0,
             BindUser.platform == "github",
         )
         .all()
@@ -127,14 +106,10 @@ def on_repository_created(event_dict: dict | list | None) -> list:
         app.logger.error(f"Repo {new_repo.id} has no lark admin user")
         return []
 
-    # 查找 im application
-    im_application = (
-        db.session.query(IMApplication)
-        .filter(
-            IMApplication.team_id == team.id,
-        )
-        .first()
-    )
+    im_application = context.im_application
+    if im_application is None:
+        app.logger.error(f"Team {team.id} has no im application")
+        return []
 
     task_ids = []
     for bind_user in admin_lark_bind_users:
@@ -233,7 +208,9 @@ def on_repository_updated(event_dict: dict | None) -> list[str]:
     repo.extra = event.repository.model_dump()
 
     db.session.commit()
+    invalidate_context(repo_id=repo.id)
 
-    task = update_repo_info.delay(repo.id)
+    # 合并短时间内的多次更新，只刷新一次 repo 卡片
+    task = delay_update_repo_info(repo.id)
 
-    return [task.id]
+    return [task.id] if task else []
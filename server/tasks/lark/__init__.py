@@ -1,4 +1,5 @@
 from .base import *
+from .card import *
 from .chat import *
 from .issue import *
 from .lark import *
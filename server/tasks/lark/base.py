@@ -1,13 +1,22 @@
+import hashlib
 import json
 import logging
 import os
+import threading
+from collections import OrderedDict
 from functools import wraps
 
-from connectai.lark.sdk import Bot
+from celery_app import celery
+from model.context import Snapshot
 from model.schema import ChatGroup, IMApplication, Issue, ObjID, PullRequest, Repo, db
 from sqlalchemy import or_
-from utils.constant import GitHubPermissionError
-from utils.redis import RedisStorage
+from utils.constant import GitHubPermissionError, LarkRateLimitError, TopicType
+from utils.lark import ratelimit
+from utils.lark.bot import GitMayaBot, bot_registry
+from utils.redis import TokenStorage, client, incr_metrics
+
+# 卡片内容 hash 的保存时间，超过之后会重新发送一次更新
+CARD_HASH_EXPIRE = 60 * 60 * 24 * 7
 
 
 def get_chat_group_by_chat_id(chat_id):
@@ -41,6 +50,21 @@ def get_repo_by_repo_id(repo_id):
 
 
 def get_bot_by_application_id(app_id):
+    """Get the bot of the IMApplication, bots are cached in `bot_registry`.
+
+    Args:
+        app_id (str): IMApplication.app_id or IMApplication.id.
+
+    Returns:
+        tuple: (GitMayaBot, application), the application is a read-only
+            Snapshot, (None, None) if not found.
+    """
+    cached = bot_registry.get(app_id)
+    if cached:
+        incr_metrics("lark_bot_registry", "hit")
+        return cached
+
+    incr_metrics("lark_bot_registry", "miss")
     application = (
         db.session.query(IMApplication)
         .filter(
@@ -51,32 +75,163 @@ def get_bot_by_application_id(app_id):
         )
         .first()
     )
-    if application:
-        return (
-            Bot(
-                app_id=application.app_id,
-                app_secret=application.app_secret,
-                encrypt_key=application.extra.get("encrypt_key"),
-                verification_token=application.extra.get("verification_token"),
-                storage=RedisStorage(),
-            ),
-            application,
+    if not application:
+        return None, None
+    bot = GitMayaBot(
+        app_id=application.app_id,
+        app_secret=application.app_secret,
+        encrypt_key=application.extra.get("encrypt_key"),
+        verification_token=application.extra.get("verification_token"),
+        storage=TokenStorage(),
+    )
+    # 缓存的 application 会跨 session 使用，只保留一份只读快照
+    application = Snapshot(
+        {
+            field: getattr(application, field)
+            for field in ["id", "team_id", "platform", "app_id", "app_secret", "extra"]
+        }
+    )
+    bot_registry.set(bot, application)
+    return bot, application
+
+
+@celery.task(bind=True, max_retries=10)
+def send_deferred_lark_requests(self, app_id, queue):
+    """Send the Lark requests re-queued by the rate limit of GitMayaBot.
+
+    Only the throttled requests are sent again, not the tasks which made them.
+    Requests are sent in the order they were deferred, a request leaves the
+    queue only after it is sent, so a retry starts from the same request.
+
+    Args:
+        app_id (str): IMApplication.app_id.
+        queue (str): The chat id or thread of the requests.
+    """
+    bot, _ = get_bot_by_application_id(app_id)
+    if not bot:
+        return None
+    while True:
+        request = ratelimit.peek_deferred(app_id, queue)
+        if request is None:
+            return None
+        try:
+            with ratelimit.chat(request["chat_id"]):
+                bot.request(request["method"], request["url"], json=request["json"])
+        except LarkRateLimitError as e:
+            if self.request.retries < self.max_retries:
+                raise self.retry(exc=e, countdown=e.retry_after)
+            # 重试次数用完时丢掉这个请求，后面的请求重新开始计数
+            logging.error("drop deferred lark request %r %r", queue, request)
+            ratelimit.pop_deferred(app_id, queue)
+            send_deferred_lark_requests.apply_async(
+                args=(app_id, queue), countdown=e.retry_after
+            )
+            return None
+        except Exception as e:
+            logging.exception("deferred lark request %r %r: %r", queue, request, e)
+        ratelimit.pop_deferred(app_id, queue)
+
+
+def _card_hash(content):
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+
+
+def remember_card(message_id, content):
+    """Save the hash of the card last sent for message_id."""
+    try:
+        client.set(
+            f"lark:card_hash:{message_id}", _card_hash(content), ex=CARD_HASH_EXPIRE
         )
-    return None, None
+    except Exception as e:
+        logging.error(e)
 
 
-def get_git_object_by_message_id(message_id):
+def update_card(bot, message_id, content):
+    """Update a card message, skip the request if the card is not changed.
+
+    Args:
+        bot (Bot): The bot instance.
+        message_id (str): The ID of the Lark message.
+        content (FeishuMessageCard): The rendered card.
+
+    Returns:
+        dict: The JSON response from the bot's update method.
     """
-    根据message_id区分Repo、Issue、PullRequest对象
+    key = f"lark:card_hash:{message_id}"
+    digest = _card_hash(content)
+    try:
+        if client.get(key) == digest:
+            incr_metrics("lark_card_update", "skipped")
+            return {"code": 0, "msg": "skipped", "data": {}}
+    except Exception as e:
+        logging.error(e)
 
-    参数：
-    message_id：消息ID
+    result = bot.update(message_id=message_id, content=content).json()
+    incr_metrics("lark_card_update", "sent")
+    # 延后发送的更新还没有生效，不记录
+    if result.get("code") == 0 and result.get("msg") != "deferred":
+        remember_card(message_id, content)
+    return result
 
-    返回值：
-    repo：Repo对象，如果存在
-    issue：Issue对象，如果存在
-    pr：PullRequest对象，如果存在
+
+# message_id -> (topic, object_id) 的缓存，消息和对象的对应关系不会变化
+MESSAGE_OBJECT_EXPIRE = 60 * 60 * 24 * 30
+# 普通消息（不是 repo/issue/pr 卡片）也缓存一小段时间，避免重复查库
+MESSAGE_OBJECT_MISS_EXPIRE = 60
+MESSAGE_OBJECT_LOCAL_SIZE = 10000
+_message_objects = OrderedDict()
+_message_objects_lock = threading.Lock()
+
+
+def _remember_message_object_local(message_id, topic, object_id):
+    with _message_objects_lock:
+        _message_objects[message_id] = (topic, object_id)
+        _message_objects.move_to_end(message_id)
+        while len(_message_objects) > MESSAGE_OBJECT_LOCAL_SIZE:
+            _message_objects.popitem(last=False)
+
+
+def set_message_object(message_id, topic, object_id):
+    """Save which Repo/Issue/PullRequest a card message belongs to.
+
+    Args:
+        message_id (str): The ID of the Lark message.
+        topic (TopicType): TopicType.REPO, TopicType.ISSUE or TopicType.PULL_REQUEST.
+        object_id (str): Repo.id, Issue.id or PullRequest.id.
     """
+    if not message_id:
+        return
+    _remember_message_object_local(message_id, topic.value, object_id)
+    try:
+        client.set(
+            f"lark:message:{message_id}",
+            json.dumps([topic.value, object_id]),
+            ex=MESSAGE_OBJECT_EXPIRE,
+        )
+    except Exception as e:
+        logging.error(e)
+
+
+def _get_message_object_cache(message_id):
+    """Returns: (topic, object_id), ("", None) for cached miss, None if unknown."""
+    cached = _message_objects.get(message_id)
+    if cached:
+        return cached
+    try:
+        value = client.get(f"lark:message:{message_id}")
+        if value:
+            topic, object_id = json.loads(value)
+            if topic:
+                _remember_message_object_local(message_id, topic, object_id)
+            return topic, object_id
+    except Exception as e:
+        logging.error(e)
+    return None
+
+
+def _find_git_object_by_message_id(message_id):
     issue = (
         db.session.query(Issue)
         .filter(
@@ -85,6 +240,7 @@ def get_git_object_by_message_id(message_id):
         .first()
     )
     if issue:
+        set_message_object(message_id, TopicType.ISSUE, issue.id)
         return None, issue, None
     pr = (
         db.session.query(PullRequest)
@@ -94,6 +250,7 @@ def get_git_object_by_message_id(message_id):
         .first()
     )
     if pr:
+        set_message_object(message_id, TopicType.PULL_REQUEST, pr.id)
         return None, None, pr
     repo = (
         db.session.query(Repo)
@@ -103,11 +260,79 @@ def get_git_object_by_message_id(message_id):
         .first()
     )
     if repo:
+        set_message_object(message_id, TopicType.REPO, repo.id)
         return repo, None, None
 
+    try:
+        client.set(
+            f"lark:message:{message_id}",
+            json.dumps(["", None]),
+            ex=MESSAGE_OBJECT_MISS_EXPIRE,
+        )
+    except Exception as e:
+        logging.error(e)
     return None, None, None
 
 
+def get_topic_by_message_id(message_id):
+    """
+    根据message_id区分消息所在的话题类型，优先使用缓存
+
+    返回值：
+    TopicType.REPO / TopicType.ISSUE / TopicType.PULL_REQUEST，找不到返回 ""
+    """
+    cached = _get_message_object_cache(message_id)
+    if cached is not None:
+        return TopicType(cached[0]) if cached[0] else ""
+
+    repo, issue, pr = _find_git_object_by_message_id(message_id)
+    if repo:
+        return TopicType.REPO
+    elif issue:
+        return TopicType.ISSUE
+    elif pr:
+        return TopicType.PULL_REQUEST
+    return ""
+
+
+def get_git_object_by_message_id(message_id):
+    """
+    根据message_id区分Repo、Issue、PullRequest对象
+
+    参数：
+    message_id：消息ID
+
+    返回值：
+    repo：Repo对象，如果存在
+    issue：Issue对象，如果存在
+    pr：PullRequest对象，如果存在
+    """
+    cached = _get_message_object_cache(message_id)
+    if cached is None:
+        return _find_git_object_by_message_id(message_id)
+
+    topic, object_id = cached
+    if not topic:
+        return None, None, None
+
+    topic = TopicType(topic)
+    if TopicType.ISSUE == topic:
+        issue = db.session.query(Issue).filter(Issue.id == object_id).first()
+        if issue:
+            return None, issue, None
+    elif TopicType.PULL_REQUEST == topic:
+        pr = db.session.query(PullRequest).filter(PullRequest.id == object_id).first()
+        if pr:
+            return None, None, pr
+    elif TopicType.REPO == topic:
+        repo = db.session.query(Repo).filter(Repo.id == object_id).first()
+        if repo:
+            return repo, None, None
+
+    # 对象被删除了，重新查一次
+    return _find_git_object_by_message_id(message_id)
+
+
 def with_authenticated_github():
     def decorate(func):
         @wraps(func)
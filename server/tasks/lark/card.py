@@ -0,0 +1,124 @@
+import json
+import logging
+from functools import lru_cache
+from time import time
+
+from celery_app import app, celery
+from utils.redis import observe_latency
+
+from .base import get_bot_by_application_id
+
+
+def get_card_action_message(bot, data):
+    """Build the message event of the card, like the one of the Lark SDK.
+
+    The card action callback only has the id of the message, the message is
+    fetched here so that the parser can read the chat and the sender.
+
+    Args:
+        bot (Bot): The bot instance.
+        data (dict): The card action callback.
+
+    Returns:
+        dict: The mock `im.message.receive_v1` event, `data` if the message
+            can not be fetched.
+    """
+    if "open_message_id" not in data:
+        return data
+    try:
+        messages = bot.get(
+            f"{bot.host}/open-apis/im/v1/messages/{data['open_message_id']}"
+        ).json()
+        items = messages.get("data", {}).get("items", [])
+        if len(items) == 0:
+            return data
+        raw_message = items[0]
+        message_sender = raw_message.pop("sender")
+        body = raw_message.pop("body")
+        msg_type = raw_message.pop("msg_type")
+        return {
+            "header": {
+                "app_id": message_sender["id"]
+                if message_sender["sender_type"] == "app"
+                else "",
+                "tenant_key": message_sender["tenant_key"],
+                "event_type": "card:action",
+                "token": data["token"],
+                "create_time": raw_message["create_time"],
+            },
+            "event": {
+                "message": {
+                    "content": json.loads(body["content"]),
+                    "message_type": msg_type,
+                    **raw_message,
+                },
+                "sender": {
+                    "sender_id": {
+                        "open_id": data["open_id"],
+                        "user_id": data["user_id"],
+                    },
+                    **message_sender,
+                },
+            },
+        }
+    except Exception as e:
+        logging.error(e)
+    return data
+
+
+@lru_cache(maxsize=None)
+def get_parser():
+    # parser 会引用 tasks，在这里再导入避免循环引用
+    from utils.lark.parser import GitMayaLarkParser
+
+    return GitMayaLarkParser()
+
+
+def get_card_action_command(data):
+    """Returns: the command of the clicked button or selected option, None if not a command."""
+    if "action" not in data or "command" not in data["action"].get("value", {}):
+        return None
+    command = data["action"]["value"]["command"]
+    suffix = data["action"]["value"].get("suffix")
+    # 将选择的直接拼接到后面
+    if suffix == "$option" and "option" in data["action"]:
+        command = command + data["action"]["option"]
+    return command
+
+
+@celery.task()
+def process_card_action(app_id, data, received_at=None):
+    """Run the command of a card action out of the webhook.
+
+    The webhook only acknowledges the action, the command is parsed here and
+    the card is updated by the tasks of the command.
+
+    Args:
+        app_id (str): IMApplication.app_id.
+        data (dict): The card action callback.
+        received_at (float): When the webhook received the action.
+    """
+    if received_at:
+        observe_latency("lark_card_action_queue", time() - received_at)
+    bot, _ = get_bot_by_application_id(app_id)
+    if not bot:
+        app.logger.error("unkown app_id of card_action %r", app_id)
+        return
+    command = get_card_action_command(data)
+    if not command:
+        app.logger.error("unkown card_action %r", (bot, data))
+        return
+
+    message = get_card_action_message(bot, data)
+    try:
+        get_parser().parse_args(
+            command,
+            bot.app_id,
+            data["open_message_id"],
+            data,
+            message,
+        )
+    except Exception as e:
+        app.logger.exception(e)
+    if received_at:
+        observe_latency("lark_card_action", time() - received_at)
@@ -18,7 +18,8 @@ from model.schema import (
 from model.team import get_code_users_by_openid
 from sqlalchemy.orm import aliased
 from tasks.lark.issue import replace_im_name_to_github_name
-from utils.github.repo import GitHubAppRepo
+from utils.github.client import run_async
+from utils.github.repo import AsyncGitHubAppRepo, GitHubAppRepo
 from utils.lark.chat_manual import ChatManual, ChatView
 from utils.lark.chat_tip_failed import ChatTipFailed
 from utils.lark.issue_card import IssueCard
@@ -290,7 +291,7 @@ def create_issue(
 
     openid = data["event"]["sender"]["sender_id"]["open_id"]
     # 这里连三个表查询，所以一次性都查出来
-    code_users = get_code_users_by_openid([openid] + users)
+    code_users = get_code_users_by_openid([openid] + users, team.id)
 
     import tasks
 
@@ -453,7 +454,7 @@ def sync_issue(
         )
     openid = data["event"]["sender"]["sender_id"]["open_id"]
     # 这里连三个表查询，所以一次性都查出来
-    code_users = get_code_users_by_openid([openid])
+    code_users = get_code_users_by_openid([openid], team.id)
 
     import tasks
 
@@ -473,14 +474,17 @@ def sync_issue(
     # 当前操作的用户
     current_code_user_id = code_users[openid][0]
 
-    github_app = GitHubAppRepo(
+    github_app = AsyncGitHubAppRepo(
         code_application.installation_id, user_id=current_code_user_id
     )
 
     # 后面需要插入记录，再发卡片，创建话题
-    repository = github_app.get_repo_info_by_name(team.name, repo.name)
+    # 仓库信息和 issue/pr 同时拉取
     if is_pr:
-        pull_request = github_app.get_one_pull_request(team.name, repo.name, issue_id)
+        repository, pull_request = run_async(
+            github_app.get_repo_info_by_name(team.name, repo.name),
+            github_app.get_one_pull_request(team.name, repo.name, issue_id),
+        )
         logging.debug("get_one_pull_requrst %r", pull_request)
         return tasks.on_pull_request_opened(
             {
@@ -491,7 +495,10 @@ def sync_issue(
             }
         )
     else:
-        issue = github_app.get_one_issue(team.name, repo.name, issue_id)
+        repository, issue = run_async(
+            github_app.get_repo_info_by_name(team.name, repo.name),
+            github_app.get_one_issue(team.name, repo.name, issue_id),
+        )
         logging.debug("get_one_issue %r", issue)
         return tasks.on_issue_opened(
             {
@@ -4,19 +4,12 @@ import re
 
 from celery_app import app, celery
 from connectai.lark.sdk import *
-from model.schema import (
-    ChatGroup,
-    CodeApplication,
-    CodeUser,
-    IMUser,
-    Issue,
-    Repo,
-    Team,
-    TeamMember,
-    db,
-)
-from model.team import get_assignees_by_openid
+from model.context import resolve_context
+from model.schema import CodeUser, IMUser, Issue, TeamMember, db
+from model.team import get_assignees_by_openid, get_team_identity_map
+from utils.constant import TopicType
 from utils.github.repo import GitHubAppRepo
+from utils.lark import ratelimit
 from utils.lark.issue_card import IssueCard
 from utils.lark.issue_manual_help import IssueManualHelp, IssueView
 from utils.lark.issue_tip_failed import IssueTipFailed
@@ -26,6 +19,9 @@ from utils.utils import process_image
 from .base import (
     get_bot_by_application_id,
     get_git_object_by_message_id,
+    remember_card,
+    set_message_object,
+    update_card,
     with_authenticated_github,
 )
 
@@ -63,20 +59,9 @@ def send_issue_success_tip(content, app_id, message_id, *args, bot=None, **kwarg
 def get_assignees_by_issue(issue, team):
     assignees = issue.extra.get("assignees", [])
     if len(assignees):
-        assignees = [
-            openid
-            for openid, in db.session.query(IMUser.openid)
-            .join(TeamMember, TeamMember.im_user_id == IMUser.id)
-            .join(
-                CodeUser,
-                CodeUser.id == TeamMember.code_user_id,
-            )
-            .filter(
-                TeamMember.team_id == team.id,
-                CodeUser.name.in_([i["login"] for i in assignees]),
-            )
-            .all()
-        ]
+        assignees = get_team_identity_map(team.id).get_openids(
+            [i["login"] for i in assignees]
+        )
     return assignees
 
 
@@ -84,20 +69,7 @@ def get_creater_by_item(item, team):
     code_name = item.extra["user"].get("login", None)
     creater = None
     if code_name:
-        creater = (
-            db.session.query(IMUser.openid)
-            .join(TeamMember, TeamMember.im_user_id == IMUser.id)
-            .join(
-                CodeUser,
-                CodeUser.id == TeamMember.code_user_id,
-            )
-            .filter(
-                TeamMember.team_id == team.id,
-                CodeUser.name == code_name,
-                CodeUser.status == 0,
-            )
-            .scalar()
-        )
+        creater = get_team_identity_map(team.id).get_openid(code_name)
     return creater, code_name
 
 
@@ -128,7 +100,7 @@ def gen_issue_card_by_issue(bot, issue, repo_url, team, maunal=False, is_private
     )
 
     # 处理从 github 创建 Issue 时, description 中的 at
-    description = replace_code_name_to_im_name(description)
+    description = replace_code_name_to_im_name(description, team.id)
 
     return IssueCard(
         repo_url=repo_url,
@@ -183,11 +155,11 @@ def replace_images_with_keys(text, bot, is_private=False):
     return replaced_text.replace("![]()", "(请确认图片是否上传成功)")
 
 
-def replace_code_name_to_im_name(text):
+def replace_code_name_to_im_name(text, team_id=None):
     # 处理每行 at, 普通文本
     def replacement_func(match):
         code_name = match.group(1)
-        user_id = get_openid_by_code_name(code_name)
+        user_id = get_openid_by_code_name(code_name, team_id)
         # 消息卡片的md和回复消息md的at格式不同
         return f'<at id="{user_id}"></at>'
 
@@ -204,15 +176,8 @@ def send_issue_url_message(
         return send_issue_failed_tip(
             "找不到 Issue", app_id, message_id, content, data, *args, **kwargs
         )
-    repo = (
-        db.session.query(Repo)
-        .filter(
-            Repo.id == issue.repo_id,
-            Repo.status == 0,
-        )
-        .first()
-    )
-    if not issue:
+    context = resolve_context(repo_id=issue.repo_id)
+    if not context:
         return send_issue_failed_tip(
             "找不到项目", app_id, message_id, content, data, *args, **kwargs
         )
@@ -229,13 +194,7 @@ def send_issue_url_message(
             **kwargs,
         )
 
-    team = (
-        db.session.query(Team)
-        .filter(
-            Team.id == application.team_id,
-        )
-        .first()
-    )
+    team = context.team
     if not team:
         return send_issue_failed_tip(
             "找不到对应的项目",
@@ -248,7 +207,7 @@ def send_issue_url_message(
             **kwargs,
         )
 
-    repo_url = f"https://github.com/{team.name}/{repo.name}"
+    repo_url = context.repo_url
     if "view" == typ:
         message = IssueView(
             repo_url=repo_url,
@@ -284,15 +243,8 @@ def send_issue_manual(app_id, message_id, content, data, *args, **kwargs):
         return send_issue_failed_tip(
             "找不到 Issue", app_id, message_id, content, data, *args, **kwargs
         )
-    repo = (
-        db.session.query(Repo)
-        .filter(
-            Repo.id == issue.repo_id,
-            Repo.status == 0,
-        )
-        .first()
-    )
-    if not repo:
+    context = resolve_context(repo_id=issue.repo_id)
+    if not context:
         return send_issue_failed_tip(
             "找不到项目", app_id, message_id, content, data, *args, **kwargs
         )
@@ -309,13 +261,7 @@ def send_issue_manual(app_id, message_id, content, data, *args, **kwargs):
             **kwargs,
         )
 
-    team = (
-        db.session.query(Team)
-        .filter(
-            Team.id == application.team_id,
-        )
-        .first()
-    )
+    team = context.team
     if not team:
         return send_issue_failed_tip(
             "找不到对应的项目",
@@ -328,7 +274,7 @@ def send_issue_manual(app_id, message_id, content, data, *args, **kwargs):
             **kwargs,
         )
 
-    repo_url = f"https://github.com/{team.name}/{repo.name}"
+    repo_url = context.repo_url
     message = gen_issue_card_by_issue(bot, issue, repo_url, team, True)
     # 回复到话题内部
     return bot.reply(message_id, message).json()
@@ -343,21 +289,14 @@ def send_issue_card(issue_id):
     """
     issue = db.session.query(Issue).filter(Issue.id == issue_id).first()
     if issue:
-        repo = db.session.query(Repo).filter(Repo.id == issue.repo_id).first()
-        if not repo:
+        context = resolve_context(repo_id=issue.repo_id)
+        if not context:
             return False
-        chat_group = (
-            db.session.query(ChatGroup)
-            .filter(
-                ChatGroup.id == repo.chat_group_id,
-            )
-            .first()
-        )
+        repo, team, chat_group = context.repo, context.team, context.chat_group
         if chat_group and repo:
             bot, application = get_bot_by_application_id(chat_group.im_application_id)
-            team = db.session.query(Team).filter(Team.id == application.team_id).first()
             if application and team:
-                repo_url = f"https://github.com/{team.name}/{repo.name}"
+                repo_url = context.repo_url
                 is_private = repo.extra.get("private", False)
                 message = gen_issue_card_by_issue(
                     bot, issue, repo_url, team, is_private=is_private
@@ -370,6 +309,8 @@ def send_issue_card(issue_id):
                     # save message_id
                     issue.message_id = message_id
                     db.session.commit()
+                    remember_card(message_id, message)
+                    set_message_object(message_id, TopicType.ISSUE, issue.id)
 
                     assignees = get_assignees_by_issue(issue, team)
                     creater, _ = get_creater_by_item(issue, team)
@@ -406,32 +347,29 @@ def send_issue_comment(issue_id, comment, user_name: str):
     """
     issue = db.session.query(Issue).filter(Issue.id == issue_id).first()
     if issue:
-        repo = db.session.query(Repo).filter(Repo.id == issue.repo_id).first()
-        if not repo:
+        context = resolve_context(repo_id=issue.repo_id)
+        if not context:
             return False
-        chat_group = (
-            db.session.query(ChatGroup)
-            .filter(
-                ChatGroup.id == repo.chat_group_id,
-            )
-            .first()
-        )
+        repo, chat_group = context.repo, context.chat_group
         if chat_group and issue.message_id:
             bot, _ = get_bot_by_application_id(chat_group.im_application_id)
             is_private = repo.extra.get("private", False)
             # 替换 comment 中的图片 url 为 image_key
             comment = replace_images_with_keys(comment, bot, is_private=is_private)
             # 统一用富文本回答, 支持图片、at
-            content = gen_comment_post_message(user_name, comment)
-            result = bot.reply(
-                issue.message_id,
-                FeishuPostMessage(*content),
-            ).json()
+            content = gen_comment_post_message(
+                user_name, comment, context.team.id if context.team else None
+            )
+            with ratelimit.chat(chat_group.chat_id):
+                result = bot.reply(
+                    issue.message_id,
+                    FeishuPostMessage(*content),
+                ).json()
             return result
     return False
 
 
-def gen_comment_post_message(user_name, comment):
+def gen_comment_post_message(user_name, comment, team_id=None):
     comment = comment.replace("\r\n", "\n")
     comment = re.sub(r"!\[.*?\]\((.*?)\)", r"\n\1\n", comment)
 
@@ -451,7 +389,7 @@ def gen_comment_post_message(user_name, comment):
             element_messages = []
             for element in elements:
                 if element.startswith("@"):
-                    user_id = get_openid_by_code_name(element[1:])
+                    user_id = get_openid_by_code_name(element[1:], team_id)
                     element_messages.append(
                         FeishuPostMessageAt(user_id=user_id)
                         if user_id
@@ -465,7 +403,13 @@ def gen_comment_post_message(user_name, comment):
     return messages
 
 
-def get_openid_by_code_name(code_name):
+def get_openid_by_code_name(code_name, team_id=None):
+    if team_id:
+        openid = get_team_identity_map(team_id).get_openid(code_name)
+        if not openid:
+            logging.info("get_openid_by_code_name---openid: Not found")
+        return openid
+
     code_user_id = (
         db.session.query(CodeUser.id)
         .filter(
@@ -492,7 +436,7 @@ def get_openid_by_code_name(code_name):
     )
 
     if not openid:
-        logging.info(f"get_openid_by_code_name---openid: Not found")
+        logging.info("get_openid_by_code_name---openid: Not found")
         return None
 
     return openid
@@ -508,29 +452,18 @@ def update_issue_card(issue_id: str):
 
     issue = db.session.query(Issue).filter(Issue.id == issue_id).first()
     if issue:
-        repo = db.session.query(Repo).filter(Repo.id == issue.repo_id).first()
-        if not repo:
+        context = resolve_context(repo_id=issue.repo_id)
+        if not context:
             return False
-        chat_group = (
-            db.session.query(ChatGroup)
-            .filter(
-                ChatGroup.id == repo.chat_group_id,
-            )
-            .first()
-        )
+        repo, team, chat_group = context.repo, context.team, context.chat_group
 
         if chat_group and repo:
             bot, application = get_bot_by_application_id(chat_group.im_application_id)
-            team = db.session.query(Team).filter(Team.id == application.team_id).first()
             if application and team:
-                repo_url = f"https://github.com/{team.name}/{repo.name}"
+                repo_url = context.repo_url
                 message = gen_issue_card_by_issue(bot, issue, repo_url, team)
-                result = bot.update(
-                    message_id=issue.message_id,
-                    content=message,
-                )
-
-                return result.json()
+                # 卡片内容没有变化时不再请求飞书
+                return update_card(bot, issue.message_id, message)
 
     return False
 
@@ -546,59 +479,27 @@ def _get_github_app(app_id, message_id, content, data, *args, **kwargs):
         return send_issue_failed_tip(
             "找不到 Issue", app_id, message_id, content, data, *args, **kwargs
         )
-    repo = (
-        db.session.query(Repo)
-        .filter(
-            Repo.id == issue.repo_id,
-            Repo.status == 0,
-        )
-        .first()
-    )
-    if not repo:
+    context = resolve_context(repo_id=issue.repo_id)
+    if not context:
         return send_issue_failed_tip(
             "找不到项目", app_id, message_id, content, data, *args, **kwargs
         )
+    repo = context.repo
 
-    code_application = (
-        db.session.query(CodeApplication)
-        .filter(
-            CodeApplication.id == repo.application_id,
-        )
-        .first()
-    )
+    code_application = context.code_application
     if not code_application:
         return send_issue_failed_tip(
             "找不到对应的应用", app_id, message_id, content, data, *args, **kwargs
         )
 
-    team = (
-        db.session.query(Team)
-        .filter(
-            Team.id == code_application.team_id,
-        )
-        .first()
-    )
+    team = context.team
     if not team:
         return send_issue_failed_tip(
             "找不到对应的项目", app_id, message_id, content, data, *args, **kwargs
         )
 
-    code_user_id = (
-        db.session.query(CodeUser.user_id)
-        .join(
-            TeamMember,
-            TeamMember.code_user_id == CodeUser.id,
-        )
-        .join(
-            IMUser,
-            IMUser.id == TeamMember.im_user_id,
-        )
-        .filter(
-            IMUser.openid == openid,
-            TeamMember.team_id == team.id,
-        )
-        .limit(1)
-        .scalar()
+    code_user_id, _ = get_team_identity_map(team.id).code_user_by_openid.get(
+        openid, (None, None)
     )
 
     github_app = GitHubAppRepo(code_application.installation_id, user_id=code_user_id)
@@ -698,51 +599,13 @@ def get_github_name_by_openid(
     Returns:
         str: GitHub name
     """
-    # 第一步：根据 openid 和 team_id 查询 team_member 表得到 im_user_id
-    im_user_id = (
-        db.session.query(TeamMember.im_user_id)
-        .join(
-            IMUser,  # BindUser 表是 CodeUser 和 IMUser 的别名
-            IMUser.id == TeamMember.im_user_id,
-        )
-        .filter(
-            IMUser.openid == openid,
-            TeamMember.team_id == team_id,
-        )
-        .limit(1)
-        .scalar()
-    )
-
-    if not im_user_id:
+    identity_map = get_team_identity_map(team_id)
+    if openid not in identity_map.code_user_by_openid:
         return send_issue_failed_tip(
             "找不到对应的飞书用户", app_id, message_id, content, data, *args, **kwargs
         )
 
-    # 第二步：使用 im_user_id 和 team_id 再次查询 team_member 表得到 code_user_id
-    code_user_id = (
-        db.session.query(TeamMember.code_user_id)
-        .filter(
-            TeamMember.im_user_id == im_user_id,
-            TeamMember.team_id == team_id,
-        )
-        .limit(1)
-        .scalar()
-    )
-
-    if not code_user_id:
-        return send_issue_failed_tip(
-            "找不到对应的 GitHub 用户",
-            app_id,
-            message_id,
-            content,
-            data,
-            *args,
-            **kwargs,
-        )
-
-    # 第三步：如果找到了 code_user_id，使用它在 bind_user 表中查询 name
-    name = db.session.query(CodeUser.name).filter(CodeUser.id == code_user_id).scalar()
-
+    name = identity_map.get_code_name(openid)
     return name
 
 
@@ -881,7 +744,7 @@ def change_issue_assignees(users, app_id, message_id, content, data, *args, **kw
     github_app, team, repo, issue, _, _ = _get_github_app(
         app_id, message_id, content, data, *args, **kwargs
     )
-    assignees = get_assignees_by_openid(users)
+    assignees = get_assignees_by_openid(users, team.id)
     if len(assignees) == 0:
         return send_issue_failed_tip(
             "更新 issue 失败", app_id, message_id, content, data, *args, **kwargs
@@ -12,6 +12,7 @@ from model.schema import (
     User,
     db,
 )
+from model.team import invalidate_team_identity_map
 from sqlalchemy import func, or_
 from utils.lark.manage_manual import ManageManual
 
@@ -121,6 +122,7 @@ def get_contact_by_lark_application(application_id):
                 IMApplication.id == application.id,
             ).update(dict(status=1))
             db.session.commit()
+            invalidate_team_identity_map(application.team_id)
         except Exception as e:
             # can not get contacts
             app.logger.exception(e)
@@ -139,3 +141,25 @@ def get_contact_for_all_lark_application():
             application.id,
             len(user_ids),
         )
+
+
+@celery.task()
+def prewarm_lark_tokens():
+    """Load or refresh the tenant_access_token of all active applications.
+
+    Run when a worker starts, so the first message after a deploy or scale-up
+    does not wait for the token.
+    """
+    application_ids = [
+        application_id
+        for (application_id,) in db.session.query(IMApplication.id).filter(
+            IMApplication.status.in_([0, 1]),
+        )
+    ]
+    for application_id in application_ids:
+        bot, _ = get_bot_by_application_id(application_id)
+        try:
+            bot.tenant_access_token
+        except Exception as e:
+            app.logger.error("prewarm_lark_tokens %r %r", application_id, e)
+    app.logger.info("prewarm_lark_tokens %r", len(application_ids))
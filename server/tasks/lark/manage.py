@@ -3,6 +3,7 @@ import os
 
 from celery_app import app, celery
 from connectai.lark.sdk import FeishuShareChatMessage, FeishuTextMessage
+from model.context import invalidate_context
 from model.schema import (
     BindUser,
     ChatGroup,
@@ -17,8 +18,10 @@ from model.schema import (
     TeamMember,
     db,
 )
+from model.team import save_repo_chat_group
 from sqlalchemy import or_
 from sqlalchemy.orm import aliased
+from utils.constant import TopicType
 from utils.lark.chat_manual import ChatManual
 from utils.lark.manage_fail import ManageFaild
 from utils.lark.manage_manual import ManageManual, ManageNew, ManageSetting, ManageView
@@ -27,7 +30,7 @@ from utils.lark.manage_success import ManageSuccess
 from utils.lark.repo_info import RepoInfo
 from utils.lark.repo_manual import RepoManual
 
-from .base import get_bot_by_application_id
+from .base import get_bot_by_application_id, remember_card, set_message_object
 
 
 @celery.task()
@@ -335,6 +338,7 @@ def create_chat_group_for_repo(
         .filter(
             TeamMember.team_id == team.id,
             RepoUser.repo_id == repo.id,
+            RepoUser.status == 0,
         )
     ]
     # 把user_id_list中的每个user_id查User表，获取每个人的名字
@@ -431,21 +435,18 @@ def create_chat_group_for_repo(
             content, app_id, message_id, *args, bot=bot, **kwargs
         )
 
-    chat_group_id = ObjID.new_id()
-    chat_group = ChatGroup(
-        id=chat_group_id,
-        im_application_id=application.id,
-        chat_id=chat_id,
-        name=name,
-        description=description,
-        extra=result,
-    )
-    db.session.add(chat_group)
     # 创建群组之后，更新repo.chat_group_id
-    db.session.query(Repo).filter(Repo.id == repo.id).update(
-        dict(chat_group_id=chat_group_id)
+    save_repo_chat_group(
+        repo.id,
+        ChatGroup(
+            id=ObjID.new_id(),
+            im_application_id=application.id,
+            chat_id=chat_id,
+            name=name,
+            description=description,
+            extra=result,
+        ),
     )
-    db.session.commit()
     """
     创建项目群之后，需要发两条消息：
     1. 给操作的用户发成功的消息
@@ -521,6 +522,9 @@ def send_repo_to_chat_group(repo_id, app_id, chat_id=""):
             # save message_id
             repo.message_id = message_id
             db.session.commit()
+            invalidate_context(repo_id=repo.id)
+            remember_card(message_id, message)
+            set_message_object(message_id, TopicType.REPO, repo.id)
             pin_url = f"{bot.host}/open-apis/im/v1/pins"
             pin_result = bot.post(pin_url, json={"message_id": message_id}).json()
             logging.info("debug pin_result %r", pin_result)
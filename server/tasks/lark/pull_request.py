@@ -3,18 +3,9 @@ import logging
 
 from celery_app import app, celery
 from connectai.lark.sdk import FeishuPostMessage, FeishuTextMessage
-from model.schema import (
-    ChatGroup,
-    CodeApplication,
-    CodeUser,
-    IMUser,
-    PullRequest,
-    Repo,
-    Team,
-    TeamMember,
-    db,
-)
-from model.team import get_assignees_by_openid
+from model.context import resolve_context
+from model.schema import PullRequest, db
+from model.team import get_assignees_by_openid, get_team_identity_map
 from tasks.lark.issue import (
     gen_comment_post_message,
     get_creater_by_item,
@@ -22,7 +13,9 @@ from tasks.lark.issue import (
     replace_im_name_to_github_name,
     replace_images_with_keys,
 )
+from utils.constant import TopicType
 from utils.github.repo import GitHubAppRepo
+from utils.lark import ratelimit
 from utils.lark.pr_card import PullCard
 from utils.lark.pr_manual import (
     PrManual,
@@ -36,6 +29,9 @@ from utils.lark.pr_tip_success import PrTipSuccess
 from .base import (
     get_bot_by_application_id,
     get_git_object_by_message_id,
+    remember_card,
+    set_message_object,
+    update_card,
     with_authenticated_github,
 )
 
@@ -77,20 +73,9 @@ def send_pull_request_success_tip(
 def get_assignees_by_pr(pr, team):
     assignees = pr.extra.get("assignees", [])
     if len(assignees):
-        assignees = [
-            openid
-            for openid, in db.session.query(IMUser.openid)
-            .join(TeamMember, TeamMember.im_user_id == IMUser.id)
-            .join(
-                CodeUser,
-                CodeUser.id == TeamMember.code_user_id,
-            )
-            .filter(
-                TeamMember.team_id == team.id,
-                CodeUser.name.in_([assignee["login"] for assignee in assignees]),
-            )
-            .all()
-        ]
+        assignees = get_team_identity_map(team.id).get_openids(
+            [assignee["login"] for assignee in assignees]
+        )
     return assignees
 
 
@@ -100,20 +85,9 @@ def gen_pr_card_by_pr(pr: PullRequest, repo_url, team, maunal=False):
     reviewers = pr.extra.get("requested_reviewers", [])
 
     if len(reviewers):
-        reviewers = [
-            openid
-            for openid, in db.session.query(IMUser.openid)
-            .join(TeamMember, TeamMember.im_user_id == IMUser.id)
-            .join(
-                CodeUser,
-                CodeUser.id == TeamMember.code_user_id,
-            )
-            .filter(
-                TeamMember.team_id == team.id,
-                CodeUser.name.in_([reviewer["login"] for reviewer in reviewers]),
-            )
-            .all()
-        ]
+        reviewers = get_team_identity_map(team.id).get_openids(
+            [reviewer["login"] for reviewer in reviewers]
+        )
 
     labels = [i["name"] for i in pr.extra.get("labels", [])]
 
@@ -161,15 +135,8 @@ def send_pull_request_manual(app_id, message_id, content, data, *args, **kwargs)
         return send_pull_request_failed_tip(
             "找不到 Pull Request", app_id, message_id, content, data, *args, **kwargs
         )
-    repo = (
-        db.session.query(Repo)
-        .filter(
-            Repo.id == pr.repo_id,
-            Repo.status == 0,
-        )
-        .first()
-    )
-    if not repo:
+    context = resolve_context(repo_id=pr.repo_id)
+    if not context:
         return send_pull_request_failed_tip(
             "找不到项目", app_id, message_id, content, data, *args, **kwargs
         )
@@ -186,13 +153,7 @@ def send_pull_request_manual(app_id, message_id, content, data, *args, **kwargs)
             **kwargs,
         )
 
-    team = (
-        db.session.query(Team)
-        .filter(
-            Team.id == application.team_id,
-        )
-        .first()
-    )
+    team = context.team
     if not team:
         return send_pull_request_failed_tip(
             "找不到对应的项目",
@@ -205,7 +166,7 @@ def send_pull_request_manual(app_id, message_id, content, data, *args, **kwargs)
             **kwargs,
         )
 
-    repo_url = f"https://github.com/{team.name}/{repo.name}"
+    repo_url = context.repo_url
     message = gen_pr_card_by_pr(pr, repo_url, team, maunal=True)
 
     # 回复到话题内部
@@ -221,15 +182,8 @@ def send_pull_request_url_message(
         return send_pull_request_failed_tip(
             "找不到 Pull Request", app_id, message_id, content, data, *args, **kwargs
         )
-    repo = (
-        db.session.query(Repo)
-        .filter(
-            Repo.id == pr.repo_id,
-            Repo.status == 0,
-        )
-        .first()
-    )
-    if not repo:
+    context = resolve_context(repo_id=pr.repo_id)
+    if not context:
         return send_pull_request_failed_tip(
             "找不到项目", app_id, message_id, content, data, *args, **kwargs
         )
@@ -246,13 +200,7 @@ def send_pull_request_url_message(
             **kwargs,
         )
 
-    team = (
-        db.session.query(Team)
-        .filter(
-            Team.id == application.team_id,
-        )
-        .first()
-    )
+    team = context.team
     if not team:
         return send_pull_request_failed_tip(
             "找不到对应的项目",
@@ -265,7 +213,7 @@ def send_pull_request_url_message(
             **kwargs,
         )
 
-    repo_url = f"https://github.com/{team.name}/{repo.name}"
+    repo_url = context.repo_url
     if "view" == typ:
         message = PullRequestView(
             repo_url=repo_url,
@@ -326,19 +274,14 @@ def send_pull_request_card(pull_request_id: str):
     """
     pr = db.session.query(PullRequest).filter(PullRequest.id == pull_request_id).first()
     if pr:
-        repo = db.session.query(Repo).filter(Repo.id == pr.repo_id).first()
-        chat_group = (
-            db.session.query(ChatGroup)
-            .filter(
-                ChatGroup.id == repo.chat_group_id,
-            )
-            .first()
-        )
+        context = resolve_context(repo_id=pr.repo_id)
+        if not context:
+            return False
+        repo, team, chat_group = context.repo, context.team, context.chat_group
         if chat_group and repo:
             bot, application = get_bot_by_application_id(chat_group.im_application_id)
-            team = db.session.query(Team).filter(Team.id == application.team_id).first()
             if application and team:
-                repo_url = f"https://github.com/{team.name}/{repo.name}"
+                repo_url = context.repo_url
 
                 message = gen_pr_card_by_pr(pr, repo_url, team)
 
@@ -350,6 +293,8 @@ def send_pull_request_card(pull_request_id: str):
                     # save message_id
                     pr.message_id = message_id
                     db.session.commit()
+                    remember_card(message_id, message)
+                    set_message_object(message_id, TopicType.PULL_REQUEST, pr.id)
 
                     assignees = get_assignees_by_pr(pr, team)
                     creater, _ = get_creater_by_item(pr, team)
@@ -387,26 +332,23 @@ def send_pull_request_comment(pull_request_id, comment, user_name: str):
     """
     pr = db.session.query(PullRequest).filter(PullRequest.id == pull_request_id).first()
     if pr:
-        repo = db.session.query(Repo).filter(Repo.id == pr.repo_id).first()
-        if not repo:
+        context = resolve_context(repo_id=pr.repo_id)
+        if not context:
             return False
-        chat_group = (
-            db.session.query(ChatGroup)
-            .filter(
-                ChatGroup.id == repo.chat_group_id,
-            )
-            .first()
-        )
+        chat_group = context.chat_group
         if chat_group and pr.message_id:
             bot, _ = get_bot_by_application_id(chat_group.im_application_id)
             # 替换 comment 中的图片 url 为 image_key
             comment = replace_images_with_keys(comment, bot)
             # 统一用富文本回答, 支持图片、at
-            content = gen_comment_post_message(user_name, comment)
-            result = bot.reply(
-                pr.message_id,
-                FeishuPostMessage(*content),
-            ).json()
+            content = gen_comment_post_message(
+                user_name, comment, context.team.id if context.team else None
+            )
+            with ratelimit.chat(chat_group.chat_id):
+                result = bot.reply(
+                    pr.message_id,
+                    FeishuPostMessage(*content),
+                ).json()
             return result
     return False
 
@@ -423,26 +365,19 @@ def update_pull_request_card(pr_id: str) -> bool | dict:
 
     pr = db.session.query(PullRequest).filter(PullRequest.id == pr_id).first()
     if pr:
-        repo = db.session.query(Repo).filter(Repo.id == pr.repo_id).first()
-        if not repo:
+        context = resolve_context(repo_id=pr.repo_id)
+        if not context:
             return False
-        chat_group = (
-            db.session.query(ChatGroup)
-            .filter(
-                ChatGroup.id == repo.chat_group_id,
-            )
-            .first()
-        )
+        repo, team, chat_group = context.repo, context.team, context.chat_group
         if chat_group and repo:
             bot, application = get_bot_by_application_id(chat_group.im_application_id)
-            team = db.session.query(Team).filter(Team.id == application.team_id).first()
             if application and team:
-                repo_url = f"https://github.com/{team.name}/{repo.name}"
+                repo_url = context.repo_url
 
                 message = gen_pr_card_by_pr(pr, repo_url, team)
 
-                result = bot.update(pr.message_id, message).json()
-                return result
+                # 卡片内容没有变化时不再请求飞书
+                return update_card(bot, pr.message_id, message)
 
     return False
 
@@ -458,59 +393,27 @@ def _get_github_app(app_id, message_id, content, data, *args, **kwargs):
         return send_pull_request_failed_tip(
             "找不到 Pull Request", app_id, message_id, content, data, *args, **kwargs
         )
-    repo = (
-        db.session.query(Repo)
-        .filter(
-            Repo.id == pr.repo_id,
-            Repo.status == 0,
-        )
-        .first()
-    )
-    if not repo:
+    context = resolve_context(repo_id=pr.repo_id)
+    if not context:
         return send_pull_request_failed_tip(
             "找不到项目", app_id, message_id, content, data, *args, **kwargs
         )
+    repo = context.repo
 
-    code_application = (
-        db.session.query(CodeApplication)
-        .filter(
-            CodeApplication.id == repo.application_id,
-        )
-        .first()
-    )
+    code_application = context.code_application
     if not code_application:
         return send_pull_request_failed_tip(
             "找不到对应的项目", app_id, message_id, content, data, *args, **kwargs
         )
 
-    team = (
-        db.session.query(Team)
-        .filter(
-            Team.id == code_application.team_id,
-        )
-        .first()
-    )
+    team = context.team
     if not team:
         return send_pull_request_failed_tip(
             "找不到对应的项目", app_id, message_id, content, data, *args, **kwargs
         )
 
-    code_user_id = (
-        db.session.query(CodeUser.user_id)
-        .join(
-            TeamMember,
-            TeamMember.code_user_id == CodeUser.id,
-        )
-        .join(
-            IMUser,
-            IMUser.id == TeamMember.im_user_id,
-        )
-        .filter(
-            IMUser.openid == openid,
-            TeamMember.team_id == team.id,
-        )
-        .limit(1)
-        .scalar()
+    code_user_id, _ = get_team_identity_map(team.id).code_user_by_openid.get(
+        openid, (None, None)
     )
 
     github_app = GitHubAppRepo(code_application.installation_id, user_id=code_user_id)
@@ -729,7 +632,7 @@ def change_pull_request_assignees(
     github_app, team, repo, pr, _, _ = _get_github_app(
         app_id, message_id, content, data, *args, **kwargs
     )
-    assignees = get_assignees_by_openid(users)
+    assignees = get_assignees_by_openid(users, team.id)
     if len(assignees) == 0:
         return send_pull_request_failed_tip(
             "更新 Pull Request 失败", app_id, message_id, content, data, *args, **kwargs
@@ -760,7 +663,7 @@ def change_pull_request_reviewer(
         app_id, message_id, content, data, *args, **kwargs
     )
     # 这里调用get_assignees_by_openid，拿到的结果是一样的
-    reviewers = get_assignees_by_openid(users)
+    reviewers = get_assignees_by_openid(users, team.id)
     if len(reviewers) == 0:
         return send_pull_request_failed_tip(
             "更新 Pull Request 失败", app_id, message_id, content, data, *args, **kwargs
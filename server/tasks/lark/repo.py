@@ -1,24 +1,21 @@
 import logging
 
 from celery_app import app, celery
-from model.schema import (
-    CodeApplication,
-    CodeUser,
-    IMApplication,
-    IMUser,
-    Repo,
-    Team,
-    TeamMember,
-    db,
-)
+from model.context import resolve_context
+from model.schema import Team, db
+from model.team import get_team_identity_map
 from utils.github.repo import GitHubAppRepo
 from utils.lark.repo_info import RepoInfo
 from utils.lark.repo_manual import RepoManual, RepoView
 from utils.lark.repo_tip_failed import RepoTipFailed
 from utils.lark.repo_tip_success import RepoTipSuccess
+from utils.redis import incr_metrics, mark_once
 
 from .base import *
 
+# 同一个仓库在窗口期内的多次更新只刷新一次 repo 卡片（秒），0 表示不合并
+app.config.setdefault("REPO_INFO_DEBOUNCE", 10)
+
 
 @celery.task()
 def get_repo_url_by_chat_id(chat_id, *args, **kwargs):
@@ -91,58 +88,22 @@ def _get_github_app(app_id, message_id, content, data):
 
     logging.info(f"chat_id: {chat_id}")
 
-    chat_group = get_chat_group_by_chat_id(chat_id)
-    logging.info(f"chat_group: {chat_group}")
-
-    repo = (
-        db.session.query(Repo)
-        .filter(
-            Repo.id == chat_group.repo_id,
-            Repo.status == 0,
-        )
-        .first()
-    )
+    context = resolve_context(chat_id=chat_id)
+    repo = context.repo if context else None
     logging.info(f"repo: {repo}")
     if not repo:
         return send_repo_failed_tip("找不到对应的项目", app_id, message_id, content, data)
 
-    code_application = (
-        db.session.query(CodeApplication)
-        .filter(
-            CodeApplication.id == repo.application_id,
-        )
-        .first()
-    )
-
+    code_application = context.code_application
     if not code_application:
         return send_repo_failed_tip("找不到对应的应用", app_id, message_id, content, data)
 
-    team = (
-        db.session.query(Team)
-        .filter(
-            Team.id == code_application.team_id,
-        )
-        .first()
-    )
+    team = context.team
     if not team:
         return send_repo_failed_tip("找不到对应的项目", app_id, message_id, content, data)
 
-    code_user_id = (
-        db.session.query(CodeUser.user_id)
-        .join(
-            TeamMember,
-            TeamMember.code_user_id == CodeUser.id,
-        )
-        .join(
-            IMUser,
-            IMUser.id == TeamMember.im_user_id,
-        )
-        .filter(
-            IMUser.openid == openid,
-            TeamMember.team_id == team.id,
-        )
-        .limit(1)
-        .scalar()
+    code_user_id, _ = get_team_identity_map(team.id).code_user_by_openid.get(
+        openid, (None, None)
     )
 
     github_app = GitHubAppRepo(code_application.installation_id, user_id=code_user_id)
@@ -180,8 +141,8 @@ def send_repo_url_message(
     app_id, message_id, content, data, *args, typ="view", **kwargs
 ):
     root_id = data["event"]["message"]["root_id"]
-    repo, _, _ = get_git_object_by_message_id(root_id)
-    if not repo:
+    context = resolve_context(message_id=root_id)
+    if not context:
         return send_repo_failed_tip(
             "找不到Repo", app_id, message_id, content, data, *args, **kwargs
         )
@@ -191,19 +152,12 @@ def send_repo_url_message(
             "找不到对应的应用", app_id, message_id, content, data, *args, bot=bot, **kwargs
         )
 
-    team = (
-        db.session.query(Team)
-        .filter(
-            Team.id == application.team_id,
-        )
-        .first()
-    )
-    if not team:
+    if not context.team:
         return send_repo_failed_tip(
             "找不到对应的项目", app_id, message_id, content, data, *args, bot=bot, **kwargs
         )
 
-    repo_url = f"https://github.com/{team.name}/{repo.name}"
+    repo_url = context.repo_url
     if "view" == typ:
         message = RepoView(repo_url=repo_url)
     elif "insight" == typ:
@@ -432,21 +386,7 @@ def change_repo_collaborator(
     github_app, team, repo = _get_github_app(app_id, message_id, content, data)
 
     # 从openid找到用户
-    username = (
-        db.session.query(CodeUser.name)
-        .join(TeamMember, TeamMember.code_user_id == CodeUser.id)
-        .join(
-            IMUser,
-            IMUser.id == TeamMember.im_user_id,
-        )
-        .filter(
-            TeamMember.team_id == team.id,
-            IMUser.openid == openid,
-            CodeUser.platform == "github",
-        )
-        .limit(1)
-        .scalar()
-    )
+    username = get_team_identity_map(team.id).get_code_name(openid)
     if not username:
         return send_repo_failed_tip(
             f"修改 {repo.name} 仓库 collaborator 失败: 找不到绑定人员",
@@ -487,6 +427,31 @@ def change_repo_collaborator(
     return response
 
 
+def delay_update_repo_info(repo_id: str):
+    """Schedule update_repo_info, coalescing bursts of updates of one repo.
+
+    The first update in a window schedules the task at the end of the window,
+    later updates in the same window are dropped. The task reads the repo from
+    database when it runs, so the card always shows the latest state.
+
+    Args:
+        repo_id (str): The ID of the repo.
+
+    Returns:
+        AsyncResult | None: The scheduled task, None if merged into a pending one.
+    """
+    window = app.config["REPO_INFO_DEBOUNCE"]
+    if not window or window <= 0:
+        return update_repo_info.delay(repo_id)
+
+    if not mark_once(f"lark:repo_info:debounce:{repo_id}", window):
+        incr_metrics("repo_info", "debounced")
+        return None
+
+    incr_metrics("repo_info", "scheduled")
+    return update_repo_info.apply_async(args=[repo_id], countdown=window)
+
+
 @celery.task()
 def update_repo_info(repo_id: str) -> dict | None:
     """Update the repo information.
@@ -499,42 +464,12 @@ def update_repo_info(repo_id: str) -> dict | None:
         dict: The JSON response from the bot's reply method.
     """
 
-    repo = (
-        db.session.query(Repo)
-        .filter(
-            Repo.id == repo_id,
-        )
-        .first()
-    )
-
-    code_application = (
-        db.session.query(CodeApplication)
-        .filter(
-            CodeApplication.id == repo.application_id,
-        )
-        .first()
-    )
-
-    team = (
-        db.session.query(Team)
-        .filter(
-            Team.id == code_application.team_id,
-        )
-        .first()
-    )
-
-    im_application = (
-        db.session.query(IMApplication)
-        .filter(
-            IMApplication.team_id == team.id,
-        )
-        .first()
-    )
-
-    if repo:
-        bot, _ = get_bot_by_application_id(im_application.app_id)
+    context = resolve_context(repo_id=repo_id)
+    if context and context.im_application:
+        repo = context.repo
+        bot, _ = get_bot_by_application_id(context.im_application.app_id)
 
-        repo_url = f"https://github.com/{team.name}/{repo.name}"
+        repo_url = context.repo_url
         message = RepoInfo(
             repo_url=repo_url,
             repo_name=repo.name,
@@ -549,7 +484,8 @@ def update_repo_info(repo_id: str) -> dict | None:
             updated=repo.extra.get("updated_at", ""),
         )
 
-        return bot.update(message_id=repo.message_id, content=message).json()
+        # 卡片内容没有变化时不再请求飞书
+        return update_card(bot, repo.message_id, message)
     else:
         app.logger.error(f"update_repo_info: Repo {repo_id} not found")
         return None
@@ -25,4 +25,22 @@ class GitHubPermissionError(Exception):
     pass
 
 
+class GitHubRequestError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class GitHubRateLimitError(Exception):
+    def __init__(self, message, retry_after=60):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LarkRateLimitError(Exception):
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
 MAX_COMMIT_MESSAGE_LENGTH = 40
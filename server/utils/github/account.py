@@ -1,6 +1,6 @@
-import httpx
 from app import app
 from utils.github.bot import BaseGitHubApp
+from utils.github.client import get_async_client, get_client
 
 
 class GitHubAppAccount(BaseGitHubApp):
@@ -26,6 +26,47 @@ class GitHubAppAccount(BaseGitHubApp):
         return get_email(self.user_token)
 
 
+def _user_info_headers(access_token: str) -> dict:
+    return {
+        "Accept": "application/vnd.github.v3+json",
+        "Authorization": f"token {access_token}",
+    }
+
+
+def _email_headers(access_token: str) -> dict:
+    return {
+        "Accept": "application/vnd.github.v3+json",
+        "Authorization": f"Bearer {access_token}",
+        "X-GitHub-Api-Version": "2022-11-28",
+    }
+
+
+def _parse_user_info(response) -> dict | None:
+    if response.status_code != 200:
+        app.logger.debug(f"Failed to get user info. {response.text}")
+        return None
+
+    user_info = response.json()
+    return user_info
+
+
+def _parse_email(response) -> str | None:
+    if response.status_code != 200:
+        app.logger.debug(f"Failed to get user email. {response.text}")
+        return None
+
+    user_emails = response.json()
+    if len(user_emails) == 0:
+        app.logger.debug("Failed to get user email.")
+        return None
+
+    for user_email in user_emails:
+        if user_email["primary"]:
+            return user_email["email"]
+
+    return user_emails[0]["email"]
+
+
 def get_user_info(access_token: str) -> dict | None:
     """Get user info by access token.
 
@@ -36,26 +77,10 @@ def get_user_info(access_token: str) -> dict | None:
         dict: User info.
     """
 
-    with httpx.Client(
-        timeout=httpx.Timeout(10.0, connect=10.0, read=10.0),
-        transport=httpx.HTTPTransport(retries=3),
-    ) as client:
-        response = client.get(
-            "https://api.github.com/user",
-            headers={
-                "Accept": "application/vnd.github.v3+json",
-                "Authorization": f"token {access_token}",
-            },
-        )
-        if response.status_code != 200:
-            app.logger.debug(f"Failed to get user info. {response.text}")
-            return None
-
-        user_info = response.json()
-        return user_info
-
-    app.logger.debug("Failed to get user info.")
-    return None
+    response = get_client().get(
+        "https://api.github.com/user", headers=_user_info_headers(access_token)
+    )
+    return _parse_user_info(response)
 
 
 def get_email(access_token: str) -> str | None:
@@ -68,32 +93,23 @@ def get_email(access_token: str) -> str | None:
         str: User email.
     """
 
-    with httpx.Client(
-        timeout=httpx.Timeout(10.0, connect=10.0, read=10.0),
-        transport=httpx.HTTPTransport(retries=3),
-    ) as client:
-        response = client.get(
-            "https://api.github.com/user/emails",
-            headers={
-                "Accept": "application/vnd.github.v3+json",
-                "Authorization": f"Bearer {access_token}",
-                "X-GitHub-Api-Version": "2022-11-28",
-            },
-        )
-        if response.status_code != 200:
-            app.logger.debug(f"Failed to get user email. {response.text}")
-            return None
-
-        user_emails = response.json()
-        if len(user_emails) == 0:
-            app.logger.debug("Failed to get user email.")
-            return None
-
-        for user_email in user_emails:
-            if user_email["primary"]:
-                return user_email["email"]
-
-        return user_emails[0]["email"]
-
-    app.logger.debug("Failed to get user email.")
-    return None
+    response = get_client().get(
+        "https://api.github.com/user/emails", headers=_email_headers(access_token)
+    )
+    return _parse_email(response)
+
+
+async def async_get_user_info(access_token: str) -> dict | None:
+    """asyncio version of get_user_info."""
+    response = await get_async_client().get(
+        "https://api.github.com/user", headers=_user_info_headers(access_token)
+    )
+    return _parse_user_info(response)
+
+
+async def async_get_email(access_token: str) -> str | None:
+    """asyncio version of get_email."""
+    response = await get_async_client().get(
+        "https://api.github.com/user/emails", headers=_email_headers(access_token)
+    )
+    return _parse_email(response)
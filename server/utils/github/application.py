@@ -1,12 +1,13 @@
 import hashlib
 import hmac
 import os
+import time
 from functools import wraps
 from urllib.parse import parse_qs
 
-import httpx
 from app import app
 from flask import abort, request
+from utils.github.client import get_client
 
 
 def oauth_by_code(code: str) -> dict | None:
@@ -19,31 +20,65 @@ def oauth_by_code(code: str) -> dict | None:
         str: The user access token.
     """
 
-    with httpx.Client(
-        timeout=httpx.Timeout(10.0, connect=10.0, read=10.0),
-        transport=httpx.HTTPTransport(retries=3),
-    ) as client:
-        response = client.post(
-            "https://github.com/login/oauth/access_token",
-            params={
-                "client_id": os.environ.get("GITHUB_CLIENT_ID"),
-                "client_secret": os.environ.get("GITHUB_CLIENT_SECRET"),
-                "code": code,
-            },
-        )
-        if response.status_code != 200:
-            app.logger.debug(f"Failed to get access token. {response.text}")
-            return None
-
-        try:
-            oauth_info = parse_qs(response.text)
-        except Exception as e:
-            app.logger.debug(e)
-            return None
+    response = get_client().post(
+        "https://github.com/login/oauth/access_token",
+        params={
+            "client_id": os.environ.get("GITHUB_CLIENT_ID"),
+            "client_secret": os.environ.get("GITHUB_CLIENT_SECRET"),
+            "code": code,
+        },
+    )
+    if response.status_code != 200:
+        app.logger.debug(f"Failed to get access token. {response.text}")
+        return None
+
+    try:
+        oauth_info = parse_qs(response.text)
+    except Exception as e:
+        app.logger.debug(e)
+        return None
 
     return oauth_info
 
 
+def refresh_by_refresh_token(refresh_token: str) -> dict | None:
+    """Refresh a user access token
+
+    Args:
+        refresh_token (str): The refresh token returned with the access token.
+
+    Returns:
+        dict: The new oauth info, same as oauth_by_code.
+    https://docs.github.com/en/apps/creating-github-apps/authenticating-with-a-github-app/refreshing-user-access-tokens
+    """
+
+    response = get_client().post(
+        "https://github.com/login/oauth/access_token",
+        params={
+            "client_id": os.environ.get("GITHUB_CLIENT_ID"),
+            "client_secret": os.environ.get("GITHUB_CLIENT_SECRET"),
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+        },
+    )
+    if response.status_code != 200:
+        app.logger.debug(f"Failed to refresh access token. {response.text}")
+        return None
+
+    oauth_info = parse_qs(response.text)
+    if "access_token" not in oauth_info:
+        app.logger.debug(f"Failed to refresh access token. {response.text}")
+        return None
+
+    return oauth_info
+
+
+def get_token_expire_time(oauth_info: dict) -> int | None:
+    """Expire timestamp of the access token, None if the token never expires."""
+    expires_in = oauth_info.get("expires_in", [None])[0]
+    return int(time.time()) + int(expires_in) if expires_in else None
+
+
 def verify_github_signature(
     secret: str = os.environ.get("GITHUB_WEBHOOK_SECRET", "secret")
 ):
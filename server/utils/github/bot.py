@@ -1,12 +1,177 @@
+import asyncio
+import json
 import logging
 import os
+import threading
 import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 
 import httpx
+from app import app, db
 from jwt import JWT, jwk_from_pem
 from model.schema import BindUser
-from utils.constant import GitHubPermissionError
+from sqlalchemy import update
+from utils.constant import (
+    GitHubPermissionError,
+    GitHubRateLimitError,
+    GitHubRequestError,
+)
+from utils.github import ratelimit
+from utils.github.application import get_token_expire_time, refresh_by_refresh_token
+from utils.github.client import get_async_client, get_client
+from utils.redis import binary_client, client, incr_metrics, singleflight
+
+# 提前刷新 installation token 的秒数，避免拿到即将过期的 token
+app.config.setdefault("GITHUB_TOKEN_REFRESH_AHEAD", 300)
+# 不会过期的用户 token 的缓存时间
+app.config.setdefault("GITHUB_USER_TOKEN_CACHE_EXPIRE", 60 * 60)
+# 用户 token 刷新失败后，这段时间内不再用 refresh token 重试
+app.config.setdefault("GITHUB_USER_TOKEN_REFRESH_FAILURE_EXPIRE", 60)
+# 列表接口每页条数（GitHub 最大 100），以及知道总页数后并发拉取的线程数
+app.config.setdefault("GITHUB_PER_PAGE", 100)
+app.config.setdefault("GITHUB_PAGINATE_CONCURRENCY", 4)
+# 条件请求缓存的响应保留时间，304 不计入 GitHub 的限流额度
+app.config.setdefault("GITHUB_ETAG_CACHE_EXPIRE", 60 * 60 * 24)
+
+# 进程内缓存: app_id -> (jwt, created_at), installation_id -> (token, expires_at)
+_jwt_cache: dict[str, tuple[str, float]] = {}
+_installation_tokens: dict[str, tuple[str, float]] = {}
+_installation_tokens_lock = threading.Lock()
+# user_id -> (token, expires_at)
+_user_tokens: dict[str, tuple[str, float]] = {}
+_user_tokens_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _get_signing_key():
+    """Load the GitHub App private key once per process."""
+    if os.environ.get("GITHUB_APP_PRIVATE_KEY"):
+        return jwk_from_pem(os.environ.get("GITHUB_APP_PRIVATE_KEY").encode())
+
+    with open(
+        os.environ.get("GITHUB_APP_PRIVATE_KEY_PATH", "pem.pem"), "rb"
+    ) as pem_file:
+        return jwk_from_pem(pem_file.read())
+
+
+def _user_token_key(user_id: str) -> str:
+    return f"github:user_token:{user_id}"
+
+
+def invalidate_user_token(user_id: str) -> None:
+    """Drop the cached user token from this process and Redis.
+
+    Args:
+        user_id (str): User.id of the GitHub user.
+    """
+    with _user_tokens_lock:
+        _user_tokens.pop(str(user_id), None)
+    try:
+        key = _user_token_key(user_id)
+        client.delete(key, f"{key}:failed")
+    except Exception as e:
+        logging.error(e)
+
+
+def _installation_token_key(installation_id: str) -> str:
+    return f"github:installation_token:{installation_id}"
+
+
+def invalidate_installation_token(installation_id: str) -> None:
+    """Drop the cached installation token from this process and Redis.
+
+    Args:
+        installation_id (str): The GitHub App installation id.
+    """
+    with _installation_tokens_lock:
+        _installation_tokens.pop(str(installation_id), None)
+    try:
+        client.delete(_installation_token_key(installation_id))
+    except Exception as e:
+        logging.error(e)
+
+
+def _per_page_url(url: str) -> str:
+    return str(
+        httpx.URL(url).copy_merge_params({"per_page": app.config["GITHUB_PER_PAGE"]})
+    )
+
+
+def _page_items(page_url: str, response: httpx.Response, items=None) -> tuple:
+    """Returns (response, items of the page).
+
+    Raises:
+        GitHubRequestError: The page failed, a partial listing must not be
+            taken as complete.
+    """
+    if response.status_code != 200:
+        logging.error("paginate %s: %r", page_url, response.text)
+        raise GitHubRequestError(
+            f"paginate {page_url}: {response.status_code}",
+            status_code=response.status_code,
+        )
+    data = response.json()
+    return response, items(data) if items else data
+
+
+def _rest_page_urls(url: str, response: httpx.Response) -> list:
+    """Urls of page 2..last if the first page tells the last page number."""
+    last = response.links.get("last", {}).get("url")
+    last_page = int(httpx.URL(last).params.get("page", 0)) if last else 0
+    return [
+        str(httpx.URL(url).copy_merge_params({"page": page}))
+        for page in range(2, last_page + 1)
+    ]
+
+
+def _etag_cache_key(owner: str, url: str) -> str:
+    return f"github:etag:{owner}:{url}"
+
+
+def _load_etag_cache(key: str) -> dict | None:
+    try:
+        value = binary_client.get(key)
+        return json.loads(zlib.decompress(value)) if value else None
+    except Exception as e:
+        logging.error("load etag cache %r %r", key, e)
+        return None
+
+
+def _conditional_headers(cached: dict | None) -> dict:
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    return headers
+
+
+def _etag_cache_response(
+    key: str, endpoint: str, cached: dict | None, response: httpx.Response
+) -> dict | list | None:
+    """Serve a 304 from the cache, or save the new body with its validators."""
+    if response.status_code == 304 and cached:
+        incr_metrics("github_etag", f"{endpoint}:hit")
+        return cached["body"]
+
+    incr_metrics("github_etag", f"{endpoint}:miss")
+    body = response.json()
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if response.status_code == 200 and (etag or last_modified):
+        value = dict(etag=etag, last_modified=last_modified, body=body)
+        try:
+            binary_client.set(
+                key,
+                zlib.compress(json.dumps(value, separators=(",", ":")).encode()),
+                ex=app.config["GITHUB_ETAG_CACHE_EXPIRE"],
+            )
+        except Exception as e:
+            logging.error("save etag cache %r %r", key, e)
+    return body
 
 
 class BaseGitHubApp:
@@ -16,15 +181,6 @@ class BaseGitHubApp:
         self.installation_id = installation_id
         self.user_id = user_id
 
-        self._jwt_created_at: float = None
-        self._jwt: str = None
-
-        self._installation_token_created_at: float = None
-        self._installation_token: str = None
-
-        self._user_token_created_at: float = None
-        self._user_token: str = None
-
     def base_github_rest_api(
         self,
         url: str,
@@ -32,6 +188,9 @@ class BaseGitHubApp:
         auth_type: str = "jwt",
         json: dict = None,
         raw: bool = False,
+        headers: dict = None,
+        _retry: bool = True,
+        _attempt: int = 0,
     ) -> dict | list | httpx.Response | None:
         """Base GitHub REST API.
 
@@ -39,11 +198,31 @@ class BaseGitHubApp:
             url (str): The url of the GitHub REST API.
             method (str, optional): The method of the GitHub REST API. Defaults to "GET".
             auth_type (str, optional): The type of the authentication. Defaults to "jwt", can be "jwt" or "install_token" or "user_token".
+            headers (dict, optional): Extra request headers, e.g. If-None-Match.
 
         Returns:
             dict | list | None: The response of the GitHub REST API.
+
+        Raises:
+            GitHubRateLimitError: Still rate limited after retries, or the wait
+                is too long.
         """
 
+        key = ratelimit.get_key(auth_type, url, self.installation_id, self.user_id)
+        ratelimit.throttle(key)
+        response = get_client().request(
+            method, url, headers=self._request_headers(auth_type, headers), json=json
+        )
+        retry = self._check_response(key, url, auth_type, response, _retry, _attempt)
+        if retry is not None:
+            return self.base_github_rest_api(
+                url, method, auth_type, json=json, raw=raw, headers=headers, **retry
+            )
+        if raw:
+            return response
+        return response.json()
+
+    def _request_headers(self, auth_type: str, headers: dict = None) -> dict:
         auth = ""
 
         match auth_type:
@@ -58,26 +237,184 @@ class BaseGitHubApp:
                     "auth_type must be 'jwt' or 'install_token' or 'user_token'"
                 )
 
-        with httpx.Client(
-            timeout=httpx.Timeout(10.0, connect=10.0, read=10.0),
-            transport=httpx.HTTPTransport(retries=3),
-        ) as client:
-            response = client.request(
-                method,
-                url,
-                headers={
-                    "Accept": "application/vnd.github+json",
-                    "Authorization": f"Bearer {auth}",
-                    "X-GitHub-Api-Version": "2022-11-28",
-                },
-                json=json,
+        return {
+            "Accept": "application/vnd.github+json",
+            "Authorization": f"Bearer {auth}",
+            "X-GitHub-Api-Version": "2022-11-28",
+            **(headers or {}),
+        }
+
+    def _check_response(
+        self,
+        key: str,
+        url: str,
+        auth_type: str,
+        response: httpx.Response,
+        _retry: bool,
+        _attempt: int,
+    ) -> dict | None:
+        """Check the rate limit and the authentication of the response.
+
+        Returns:
+            dict | None: The private args to retry the request with, None if
+            the response can be returned.
+        """
+        ratelimit.update(key, response)
+
+        retry_after = ratelimit.get_retry_after(response, _attempt)
+        if retry_after is not None:
+            ratelimit.block(key, retry_after)
+            logging.warning(
+                "base_github_rest_api: %s rate limited %.1fs", url, retry_after
             )
-            if response.status_code == 401:
-                logging.error("base_github_rest_api: GitHub Permission Error")
-                raise GitHubPermissionError(response.json().get("message"))
-            if raw:
-                return response
-            return response.json()
+            if _attempt >= app.config["GITHUB_RATELIMIT_RETRIES"]:
+                raise GitHubRateLimitError(
+                    response.json().get("message"), retry_after=retry_after
+                )
+            # 下一次请求前 throttle 会等待到解除限流，等待太久则抛出 GitHubRateLimitError
+            return dict(_retry=_retry, _attempt=_attempt + 1)
+        if response.status_code == 401:
+            if auth_type == "install_token" and _retry:
+                # token 可能被吊销或提前失效，清掉缓存重新获取一次
+                invalidate_installation_token(self.installation_id)
+                return dict(_retry=False, _attempt=_attempt)
+            if auth_type == "user_token" and _retry:
+                # 用户 token 可能已经过期或者重新授权过，重新从数据库加载一次
+                invalidate_user_token(self.user_id)
+                return dict(_retry=False, _attempt=_attempt)
+            logging.error("base_github_rest_api: GitHub Permission Error")
+            raise GitHubPermissionError(response.json().get("message"))
+        return None
+
+    def get_if_modified(
+        self, url: str, etag: str = None, auth_type: str = "install_token"
+    ) -> tuple[bool, dict | list | None, str | None]:
+        """Conditional GET with If-None-Match.
+
+        A 304 response does not count against the rate limit of GitHub.
+
+        Args:
+            url (str): The url of the GitHub REST API.
+            etag (str, optional): ETag of the last response.
+            auth_type (str, optional): The type of the authentication.
+
+        Returns:
+            tuple: (modified, data, etag), data is None if not modified.
+        """
+        response = self.base_github_rest_api(
+            url,
+            auth_type=auth_type,
+            raw=True,
+            headers={"If-None-Match": etag} if etag else None,
+        )
+        if response.status_code == 304:
+            return False, None, etag
+        return True, response.json(), response.headers.get("ETag")
+
+    def cached_get(
+        self, url: str, endpoint: str, auth_type: str = "install_token"
+    ) -> dict | list | None:
+        """GET with a conditional request, a 304 is served from the Redis cache.
+
+        The ETag/Last-Modified and the compressed body are kept per credential
+        owner and url. Hits and misses are counted in the `github_etag` metrics
+        as `<endpoint>:hit` and `<endpoint>:miss`. Identical requests in flight
+        at the same time, in this or other workers, share one upstream call.
+
+        Args:
+            url (str): The url of the GitHub REST API.
+            endpoint (str): The name of the endpoint in the metrics.
+            auth_type (str, optional): The type of the authentication.
+
+        Returns:
+            dict | list | None: The response of the GitHub REST API.
+        """
+        key = _etag_cache_key(
+            ratelimit.get_owner(auth_type, self.installation_id, self.user_id), url
+        )
+        return singleflight(
+            key, self._cached_get, key, url, endpoint, auth_type, distributed=True
+        )
+
+    def _cached_get(
+        self, key: str, url: str, endpoint: str, auth_type: str
+    ) -> dict | list | None:
+        cached = _load_etag_cache(key)
+        response = self.base_github_rest_api(
+            url, auth_type=auth_type, raw=True, headers=_conditional_headers(cached)
+        )
+        return _etag_cache_response(key, endpoint, cached, response)
+
+    def base_github_graphql_api(
+        self, query: str, variables: dict = None, auth_type: str = "install_token"
+    ) -> dict:
+        """Base GitHub GraphQL API.
+
+        Args:
+            query (str): The GraphQL query.
+            variables (dict, optional): The variables of the query.
+            auth_type (str, optional): The type of the authentication.
+
+        Returns:
+            dict: The response with `data` and `errors`, `data` may be partial
+            when `errors` is not empty.
+        """
+        return self.base_github_rest_api(
+            "https://api.github.com/graphql",
+            "POST",
+            auth_type,
+            json={"query": query, "variables": variables or {}},
+        )
+
+    def paginate(self, url: str, auth_type: str = "install_token", items=None):
+        """Iterate all items of a GitHub list API.
+
+        Pages are requested with per_page=100 and followed by the `Link` header.
+        When the first page tells the last page number, the remaining pages are
+        fetched concurrently and yielded in order.
+
+        Args:
+            url (str): The url of the list API.
+            auth_type (str, optional): The type of the authentication.
+            items (callable, optional): Get the items from the response, e.g.
+                `lambda data: data["repositories"]`.
+
+        Yields:
+            dict: The items of every page.
+
+        Raises:
+            GitHubRequestError: Any page failed.
+
+        https://docs.github.com/en/rest/using-the-rest-api/using-pagination-in-the-rest-api
+        """
+        url = _per_page_url(url)
+
+        # 线程池里的线程不会继承 contextvars 和 app context，需要带上当前请求的优先级
+        current_priority = ratelimit.get_priority()
+
+        def get_page(page_url):
+            with app.app_context(), ratelimit.priority(current_priority):
+                response = self.base_github_rest_api(
+                    page_url, auth_type=auth_type, raw=True
+                )
+            return _page_items(page_url, response, items)
+
+        response, data = get_page(url)
+        yield from data
+
+        page_urls = _rest_page_urls(url, response)
+        if page_urls:
+            with ThreadPoolExecutor(
+                max_workers=app.config["GITHUB_PAGINATE_CONCURRENCY"]
+            ) as executor:
+                for _, data in executor.map(get_page, page_urls):
+                    yield from data
+            return
+
+        # 没有 last 时按 next 逐页拉取
+        while response.links.get("next"):
+            response, data = get_page(response.links["next"]["url"])
+            yield from data
 
     @property
     def jwt(self) -> str:
@@ -86,23 +423,10 @@ class BaseGitHubApp:
         Returns:
             str: A JWT for the GitHub App.
         """
-        # 判断是否初始化了 jwt，或者 jwt 是否过期
-        if (
-            self._jwt is None
-            or self._jwt_created_at is None
-            or datetime.now().timestamp() - self._jwt_created_at > 60 * 10
-        ):
-            self._jwt_created_at = datetime.now().timestamp()
-
-            if os.environ.get("GITHUB_APP_PRIVATE_KEY"):
-                signing_key = jwk_from_pem(
-                    os.environ.get("GITHUB_APP_PRIVATE_KEY").encode()
-                )
-            else:
-                with open(
-                    os.environ.get("GITHUB_APP_PRIVATE_KEY_PATH", "pem.pem"), "rb"
-                ) as pem_file:
-                    signing_key = jwk_from_pem(pem_file.read())
+        # 同一个进程内的所有实例共享 jwt，过期前 1 分钟重新签发
+        jwt, created_at = _jwt_cache.get(self.app_id, (None, 0))
+        if jwt is None or datetime.now().timestamp() - created_at > 60 * 9:
+            created_at = datetime.now().timestamp()
 
             payload = {
                 # Issued at time
@@ -115,43 +439,167 @@ class BaseGitHubApp:
 
             # Create JWT
             jwt_instance = JWT()
-            self._jwt = jwt_instance.encode(payload, signing_key, alg="RS256")
+            jwt = jwt_instance.encode(payload, _get_signing_key(), alg="RS256")
+            _jwt_cache[self.app_id] = (jwt, created_at)
 
-        return self._jwt
+        return jwt
 
     @property
     def installation_token(self) -> str:
         """Get an installation token for the GitHub App.
 
+        The token is shared by all workers: it is looked up in process memory
+        first, then in Redis, and only minted from GitHub when both are missing
+        or about to expire. Minting is guarded by a Redis lock so that only one
+        worker calls GitHub at a time, threads of the same worker share the
+        call of the first one.
+
         Returns:
             str: An installation token for the GitHub App.
         """
-        if (
-            self._installation_token is None
-            or self._installation_token_created_at is None
-            or datetime.now().timestamp() - self._installation_token_created_at
-            > 60 * 60
-        ):
-            res = self.base_github_rest_api(
-                f"https://api.github.com/app/installations/{self.installation_id}/access_tokens",
+        installation_id = str(self.installation_id)
+        refresh_ahead = app.config["GITHUB_TOKEN_REFRESH_AHEAD"]
+
+        token, expires_at = _installation_tokens.get(installation_id, (None, 0))
+        if token and expires_at - time.time() > refresh_ahead:
+            return token
+
+        key = _installation_token_key(installation_id)
+        token, expires_at = self._load_installation_token(key) or (token, expires_at)
+        if token and expires_at - time.time() > refresh_ahead:
+            return token
+
+        return singleflight(
+            key, self._refresh_installation_token, key, token, expires_at
+        )
+
+    def _refresh_installation_token(
+        self, key: str, token: str | None, expires_at: float
+    ) -> str | None:
+        installation_id = str(self.installation_id)
+        refresh_ahead = app.config["GITHUB_TOKEN_REFRESH_AHEAD"]
+
+        lock = client.lock(f"{key}:lock", timeout=30)
+        # 旧 token 还没过期时不等待锁，直接使用旧 token，由持有锁的 worker 刷新
+        acquired = lock.acquire(
+            blocking=not (token and expires_at > time.time()), blocking_timeout=10
+        )
+        if not acquired and token and expires_at > time.time():
+            return token
+
+        try:
+            # 拿到锁之后再检查一次，可能别的 worker 已经刷新过了
+            cached = self._load_installation_token(key)
+            if cached and cached[1] - time.time() > refresh_ahead:
+                return cached[0]
+
+            # 异步子类也使用同步请求获取 token，token 大部分时间都命中缓存
+            res = BaseGitHubApp.base_github_rest_api(
+                self,
+                f"https://api.github.com/app/installations/{installation_id}/access_tokens",
                 method="POST",
             )
+            token = res.get("token", None)
+            if token is None:
+                logging.error("installation_token: %r", res)
+                return None
 
-            self._installation_token_created_at = datetime.now().timestamp()
-            self._installation_token = res.get("token", None)
+            expires_at = (
+                datetime.fromisoformat(
+                    res["expires_at"].replace("Z", "+00:00")
+                ).timestamp()
+                if res.get("expires_at")
+                else time.time() + 60 * 60
+            )
+            with _installation_tokens_lock:
+                _installation_tokens[installation_id] = (token, expires_at)
+            client.set(
+                key,
+                json.dumps([token, expires_at]),
+                ex=max(int(expires_at - time.time()), 1),
+            )
+            return token
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except Exception as e:
+                    logging.debug("release installation token lock %r", e)
 
-        return self._installation_token
+    def _load_installation_token(self, key: str) -> tuple[str, float] | None:
+        """Load the installation token from Redis into the process cache."""
+        try:
+            value = client.get(key)
+            if not value:
+                return None
+            token, expires_at = json.loads(value)
+        except Exception as e:
+            logging.error(e)
+            return None
+
+        with _installation_tokens_lock:
+            _installation_tokens[str(self.installation_id)] = (token, expires_at)
+        return token, expires_at
 
     @property
     def user_token(self) -> str:
         """Get a user token for the GitHub App.
 
+        Like the installation token, the token is looked up in process memory
+        first, then in Redis, and only loaded from BindUser when both are
+        missing or about to expire. An expiring token is refreshed ahead with
+        the refresh token, under a Redis lock shared by all workers.
+
         Returns:
             str: A user token for the GitHub App.
         """
+        user_id = str(self.user_id)
+        refresh_ahead = app.config["GITHUB_TOKEN_REFRESH_AHEAD"]
+
+        token, expires_at = _user_tokens.get(user_id, (None, 0))
+        if token and expires_at - time.time() > refresh_ahead:
+            return token
+
+        key = _user_token_key(user_id)
+        token, expires_at = self._load_user_token(key) or (token, expires_at)
+        if token and expires_at - time.time() > refresh_ahead:
+            return token
+
+        return singleflight(key, self._refresh_user_token, key)
+
+    def _load_user_token(self, key: str) -> tuple[str, float] | None:
+        """Load the user token from Redis into the process cache."""
+        try:
+            value = client.get(key)
+            if not value:
+                return None
+            token, expires_at = json.loads(value)
+        except Exception as e:
+            logging.error(e)
+            return None
+
+        with _user_tokens_lock:
+            _user_tokens[str(self.user_id)] = (token, expires_at)
+        return token, expires_at
+
+    def _refresh_user_token(self, key: str) -> str:
+        refresh_ahead = app.config["GITHUB_TOKEN_REFRESH_AHEAD"]
+        lock = client.lock(f"{key}:lock", timeout=30)
+        if not lock.acquire(blocking=True, blocking_timeout=10):
+            # 别的 worker 一直持有锁，不在锁外刷新，只使用还没过期的 token
+            cached = self._load_user_token(key)
+            if cached and cached[1] > time.time():
+                return cached[0]
+            raise GitHubRequestError(
+                f"Timed out waiting for the user token refresh: {self.user_id}"
+            )
+
+        try:
+            # 拿到锁之后再检查一次，可能别的 worker 已经刷新过了
+            cached = self._load_user_token(key)
+            if cached and cached[1] - time.time() > refresh_ahead:
+                return cached[0]
 
-        # TODO: 当前使用的是无期限的 token，可能需要考虑刷新 token 的问题
-        if (self._user_token is None or self._user_token_created_at is None,):
             bind_user = BindUser.query.filter_by(
                 user_id=self.user_id, platform="github"
             ).first()
@@ -162,10 +610,86 @@ class BaseGitHubApp:
                 # 这种情况下可能是用户没有绑定 GitHub
                 raise Exception("Failed to get access token.")
 
-            self._user_token_created_at = datetime.now().timestamp()
-            self._user_token = bind_user.access_token
+            token = bind_user.access_token
+            expire_time = bind_user.expire_time
+            if (
+                expire_time
+                and expire_time - time.time() <= refresh_ahead
+                and bind_user.refresh_token
+            ):
+                token, expire_time = self._refresh_by_refresh_token(key, bind_user)
+            if expire_time and expire_time <= time.time():
+                raise GitHubPermissionError(
+                    "GitHub authorization has expired, please re-authorize."
+                )
+
+            # 没有过期时间的 token 也只缓存一段时间，重新绑定之后能读到新 token
+            expires_at = (
+                expire_time
+                if expire_time
+                else time.time() + app.config["GITHUB_USER_TOKEN_CACHE_EXPIRE"]
+            )
+            with _user_tokens_lock:
+                _user_tokens[str(self.user_id)] = (token, expires_at)
+            client.set(
+                key,
+                json.dumps([token, expires_at]),
+                ex=max(int(expires_at - time.time()), 1),
+            )
+            return token
+        finally:
+            try:
+                lock.release()
+            except Exception as e:
+                logging.debug("release user token lock %r", e)
+
+    def _refresh_by_refresh_token(
+        self, key: str, bind_user: BindUser
+    ) -> tuple[str, int]:
+        """Refresh the user token, the caller must hold the user token lock.
+
+        A failed refresh is remembered for GITHUB_USER_TOKEN_REFRESH_FAILURE_EXPIRE
+        seconds, until then the old token is used while it is not expired.
 
-        return self._user_token
+        Raises:
+            GitHubPermissionError: The refresh failed and the old token is
+                expired, the user has to authorize again.
+        """
+        failed_key = f"{key}:failed"
+        oauth_info = None
+        if not client.exists(failed_key):
+            oauth_info = refresh_by_refresh_token(bind_user.refresh_token)
+            if oauth_info is None:
+                logging.error("Failed to refresh user token: %s", self.user_id)
+                client.set(
+                    failed_key,
+                    1,
+                    ex=app.config["GITHUB_USER_TOKEN_REFRESH_FAILURE_EXPIRE"],
+                )
+        if oauth_info is None:
+            if bind_user.expire_time > time.time():
+                return bind_user.access_token, bind_user.expire_time
+            # refresh token 也失效了，只能让用户重新授权
+            raise GitHubPermissionError(
+                "GitHub authorization has expired, please re-authorize."
+            )
+
+        token = oauth_info["access_token"][0]
+        expire_time = get_token_expire_time(oauth_info)
+        # 单独的连接提交，不影响调用方 session 里还没提交的修改
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(BindUser)
+                .where(BindUser.id == bind_user.id)
+                .values(
+                    access_token=token,
+                    refresh_token=oauth_info.get(
+                        "refresh_token", [bind_user.refresh_token]
+                    )[0],
+                    expire_time=expire_time,
+                )
+            )
+        return token, expire_time
 
     def get_installation_info(self) -> dict | None:
         """Get installation info
@@ -175,6 +699,97 @@ class BaseGitHubApp:
         https://docs.github.com/zh/rest/apps/apps?apiVersion=2022-11-28#get-an-installation-for-the-authenticated-app
         """
 
-        return self.base_github_rest_api(
-            f"https://api.github.com/app/installations/{self.installation_id}"
+        return self.cached_get(
+            f"https://api.github.com/app/installations/{self.installation_id}",
+            "installation",
+            auth_type="jwt",
+        )
+
+
+class AsyncBaseGitHubApp(BaseGitHubApp):
+    """asyncio twin of BaseGitHubApp, requests are sent by httpx.AsyncClient.
+
+    Mix it in front of a sync app, e.g.
+    `class AsyncGitHubAppRepo(AsyncBaseGitHubApp, GitHubAppRepo)`: every method
+    which returns `self.base_github_rest_api(...)` returns a coroutine and the
+    list helpers return async generators, so the method surface stays the same.
+    Use `utils.github.client.run_async` to call them from sync code.
+    """
+
+    async def base_github_rest_api(
+        self,
+        url: str,
+        method: str = "GET",
+        auth_type: str = "jwt",
+        json: dict = None,
+        raw: bool = False,
+        headers: dict = None,
+        _retry: bool = True,
+        _attempt: int = 0,
+    ) -> dict | list | httpx.Response | None:
+        key = ratelimit.get_key(auth_type, url, self.installation_id, self.user_id)
+        await ratelimit.async_throttle(key)
+        response = await get_async_client().request(
+            method, url, headers=self._request_headers(auth_type, headers), json=json
+        )
+        retry = self._check_response(key, url, auth_type, response, _retry, _attempt)
+        if retry is not None:
+            return await self.base_github_rest_api(
+                url, method, auth_type, json=json, raw=raw, headers=headers, **retry
+            )
+        if raw:
+            return response
+        return response.json()
+
+    async def get_if_modified(
+        self, url: str, etag: str = None, auth_type: str = "install_token"
+    ) -> tuple[bool, dict | list | None, str | None]:
+        response = await self.base_github_rest_api(
+            url,
+            auth_type=auth_type,
+            raw=True,
+            headers={"If-None-Match": etag} if etag else None,
         )
+        if response.status_code == 304:
+            return False, None, etag
+        return True, response.json(), response.headers.get("ETag")
+
+    async def cached_get(
+        self, url: str, endpoint: str, auth_type: str = "install_token"
+    ) -> dict | list | None:
+        key = _etag_cache_key(
+            ratelimit.get_owner(auth_type, self.installation_id, self.user_id), url
+        )
+        cached = _load_etag_cache(key)
+        response = await self.base_github_rest_api(
+            url, auth_type=auth_type, raw=True, headers=_conditional_headers(cached)
+        )
+        return _etag_cache_response(key, endpoint, cached, response)
+
+    async def paginate(self, url: str, auth_type: str = "install_token", items=None):
+        url = _per_page_url(url)
+        semaphore = asyncio.Semaphore(app.config["GITHUB_PAGINATE_CONCURRENCY"])
+
+        async def get_page(page_url):
+            async with semaphore:
+                response = await self.base_github_rest_api(
+                    page_url, auth_type=auth_type, raw=True
+                )
+            return _page_items(page_url, response, items)
+
+        response, data = await get_page(url)
+        for item in data:
+            yield item
+
+        page_urls = _rest_page_urls(url, response)
+        if page_urls:
+            for _, data in await asyncio.gather(*map(get_page, page_urls)):
+                for item in data:
+                    yield item
+            return
+
+        # 没有 last 时按 next 逐页拉取
+        while response.links.get("next"):
+            response, data = await get_page(response.links["next"]["url"])
+            for item in data:
+                yield item
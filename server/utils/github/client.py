@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+
+import httpx
+from app import app
+
+app.config.setdefault("GITHUB_HTTP2", False)
+app.config.setdefault("GITHUB_HTTP_TIMEOUT", 10.0)
+app.config.setdefault("GITHUB_HTTP_RETRIES", 3)
+app.config.setdefault("GITHUB_HTTP_MAX_CONNECTIONS", 100)
+app.config.setdefault("GITHUB_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)
+app.config.setdefault("GITHUB_HTTP_KEEPALIVE_EXPIRY", 30.0)
+
+_client: httpx.Client = None
+_client_pid: int = None
+_client_lock = threading.Lock()
+# 每个 event loop 一个 AsyncClient，连接不能跨 loop 使用
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _http2_enabled() -> bool:
+    if not app.config["GITHUB_HTTP2"]:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logging.warning("GITHUB_HTTP2 is enabled but h2 is not installed.")
+        return False
+    return True
+
+
+def _on_request(request: httpx.Request) -> None:
+    request.extensions["start_time"] = time.perf_counter()
+
+
+def _on_response(response: httpx.Response) -> None:
+    start_time = response.request.extensions.get("start_time")
+    if start_time is None:
+        return
+    app.logger.debug(
+        "github http %s %s %s %s %.1fms",
+        response.request.method,
+        response.request.url,
+        response.status_code,
+        response.http_version,
+        (time.perf_counter() - start_time) * 1000,
+    )
+
+
+async def _on_async_request(request: httpx.Request) -> None:
+    _on_request(request)
+
+
+async def _on_async_response(response: httpx.Response) -> None:
+    _on_response(response)
+
+
+def _client_options() -> dict:
+    timeout = app.config["GITHUB_HTTP_TIMEOUT"]
+    return dict(
+        timeout=httpx.Timeout(timeout, connect=timeout, read=timeout),
+        retries=app.config["GITHUB_HTTP_RETRIES"],
+        http2=_http2_enabled(),
+        limits=httpx.Limits(
+            max_connections=app.config["GITHUB_HTTP_MAX_CONNECTIONS"],
+            max_keepalive_connections=app.config[
+                "GITHUB_HTTP_MAX_KEEPALIVE_CONNECTIONS"
+            ],
+            keepalive_expiry=app.config["GITHUB_HTTP_KEEPALIVE_EXPIRY"],
+        ),
+    )
+
+
+def _create_client() -> httpx.Client:
+    options = _client_options()
+    return httpx.Client(
+        timeout=options.pop("timeout"),
+        transport=httpx.HTTPTransport(**options),
+        event_hooks={"request": [_on_request], "response": [_on_response]},
+    )
+
+
+def _create_async_client() -> httpx.AsyncClient:
+    options = _client_options()
+    return httpx.AsyncClient(
+        timeout=options.pop("timeout"),
+        transport=httpx.AsyncHTTPTransport(**options),
+        event_hooks={"request": [_on_async_request], "response": [_on_async_response]},
+    )
+
+
+def get_client() -> httpx.Client:
+    """Get the shared keep-alive http client of the current process.
+
+    The client is created lazily and re-created after fork, so that celery
+    prefork workers never share sockets with the parent process.
+
+    Returns:
+        httpx.Client: The shared http client.
+    """
+    global _client, _client_pid
+
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = _create_client()
+                _client_pid = os.getpid()
+    return _client
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """Get the shared keep-alive async http client of the running event loop.
+
+    Returns:
+        httpx.AsyncClient: The async http client.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _create_async_client()
+        _async_clients[loop] = client
+    return client
+
+
+def run_async(*aws) -> list:
+    """Run coroutines concurrently from sync code, e.g. a celery task.
+
+    The requests overlap, so the flow takes max() of the latencies instead of
+    sum(). The async client of the loop is closed before returning.
+
+    Args:
+        *aws: Coroutines, e.g. `AsyncGitHubAppRepo(...).get_one_issue(...)`.
+
+    Returns:
+        list: The results in order, the first exception is raised.
+    """
+
+    async def main():
+        try:
+            return await asyncio.gather(*aws)
+        finally:
+            client = _async_clients.pop(asyncio.get_running_loop(), None)
+            if client is not None:
+                await client.aclose()
+
+    return asyncio.run(main())
+
+
+def _reset_client() -> None:
+    """Forget the client inherited from the parent process."""
+    global _client, _client_pid, _client_lock
+
+    _client, _client_pid = None, None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_client)
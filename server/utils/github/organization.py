@@ -1,4 +1,4 @@
-from utils.github.bot import BaseGitHubApp
+from utils.github.bot import AsyncBaseGitHubApp, BaseGitHubApp
 
 
 class GitHubAppOrg(BaseGitHubApp):
@@ -16,17 +16,7 @@ class GitHubAppOrg(BaseGitHubApp):
         https://docs.github.com/zh/rest/repos/repos?apiVersion=2022-11-28#list-organization-repositories
         """
 
-        page = 1
-        while True:
-            repos = self.base_github_rest_api(
-                f"https://api.github.com/orgs/{org_name}/repos?page={page}",
-                auth_type="install_token",
-            )
-            if len(repos) == 0:
-                break
-            for repo in repos:
-                yield repo
-            page = page + 1
+        return self.paginate(f"https://api.github.com/orgs/{org_name}/repos")
 
     def get_org_repos_accessible(self) -> list | None:
         """Get accessible org repos.
@@ -36,18 +26,10 @@ class GitHubAppOrg(BaseGitHubApp):
         https://docs.github.com/zh/rest/apps/installations?apiVersion=2022-11-28#list-repositories-accessible-to-the-app-installation
         """
 
-        page = 1
-        while True:
-            repos_json = self.base_github_rest_api(
-                f"https://api.github.com/installation/repositories?page={page}",
-                auth_type="install_token",
-            )
-            repos = repos_json.get("repositories", [])
-            if len(repos) == 0:
-                break
-            for repo in repos:
-                yield repo
-            page = page + 1
+        return self.paginate(
+            "https://api.github.com/installation/repositories",
+            items=lambda data: data.get("repositories", []),
+        )
 
     def get_org_members(self, org_name: str) -> list | None:
         """Get a list of members of an organization.
@@ -59,14 +41,8 @@ class GitHubAppOrg(BaseGitHubApp):
             list | None: A list of members of the organization.
         https://docs.github.com/zh/rest/orgs/members?apiVersion=2022-11-28#list-organization-members
         """
-        page = 1
-        while True:
-            members = self.base_github_rest_api(
-                f"https://api.github.com/orgs/{org_name}/members?page={page}",
-                auth_type="install_token",
-            )
-            if len(members) == 0:
-                break
-            for member in members:
-                yield member
-            page = page + 1
+        return self.paginate(f"https://api.github.com/orgs/{org_name}/members")
+
+
+class AsyncGitHubAppOrg(AsyncBaseGitHubApp, GitHubAppOrg):
+    """asyncio twin of GitHubAppOrg, the list helpers return async generators."""
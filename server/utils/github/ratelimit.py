@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import httpx
+from app import app
+from utils.constant import GitHubRateLimitError
+from utils.redis import client, incr_metrics
+
+# 后台同步在剩余额度低于这个值时停下来，把额度留给交互命令（/close、/merge 等）
+app.config.setdefault("GITHUB_RATELIMIT_RESERVE", 500)
+# 需要等待的时间超过这个值时不再阻塞，抛出 GitHubRateLimitError（后台同步任务会延后重试）
+app.config.setdefault("GITHUB_RATELIMIT_MAX_WAIT", 30)
+# 交互命令没有重试，至少等完第一次 secondary rate limit 的 60 秒
+app.config.setdefault("GITHUB_RATELIMIT_INTERACTIVE_MAX_WAIT", 60)
+# 遇到限流响应后最多重试的次数
+app.config.setdefault("GITHUB_RATELIMIT_RETRIES", 2)
+
+_priority: ContextVar[str] = ContextVar("github_priority", default="interactive")
+
+# KEYS[1] 是限流标记，ARGV 是 blocked_until, 毫秒数
+# 只会延长不会缩短，并发的限流响应以最晚解除的为准
+_BLOCK_SCRIPT = client.register_script(
+    """
+if redis.call("PTTL", KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+end
+"""
+)
+
+
+def get_priority() -> str:
+    return _priority.get()
+
+
+@contextmanager
+def priority(value: str):
+    """Set the priority of the GitHub requests, "interactive" or "background".
+
+    Can be used as a decorator too.
+    """
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def background_priority():
+    """Mark the GitHub requests as background sync."""
+    return priority("background")
+
+
+def get_owner(auth_type: str, installation_id=None, user_id=None) -> str:
+    """The owner of the credential, e.g. `installation:<id>`."""
+    match auth_type:
+        case "install_token":
+            return f"installation:{installation_id}"
+        case "user_token":
+            return f"user:{user_id}"
+        case _:
+            return "app"
+
+
+def get_key(auth_type: str, url: str, installation_id=None, user_id=None) -> str:
+    """Redis hash of the rate limit budget shared by all workers.
+
+    GitHub counts the budget per installation / user token and per resource.
+    """
+    resource = "graphql" if url.endswith("/graphql") else "core"
+    owner = get_owner(auth_type, installation_id, user_id)
+    return f"github:ratelimit:{owner}:{resource}"
+
+
+def get_wait(key: str) -> float:
+    """Seconds to wait before the next request of the current priority."""
+    try:
+        pipeline = client.pipeline()
+        pipeline.hgetall(key)
+        pipeline.get(f"{key}:blocked")
+        state, blocked_until = pipeline.execute()
+    except Exception as e:
+        logging.error("github ratelimit %r %r", key, e)
+        return 0
+    now = time.time()
+
+    blocked_until = float(blocked_until or 0)
+    if blocked_until > now:
+        return blocked_until - now
+
+    reset = float(state.get("reset", 0))
+    if "remaining" not in state or reset <= now:
+        return 0
+    reserve = (
+        app.config["GITHUB_RATELIMIT_RESERVE"] if "background" == get_priority() else 0
+    )
+    if int(state["remaining"]) <= reserve:
+        return reset - now
+    return 0
+
+
+def get_throttle(key: str) -> float:
+    """Seconds to sleep before the next request.
+
+    Raises:
+        GitHubRateLimitError: The wait is longer than GITHUB_RATELIMIT_MAX_WAIT,
+            or GITHUB_RATELIMIT_INTERACTIVE_MAX_WAIT for interactive requests.
+    """
+    wait = get_wait(key)
+    if wait <= 0:
+        return 0
+    incr_metrics("github_ratelimit", f"{get_priority()}_throttled")
+    max_wait = (
+        app.config["GITHUB_RATELIMIT_MAX_WAIT"]
+        if "background" == get_priority()
+        else app.config["GITHUB_RATELIMIT_INTERACTIVE_MAX_WAIT"]
+    )
+    if wait > max_wait:
+        raise GitHubRateLimitError(f"{key} is rate limited", retry_after=wait)
+    logging.info("github ratelimit %s wait %.1fs", key, wait)
+    return wait
+
+
+def throttle(key: str):
+    """Wait until the budget allows a request."""
+    wait = get_throttle(key)
+    if wait:
+        time.sleep(wait)
+
+
+async def async_throttle(key: str):
+    """Wait until the budget allows a request, without blocking the loop."""
+    wait = get_throttle(key)
+    if wait:
+        await asyncio.sleep(wait)
+
+
+def update(key: str, response: httpx.Response):
+    """Save the budget from the X-RateLimit-* headers of the response."""
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    reset = response.headers.get("X-RateLimit-Reset")
+    if remaining is None or reset is None:
+        return
+    try:
+        pipeline = client.pipeline()
+        pipeline.hset(key, mapping={"remaining": remaining, "reset": reset})
+        pipeline.expireat(key, int(reset) + 60)
+        pipeline.execute()
+    except Exception as e:
+        logging.error("github ratelimit %r %r", key, e)
+
+
+def get_retry_after(response: httpx.Response, attempt: int = 0) -> float | None:
+    """Seconds to back off if the response is a primary or secondary rate limit.
+
+    https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api#exceeding-the-rate-limit
+
+    Returns:
+        float | None: None if the response is not rate limited.
+    """
+    if response.status_code not in [403, 429]:
+        return None
+    if response.headers.get("Retry-After"):
+        return float(response.headers["Retry-After"])
+    if "0" == response.headers.get("X-RateLimit-Remaining"):
+        return max(float(response.headers["X-RateLimit-Reset"]) - time.time(), 1)
+    if "secondary rate limit" in response.text.lower():
+        # 没有 Retry-After 时至少等 1 分钟，之后指数退避
+        return 60 * 2**attempt
+    return None
+
+
+def block(key: str, retry_after: float):
+    """Stop all requests of the key for `retry_after` seconds.
+
+    The block is kept apart from the budget hash, so that `update` does not
+    cut it short, and an earlier block is never shortened.
+    """
+    incr_metrics("github_ratelimit", "limited")
+    try:
+        _BLOCK_SCRIPT(
+            keys=[f"{key}:blocked"],
+            args=[time.time() + retry_after, max(int(retry_after * 1000), 1)],
+        )
+    except Exception as e:
+        logging.error("github ratelimit %r %r", key, e)
@@ -1,6 +1,83 @@
-from app import db
+import asyncio
+import logging
+
+from app import app, db
 from model.schema import CodeApplication, Repo, Team
-from utils.github.bot import BaseGitHubApp
+from utils.github.bot import AsyncBaseGitHubApp, BaseGitHubApp
+
+app.config.setdefault("GITHUB_ASYNC_CONCURRENCY", 8)
+
+REPO_COLLABORATORS_QUERY = """
+query ($org: String!, $first: Int!, $cursor: String) {
+  organization(login: $org) {
+    repositories(first: $first, after: $cursor) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        databaseId
+        name
+        collaborators(first: 100) {
+          pageInfo {
+            hasNextPage
+          }
+          edges {
+            permission
+            node {
+              databaseId
+              login
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+# GraphQL RepositoryPermission -> REST collaborator permissions
+GRAPHQL_PERMISSIONS = {
+    "ADMIN": ["admin", "maintain", "push", "triage", "pull"],
+    "MAINTAIN": ["maintain", "push", "triage", "pull"],
+    "WRITE": ["push", "triage", "pull"],
+    "TRIAGE": ["triage", "pull"],
+    "READ": ["pull"],
+}
+
+
+def _parse_repo_collaborators(res: dict, result: dict) -> str | None:
+    """Add the collaborators of a REPO_COLLABORATORS_QUERY response to result.
+
+    Returns:
+        str | None: The cursor of the next page, None if it is the last page.
+    """
+    repositories = ((res.get("data") or {}).get("organization") or {}).get(
+        "repositories"
+    )
+    if repositories is None:
+        logging.error("get_org_repo_collaborators: %r", res.get("errors"))
+        return None
+
+    for repo in repositories["nodes"]:
+        collaborators = repo.get("collaborators")
+        if collaborators is None or collaborators["pageInfo"]["hasNextPage"]:
+            continue
+        result[str(repo["databaseId"])] = [
+            dict(
+                id=edge["node"]["databaseId"],
+                login=edge["node"]["login"],
+                permissions={
+                    permission: True
+                    for permission in GRAPHQL_PERMISSIONS.get(edge["permission"], [])
+                },
+            )
+            for edge in collaborators["edges"]
+        ]
+
+    if not repositories["pageInfo"]["hasNextPage"]:
+        return None
+    return repositories["pageInfo"]["endCursor"]
 
 
 class GitHubAppRepo(BaseGitHubApp):
@@ -48,10 +125,8 @@ class GitHubAppRepo(BaseGitHubApp):
         Returns:
             dict: Repo info.
         """
-        return self.base_github_rest_api(
-            f"https://api.github.com/repos/{team_name}/{repo_name}",
-            "GET",
-            "install_token",
+        return self.cached_get(
+            f"https://api.github.com/repos/{team_name}/{repo_name}", "repo"
         )
 
     def get_repo_collaborators(self, repo_name: str, owner_name: str) -> list | None:
@@ -65,17 +140,37 @@ class GitHubAppRepo(BaseGitHubApp):
             list: The repo collaborators.
         https://docs.github.com/zh/rest/collaborators/collaborators?apiVersion=2022-11-28#list-repository-collaborators
         """
-        page = 1
+        return self.paginate(
+            f"https://api.github.com/repos/{owner_name}/{repo_name}/collaborators"
+        )
+
+    def get_org_repo_collaborators(self, org_name: str, first: int = 50) -> dict:
+        """Get the collaborators of all org repos with a few GraphQL queries.
+
+        Every query returns `first` repos with up to 100 collaborators each.
+        Repos whose collaborators can not be read or do not fit in one page
+        are left out, use get_repo_collaborators (REST) for them.
+
+        Args:
+            org_name (str): The name of the org.
+            first (int, optional): Repos per query.
+
+        Returns:
+            dict: GitHub repo id -> collaborators, in the same format as
+            get_repo_collaborators.
+        https://docs.github.com/en/graphql/reference/objects#repository
+        """
+        result = {}
+        cursor = None
         while True:
-            collaborators = self.base_github_rest_api(
-                f"https://api.github.com/repos/{owner_name}/{repo_name}/collaborators?page={page}",
-                auth_type="install_token",
+            res = self.base_github_graphql_api(
+                REPO_COLLABORATORS_QUERY,
+                dict(org=org_name, first=first, cursor=cursor),
             )
-            if len(collaborators) == 0:
+            cursor = _parse_repo_collaborators(res, result)
+            if cursor is None:
                 break
-            for collaborator in collaborators:
-                yield collaborator
-            page = page + 1
+        return result
 
     def update_repo(
         self,
@@ -230,9 +325,9 @@ class GitHubAppRepo(BaseGitHubApp):
             dict: The issue info.
         """
 
-        return self.base_github_rest_api(
+        return self.cached_get(
             f"https://api.github.com/repos/{repo_onwer}/{repo_name}/issues/{issue_number}",
-            auth_type="install_token",
+            "issue",
         )
 
     def create_issue_comment(
@@ -314,9 +409,9 @@ class GitHubAppRepo(BaseGitHubApp):
             dict: The issue info.
         """
 
-        return self.base_github_rest_api(
+        return self.cached_get(
             f"https://api.github.com/repos/{repo_onwer}/{repo_name}/pulls/{pull_number}",
-            auth_type="install_token",
+            "pull_request",
         )
 
     def requested_reviewers(
@@ -382,3 +477,81 @@ class GitHubAppRepo(BaseGitHubApp):
             "user_token",
             json=json,
         )
+
+
+class AsyncGitHubAppRepo(AsyncBaseGitHubApp, GitHubAppRepo):
+    """asyncio twin of GitHubAppRepo, see AsyncBaseGitHubApp."""
+
+    async def get_repo_info(self, repo_id: str) -> dict | None:
+        # 同步版本查完数据库后返回 get_repo_info_by_name 的 coroutine
+        repo_info = super().get_repo_info(repo_id)
+        return await repo_info if repo_info is not None else None
+
+    async def get_org_repo_collaborators(self, org_name: str, first: int = 50) -> dict:
+        result = {}
+        cursor = None
+        while True:
+            res = await self.base_github_graphql_api(
+                REPO_COLLABORATORS_QUERY,
+                dict(org=org_name, first=first, cursor=cursor),
+            )
+            cursor = _parse_repo_collaborators(res, result)
+            if cursor is None:
+                break
+        return result
+
+    async def get_repos_collaborators(self, repo_names: list, owner_name: str) -> dict:
+        """Get the collaborators of many repos concurrently.
+
+        At most GITHUB_ASYNC_CONCURRENCY repos are listed at the same time.
+        Repos which failed are left out.
+
+        Args:
+            repo_names (list): The names of the repos.
+            owner_name (str): The name of the owner.
+
+        Returns:
+            dict: repo name -> collaborators.
+        """
+        semaphore = asyncio.Semaphore(app.config["GITHUB_ASYNC_CONCURRENCY"])
+
+        async def get_collaborators(repo_name):
+            async with semaphore:
+                try:
+                    return repo_name, [
+                        collaborator
+                        async for collaborator in self.get_repo_collaborators(
+                            repo_name, owner_name
+                        )
+                    ]
+                except Exception as e:
+                    logging.error("get_repos_collaborators %s: %r", repo_name, e)
+                    return repo_name, None
+
+        return {
+            repo_name: collaborators
+            for repo_name, collaborators in await asyncio.gather(
+                *map(get_collaborators, repo_names)
+            )
+            if collaborators is not None
+        }
+
+    async def add_repo_collaborator(
+        self,
+        repo_onwer: str,
+        repo_name: str,
+        username: str,
+        permission: str = "pull",
+    ) -> dict | None:
+        res = await self.base_github_rest_api(
+            f"https://api.github.com/repos/{repo_onwer}/{repo_name}/collaborators/{username}",
+            "PUT",
+            "user_token",
+            json={"permission": permission},
+            raw=True,
+        )
+
+        if res.status_code == 204:
+            return {"status": "success"}
+        else:
+            return {"status": "failed", "message": res.json()["message"]}
@@ -0,0 +1,249 @@
+import json
+import logging
+import threading
+from collections import OrderedDict
+from time import sleep, time
+
+import httpx
+from app import app
+from connectai.lark.sdk import Bot
+from utils.constant import LarkRateLimitError
+from utils.lark import ratelimit
+from utils.redis import client, incr_metrics, singleflight
+
+# 每个进程缓存的 bot 数量
+app.config.setdefault("LARK_BOT_REGISTRY_SIZE", 1000)
+# bot 缓存的最长时间，版本号丢失时也能兜底刷新
+app.config.setdefault("LARK_BOT_REGISTRY_EXPIRE", 60 * 10)
+# 每个进程最多每隔这么多秒读一次 redis 里的版本号，其他进程的修改最多延迟这么久生效
+app.config.setdefault("LARK_BOT_REGISTRY_VERSION_CHECK_INTERVAL", 5)
+# 提前刷新 tenant_access_token 的秒数，飞书在 token 剩余不到 30 分钟时才会下发新 token
+app.config.setdefault("LARK_TOKEN_REFRESH_AHEAD", 60 * 5)
+
+BOT_REGISTRY_VERSION_KEY = "lark:bot_registry:version"
+
+# "<name>:<app_id>" -> (token, expired)
+_access_tokens = {}
+_access_tokens_lock = threading.Lock()
+
+
+class GitMayaBot(Bot):
+    """Bot which shares tokens and coalesces identical requests in flight.
+
+    Access tokens are looked up in process memory first, then in the storage,
+    and are refreshed ahead of expiry by one worker at a time under a redis
+    lock. Concurrent identical GET requests of this process share one upstream
+    call and its response.
+
+    Every request waits for the per-app bucket, and for the per-chat bucket
+    inside `ratelimit.chat`. Replies and card updates which would wait too
+    long are re-queued on their own by `send_deferred_lark_requests`, in
+    order per chat or thread; other requests wait in place and raise
+    LarkRateLimitError when they wait too long.
+    """
+
+    def access_token_by_name(self, name):
+        key = f"{name}:{self.app_id}"
+        refresh_ahead = app.config["LARK_TOKEN_REFRESH_AHEAD"]
+
+        token, expired = _access_tokens.get(key, (None, 0))
+        if token and expired - time() > refresh_ahead:
+            return token
+
+        token, expired = self._load_access_token(key) or (token, expired)
+        if token and expired - time() > refresh_ahead:
+            return token
+
+        return singleflight(key, self._refresh_access_token, name, key, token, expired)
+
+    def _refresh_access_token(self, name, key, token, expired):
+        refresh_ahead = app.config["LARK_TOKEN_REFRESH_AHEAD"]
+
+        lock = client.lock(f"lark:{key}:lock", timeout=30)
+        # 旧 token 还没过期时不等待锁，直接使用旧 token，由持有锁的 worker 刷新
+        acquired = lock.acquire(
+            blocking=not (token and expired > time()), blocking_timeout=10
+        )
+        if not acquired and token and expired > time():
+            return token
+
+        try:
+            # 拿到锁之后再检查一次，可能别的 worker 已经刷新过了
+            cached = self._load_access_token(key)
+            if cached and cached[1] - time() > refresh_ahead:
+                return cached[0]
+
+            # SDK 会把拿到的 token 缓存在实例上，刷新前先清掉
+            attr = f"_{name}"
+            if attr in self.__dict__:
+                delattr(self, attr)
+            token, expired = getattr(self, attr)
+            incr_metrics("lark_token", "refreshed")
+            with _access_tokens_lock:
+                _access_tokens[key] = (token, expired)
+            try:
+                self.storage.set(key, json.dumps([token, expired]))
+            except Exception as e:
+                logging.error("save %r to storage %r", key, e)
+            return token
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except Exception as e:
+                    logging.debug("release lark token lock %r", e)
+
+    def _load_access_token(self, key):
+        """Load the access token from the storage into the process cache."""
+        try:
+            token, expired = json.loads(self.storage.get(key))
+        except Exception as e:
+            logging.debug("error to get %r from storage %r", key, e)
+            return None
+        with _access_tokens_lock:
+            _access_tokens[key] = (token, expired)
+        return token, expired
+
+    def request(self, method, url, headers=None, **kwargs):
+        deferrable = "GET" != method and ratelimit.is_deferrable()
+        # 同一个群/话题已经有延后的请求时排到后面，不能插队
+        if deferrable and ratelimit.has_deferred(self.app_id, ratelimit.get_queue()):
+            return self._defer(method, url, 0, **kwargs)
+
+        max_wait = ratelimit.get_max_wait(method)
+        attempt = 0
+        try:
+            while True:
+                ratelimit.throttle(self.app_id, ratelimit.get_chat(), max_wait)
+                response = super().request(method, url, headers=headers, **kwargs)
+                retry_after = ratelimit.check_response(
+                    self.app_id, response, attempt, max_wait
+                )
+                if retry_after is None:
+                    return response
+                sleep(retry_after)
+                attempt += 1
+        except LarkRateLimitError as e:
+            if not deferrable:
+                raise e
+            return self._defer(method, url, e.retry_after, **kwargs)
+
+    def _defer(self, method, url, countdown, **kwargs):
+        """Re-queue a request whose response is not used.
+
+        Requests of the same chat or thread are appended to one queue, which
+        is sent in order by a single `send_deferred_lark_requests` task.
+        """
+        # tasks 会引用 utils.lark，在这里再导入避免循环引用
+        import tasks
+
+        queue = ratelimit.get_queue()
+        request = dict(
+            method=method,
+            url=url,
+            json=kwargs.get("json"),
+            chat_id=ratelimit.get_chat(),
+        )
+        if ratelimit.push_deferred(self.app_id, queue, request):
+            tasks.send_deferred_lark_requests.apply_async(
+                args=(self.app_id, queue), countdown=countdown
+            )
+        incr_metrics("lark_ratelimit", "deferred")
+        return httpx.Response(200, json={"code": 0, "msg": "deferred", "data": {}})
+
+    def send(self, receive_id, content, msg_type="text", receive_id_type="open_id"):
+        # 发到群里的消息同时受群的频率限制
+        chat_id = receive_id if "chat_id" == receive_id_type else None
+        with ratelimit.chat(chat_id):
+            return super().send(receive_id, content, msg_type, receive_id_type)
+
+    def reply(self, message_id, content, msg_type="text", reply_in_thread=False):
+        # 回复的响应没有被用到，被限流时可以单独延后发送
+        with ratelimit.deferrable(message_id):
+            return super().reply(message_id, content, msg_type, reply_in_thread)
+
+    def update(self, message_id, content):
+        with ratelimit.deferrable(message_id):
+            return super().update(message_id, content)
+
+    def get(self, url, **kwargs):
+        key = "lark:get:{}:{}:{}".format(
+            self.app_id, url, json.dumps(kwargs, sort_keys=True, default=str)
+        )
+        return singleflight(key, super().get, url, **kwargs)
+
+
+class BotRegistry(object):
+    """LRU of live bots, keyed by both IMApplication.app_id and IMApplication.id.
+
+    The registry of every process is dropped when the version in redis is
+    bumped by `invalidate_bot_registry`, the version is read at most every
+    LARK_BOT_REGISTRY_VERSION_CHECK_INTERVAL seconds. Entries also expire
+    after LARK_BOT_REGISTRY_EXPIRE seconds.
+    """
+
+    def __init__(self):
+        # key -> (bot, application, created_at)
+        self._bots = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0
+
+    def _check_version(self):
+        now = time()
+        if (
+            now - self._checked_at
+            < app.config["LARK_BOT_REGISTRY_VERSION_CHECK_INTERVAL"]
+        ):
+            return
+        self._checked_at = now
+        try:
+            version = client.get(BOT_REGISTRY_VERSION_KEY)
+        except Exception as e:
+            logging.error(e)
+            return
+        if version != self._version:
+            self.clear(version)
+
+    def clear(self, version=None):
+        with self._lock:
+            self._bots.clear()
+            self._version = version
+
+    def get(self, key):
+        """Returns: (bot, application), None if not cached."""
+        self._check_version()
+        with self._lock:
+            item = self._bots.get(key)
+            if not item:
+                return None
+            bot, application, created_at = item
+            if time() - created_at > app.config["LARK_BOT_REGISTRY_EXPIRE"]:
+                self._bots.pop(application.id, None)
+                self._bots.pop(application.app_id, None)
+                return None
+            self._bots.move_to_end(key)
+            return bot, application
+
+    def set(self, bot, application):
+        item = (bot, application, time())
+        with self._lock:
+            for key in {application.id, application.app_id}:
+                self._bots[key] = item
+                self._bots.move_to_end(key)
+            while len(self._bots) > app.config["LARK_BOT_REGISTRY_SIZE"]:
+                self._bots.popitem(last=False)
+
+
+bot_registry = BotRegistry()
+
+
+def invalidate_bot_registry():
+    """Drop the cached bots of all processes, call this after IMApplication changed."""
+    try:
+        version = client.incr(BOT_REGISTRY_VERSION_KEY)
+    except Exception as e:
+        logging.error(e)
+        version = None
+    # 当前进程立即生效，其他进程在下一次检查版本号时生效
+    bot_registry.clear(None if version is None else str(version))
@@ -141,13 +141,7 @@ class GitMayaLarkParser(object):
                 )
 
                 if root_id:
-                    repo, issue, pr = tasks.get_git_object_by_message_id(root_id)
-                    if repo:
-                        topic = TopicType.REPO
-                    elif issue:
-                        topic = TopicType.ISSUE
-                    elif pr:
-                        topic = TopicType.PULL_REQUEST
+                    topic = tasks.get_topic_by_message_id(root_id)
         except Exception as e:
             logging.error(e)
         return chat_type, topic
@@ -0,0 +1,195 @@
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import httpx
+from app import app
+from utils.constant import LarkRateLimitError
+from utils.redis import client, incr_metrics, token_bucket
+
+# 每个应用每秒最多调用的次数，飞书发送消息接口的上限是 50 次/秒
+app.config.setdefault("LARK_RATELIMIT_APP_QPS", 40)
+# 每个群每秒最多发送的消息数，飞书同一个群的上限是 5 次/秒（多个机器人共享）
+app.config.setdefault("LARK_RATELIMIT_CHAT_QPS", 4)
+# 可以延后的请求（回复、更新卡片）等待超过这个值时，单独放到 send_lark_request 任务里延后发送
+app.config.setdefault("LARK_RATELIMIT_MAX_WAIT", 2)
+# 需要用到响应的请求（例如发送卡片后保存 message_id）原地等待的最长时间，超过则抛出 LarkRateLimitError
+app.config.setdefault("LARK_RATELIMIT_MAX_BLOCK", 30)
+# 遇到限流响应后最多重试的次数
+app.config.setdefault("LARK_RATELIMIT_RETRIES", 2)
+# 延后发送的请求队列的保存时间，发送任务丢失时过期之后不再阻塞后面的请求
+app.config.setdefault("LARK_DEFERRED_EXPIRE", 60 * 10)
+
+# 飞书的频率限制错误码
+# https://open.feishu.cn/document/server-docs/api-call-guide/frequency-control
+RATELIMIT_CODES = [99991400, 230020]
+
+_chat_id: ContextVar[str | None] = ContextVar("lark_chat_id", default=None)
+_deferrable: ContextVar[str | None] = ContextVar("lark_deferrable", default=None)
+
+
+def get_chat() -> str | None:
+    return _chat_id.get()
+
+
+@contextmanager
+def chat(chat_id: str | None):
+    """Count the Lark requests inside against the bucket of the chat too."""
+    token = _chat_id.set(chat_id)
+    try:
+        yield
+    finally:
+        _chat_id.reset(token)
+
+
+def is_deferrable() -> bool:
+    return _deferrable.get() is not None
+
+
+def get_queue() -> str | None:
+    """Deferred requests of the same chat, else of the same thread, keep order."""
+    return _chat_id.get() or _deferrable.get()
+
+
+@contextmanager
+def deferrable(thread: str):
+    """The responses of the Lark requests inside are not used.
+
+    Such requests are re-queued on their own when throttled, instead of
+    waiting in place.
+
+    Args:
+        thread (str): The message replied to or updated, deferred requests
+            of the same thread are sent in order when there is no chat.
+    """
+    token = _deferrable.set(thread)
+    try:
+        yield
+    finally:
+        _deferrable.reset(token)
+
+
+def _deferred_key(app_id: str, queue: str) -> str:
+    return f"lark:deferred:{app_id}:{queue}"
+
+
+def has_deferred(app_id: str, queue: str) -> bool:
+    """Whether requests of the queue are waiting to be sent."""
+    try:
+        return bool(client.exists(_deferred_key(app_id, queue)))
+    except Exception as e:
+        logging.error("lark deferred %r %r", queue, e)
+        return False
+
+
+def push_deferred(app_id: str, queue: str, request: dict) -> bool:
+    """Append a request to the queue.
+
+    Returns:
+        bool: True if the queue was empty, the caller has to schedule
+        `send_deferred_lark_requests`.
+    """
+    key = _deferred_key(app_id, queue)
+    pipeline = client.pipeline()
+    pipeline.rpush(key, json.dumps(request))
+    pipeline.expire(key, app.config["LARK_DEFERRED_EXPIRE"])
+    count, _ = pipeline.execute()
+    return 1 == count
+
+
+def peek_deferred(app_id: str, queue: str) -> dict | None:
+    """The first request of the queue, None if the queue is empty."""
+    value = client.lindex(_deferred_key(app_id, queue), 0)
+    return json.loads(value) if value else None
+
+
+def pop_deferred(app_id: str, queue: str):
+    """Remove the first request of the queue once it is sent."""
+    client.lpop(_deferred_key(app_id, queue))
+
+
+def get_max_wait(method: str) -> float:
+    if "GET" != method and is_deferrable():
+        return app.config["LARK_RATELIMIT_MAX_WAIT"]
+    return app.config["LARK_RATELIMIT_MAX_BLOCK"]
+
+
+def get_buckets(app_id: str, chat_id: str | None = None) -> list:
+    qps = app.config["LARK_RATELIMIT_APP_QPS"]
+    buckets = [(f"lark:ratelimit:app:{app_id}", qps, qps)]
+    if chat_id:
+        qps = app.config["LARK_RATELIMIT_CHAT_QPS"]
+        buckets.append((f"lark:ratelimit:chat:{chat_id}", qps, qps))
+    return buckets
+
+
+def _requeue_after(wait: float) -> float:
+    # 加一点随机，避免延后的任务同时回来
+    return max(wait, 1) + random.random()
+
+
+def throttle(app_id: str, chat_id: str | None = None, max_wait: float = None):
+    """Wait until the buckets of the app and the chat allow a request.
+
+    Raises:
+        LarkRateLimitError: The wait is longer than `max_wait`, defaults to
+            LARK_RATELIMIT_MAX_WAIT.
+    """
+    if max_wait is None:
+        max_wait = app.config["LARK_RATELIMIT_MAX_WAIT"]
+    buckets = get_buckets(app_id, chat_id)
+    waited = 0
+    while True:
+        wait = token_bucket(buckets)
+        if wait <= 0:
+            return
+        incr_metrics("lark_ratelimit", "throttled")
+        if waited + wait > max_wait:
+            raise LarkRateLimitError(
+                f"lark {app_id} {chat_id} is rate limited",
+                retry_after=_requeue_after(wait),
+            )
+        time.sleep(wait)
+        waited += wait
+
+
+def get_retry_after(response: httpx.Response) -> float | None:
+    """Seconds to back off if the response is a frequency limit error.
+
+    Returns:
+        float | None: None if the response is not rate limited.
+    """
+    if response.status_code not in [400, 429]:
+        return None
+    try:
+        code = response.json().get("code")
+    except Exception:
+        code = None
+    if response.status_code != 429 and code not in RATELIMIT_CODES:
+        return None
+    incr_metrics("lark_ratelimit", "limited")
+    reset = response.headers.get("x-ogw-ratelimit-reset")
+    return float(reset) if reset else 1
+
+
+def check_response(
+    app_id: str, response: httpx.Response, attempt: int, max_wait: float = None
+) -> float | None:
+    """Seconds to sleep before retrying the request, None if not rate limited.
+
+    Raises:
+        LarkRateLimitError: Out of retries, or the wait is longer than `max_wait`.
+    """
+    if max_wait is None:
+        max_wait = app.config["LARK_RATELIMIT_MAX_WAIT"]
+    retry_after = get_retry_after(response)
+    if retry_after is None:
+        return None
+    if attempt >= app.config["LARK_RATELIMIT_RETRIES"] or retry_after > max_wait:
+        raise LarkRateLimitError(
+            f"lark {app_id} is rate limited", retry_after=_requeue_after(retry_after)
+        )
+    return retry_after
@@ -1,9 +1,13 @@
 import asyncio
 import functools
+import json
 import logging
+import os
 import pickle
-import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from inspect import iscoroutinefunction
+from time import time
 
 import redis
 from app import app
@@ -26,87 +30,454 @@ class RedisStorage(object):
         client.set(name, value)
 
 
+class TokenStorage(RedisStorage):
+    """RedisStorage which sets the TTL of access tokens to their expiry.
+
+    The Lark SDK saves tokens as json `[token, expired]`, so stale tokens are
+    dropped by redis. Other values (e.g. app_ticket) are saved as is.
+    """
+
+    def set(self, name, value):
+        try:
+            _, expired = json.loads(value)
+            ex = max(int(float(expired) - time()), 1)
+        except (TypeError, ValueError):
+            ex = None
+        client.set(name, value, ex=ex)
+
+
+def incr_metrics(name, field, amount=1):
+    """Increase a counter in the `gitmaya:metrics:<name>` hash."""
+    try:
+        client.hincrby(f"gitmaya:metrics:{name}", field, amount)
+    except Exception as e:
+        logging.error("incr_metrics %r %r", name, e)
+
+
+# 耗时分桶（秒），飞书卡片回调需要在 3 秒内响应
+LATENCY_BUCKETS = [0.1, 0.5, 1, 3]
+
+
+def observe_latency(name, seconds):
+    """Count `seconds` into the latency buckets of the `gitmaya:metrics:<name>` hash.
+
+    The hash also keeps `count` and `sum` (in seconds) of all the observations.
+    """
+    bucket = next(
+        (f"le_{b}" for b in LATENCY_BUCKETS if seconds <= b),
+        f"gt_{LATENCY_BUCKETS[-1]}",
+    )
+    try:
+        pipeline = client.pipeline(transaction=False)
+        pipeline.hincrby(f"gitmaya:metrics:{name}", bucket, 1)
+        pipeline.hincrby(f"gitmaya:metrics:{name}", "count", 1)
+        pipeline.hincrbyfloat(f"gitmaya:metrics:{name}", "sum", seconds)
+        pipeline.execute()
+    except Exception as e:
+        logging.error("observe_latency %r %r", name, e)
+
+
+def mark_once(name, ttl):
+    """Mark `name` as seen for `ttl` seconds.
+
+    Returns:
+        bool: True if it is the first time, False if `name` was already marked.
+        Fails open (returns True) when redis is not available.
+    """
+    try:
+        return bool(client.set(name, 1, nx=True, ex=ttl))
+    except Exception as e:
+        logging.error("mark_once %r %r", name, e)
+        return True
+
+
+def unmark(name):
+    try:
+        client.delete(name)
+    except Exception as e:
+        logging.error("unmark %r %r", name, e)
+
+
+# 令牌桶：KEYS 是多个桶，ARGV 是 now, cost 以及每个桶的 rate, capacity
+# 所有桶都有足够的令牌时才一起扣除，否则返回需要等待的秒数
+_TOKEN_BUCKET_SCRIPT = client.register_script(
+    """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + i * 2])
+    local capacity = tonumber(ARGV[2 + i * 2])
+    local state = redis.call("HMGET", key, "tokens", "ts")
+    local value = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    value = math.min(capacity, value + math.max(now - ts, 0) * rate)
+    tokens[i] = value
+    if value < cost then
+        wait = math.max(wait, (cost - value) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[1 + i * 2])
+    local capacity = tonumber(ARGV[2 + i * 2])
+    local value = tokens[i]
+    if wait == 0 then
+        value = value - cost
+    end
+    redis.call("HSET", key, "tokens", tostring(value), "ts", ARGV[1])
+    redis.call("EXPIRE", key, math.ceil(capacity / rate) + 1)
+end
+return tostring(wait)
+"""
+)
+
+
+def token_bucket(buckets, cost=1):
+    """Take `cost` tokens from all the buckets at once.
+
+    Args:
+        buckets (list): (key, rate, capacity) of the buckets, `rate` tokens are
+            added per second, up to `capacity`.
+        cost (int): Tokens to take.
+
+    Returns:
+        float: 0 if the tokens are taken, otherwise seconds to wait before
+        trying again. Fails open (returns 0) when redis is not available.
+    """
+    args = [time(), cost]
+    for _, rate, capacity in buckets:
+        args.extend([rate, capacity])
+    try:
+        return float(
+            _TOKEN_BUCKET_SCRIPT(keys=[key for key, _, _ in buckets], args=args)
+        )
+    except Exception as e:
+        logging.error("token_bucket %r %r", buckets, e)
+        return 0
+
+
+# 原始字节的 client，和 client 一样在进程内共用连接池（fork 之后 redis-py 会自动重建连接）
+binary_client = redis.from_url(app.config["REDIS_URL"], decode_responses=False)
+
+
 def get_client(decode_responses=False):
-    return redis.from_url(app.config["REDIS_URL"], decode_responses=decode_responses)
+    return client if decode_responses else binary_client
+
+
+app.config.setdefault("STALECACHE_WORKERS", 4)
+app.config.setdefault("STALECACHE_LOCK_TIMEOUT", 60)
+
+_refresh_executor = None
+_refresh_executor_pid = None
+_refresh_executor_lock = threading.Lock()
+# 保存 async 刷新任务的引用，避免任务还没执行完就被回收
+_refresh_tasks = set()
+
+
+def get_refresh_executor():
+    """Thread pool which refreshes stale cache in background."""
+    global _refresh_executor, _refresh_executor_pid
+
+    if _refresh_executor is None or _refresh_executor_pid != os.getpid():
+        with _refresh_executor_lock:
+            if _refresh_executor is None or _refresh_executor_pid != os.getpid():
+                _refresh_executor = ThreadPoolExecutor(
+                    max_workers=app.config["STALECACHE_WORKERS"],
+                    thread_name_prefix="stalecache",
+                )
+                _refresh_executor_pid = os.getpid()
+    return _refresh_executor
 
 
 def gen_prefix(obj, method):
     return ".".join([obj.__module__, obj.__class__.__name__, method.__name__])
 
 
-def stalecache(
-    key=None,
-    expire=600,
-    stale=3600,
-    time_lock=1,
-    time_delay=1,
-    max_time_delay=10,
-):
+def stalecache(key=None, expire=600, stale=3600, lock_timeout=None):
+    """Cache the result in redis, serve stale value while refreshing in background.
+
+    A value is fresh for `expire` seconds, then served as stale for another
+    `stale` seconds. The first caller which sees a stale value takes a redis
+    lock and refreshes it on a background thread (or task for coroutine
+    functions), the others keep getting the stale value without waiting.
+    Falsy results are not cached. Pass `skip_cache=True` to bypass the cache.
+
+    Args:
+        key (callable): Build the cache key from the arguments of the method,
+            default is `<module>.<qualname>:<first argument>`.
+        expire (int): Seconds the value is fresh.
+        stale (int): Seconds the value can be served after it expired.
+        lock_timeout (int): Seconds of the refresh lock.
+    """
+
     def decorate(method):
+        metrics = f"stalecache:{method.__module__}.{method.__qualname__}"
+
+        def build_key(*args, **kwargs):
+            if key:
+                return f"stalecache:{key(*args, **kwargs)}"
+            return f"stalecache:{method.__module__}.{method.__qualname__}:{args[0]}"
+
+        def load(name):
+            try:
+                raw = binary_client.get(name)
+                return pickle.loads(raw) if raw else None
+            except Exception as e:
+                logging.error("stalecache load %r %r", name, e)
+                return None
+
+        def save(name, value):
+            if not value:
+                return
+            try:
+                binary_client.set(
+                    name,
+                    pickle.dumps((time() + expire, value)),
+                    ex=expire + stale,
+                )
+            except Exception as e:
+                logging.error("stalecache save %r %r", name, e)
+
+        def try_lock(name):
+            try:
+                return bool(
+                    binary_client.set(
+                        f"{name}:refresh",
+                        1,
+                        nx=True,
+                        ex=lock_timeout or app.config["STALECACHE_LOCK_TIMEOUT"],
+                    )
+                )
+            except Exception as e:
+                logging.error("stalecache lock %r %r", name, e)
+                return False
+
+        def unlock(name):
+            try:
+                binary_client.delete(f"{name}:refresh")
+            except Exception as e:
+                logging.error("stalecache unlock %r %r", name, e)
+
+        def refresh(name, *args, **kwargs):
+            try:
+                with app.app_context():
+                    value = method(*args, **kwargs)
+                save(name, value)
+                incr_metrics(metrics, "refresh")
+                logging.debug("update cache: %s", name)
+            except Exception as e:
+                incr_metrics(metrics, "refresh_error")
+                logging.exception("stalecache refresh %r %r", name, e)
+            finally:
+                unlock(name)
+
+        async def async_refresh(name, *args, **kwargs):
+            try:
+                value = await method(*args, **kwargs)
+                save(name, value)
+                incr_metrics(metrics, "refresh")
+                logging.debug("update cache: %s", name)
+            except Exception as e:
+                incr_metrics(metrics, "refresh_error")
+                logging.exception("stalecache refresh %r %r", name, e)
+            finally:
+                unlock(name)
+
         @functools.wraps(method)
         def wrapper(*args, **kwargs):
-            if kwargs.get("skip_cache"):
+            if kwargs.pop("skip_cache", False):
                 return method(*args, **kwargs)
-            name = args[0] if args and not key else None
 
-            res = get_client(False).pipeline().ttl(name).get(name).execute()
-            v = pickle.loads(res[1]) if res[0] > 0 and res[1] else None
-            if res[0] <= 0 or res[0] < stale:
+            name = build_key(*args, **kwargs)
+            cached = load(name)
+            if cached is None:
+                incr_metrics(metrics, "miss")
+                value = method(*args, **kwargs)
+                save(name, value)
+                return value
 
-                def func():
-                    value = method(*args, **kwargs)
-                    logging.debug("update cache: %s", name)
-                    get_client(False).pipeline().set(name, pickle.dumps(value)).expire(
-                        name, expire + stale
-                    ).execute()
-                    return value
-
-                # create new cache in blocking modal, if cache not exists.
-                if res[0] <= 0:
-                    return func()
-
-                # create new cache in non blocking modal, and return stale data.
-                # set expire to get a "lock", and delay to run the task
-                real_time_delay = random.randrange(time_delay, max_time_delay)
-                get_client(False).expire(name, stale + real_time_delay + time_lock)
-                # 创建一个 asyncio 任务来执行 func
-                loop = asyncio.get_event_loop()
-                loop.run_until_complete(asyncio.sleep(real_time_delay, func()))
-
-            return v
+            fresh_until, value = cached
+            if time() < fresh_until:
+                incr_metrics(metrics, "hit")
+                return value
+
+            incr_metrics(metrics, "stale")
+            # 只有拿到锁的调用方去刷新，其它调用方直接返回旧值
+            if try_lock(name):
+                try:
+                    get_refresh_executor().submit(refresh, name, *args, **kwargs)
+                except Exception as e:
+                    logging.error("stalecache submit %r %r", name, e)
+                    unlock(name)
+            return value
 
         @functools.wraps(method)
         async def async_wrapper(*args, **kwargs):
-            if kwargs.get("skip_cache"):
+            if kwargs.pop("skip_cache", False):
                 return await method(*args, **kwargs)
 
-            name = args[0] if args and not key else None
+            name = build_key(*args, **kwargs)
+            cached = load(name)
+            if cached is None:
+                incr_metrics(metrics, "miss")
+                value = await method(*args, **kwargs)
+                save(name, value)
+                return value
 
-            res = get_client(False).pipeline().ttl(name).get(name).execute()
-            v = pickle.loads(res[1]) if res[0] > 0 and res[1] else None
-            if res[0] <= 0 or res[0] < stale:
+            fresh_until, value = cached
+            if time() < fresh_until:
+                incr_metrics(metrics, "hit")
+                return value
 
-                async def func():
-                    value = await method(*args, **kwargs)
-                    logging.debug("update cache: %s", name)
-                    get_client(False).pipeline().set(name, pickle.dumps(value)).expire(
-                        name, expire + stale
-                    ).execute()
-                    return value
+            incr_metrics(metrics, "stale")
+            if try_lock(name):
+                task = asyncio.get_running_loop().create_task(
+                    async_refresh(name, *args, **kwargs)
+                )
+                _refresh_tasks.add(task)
+                task.add_done_callback(_refresh_tasks.discard)
+            return value
 
-                # create new cache in blocking modal, if cache not exists.
-                if res[0] <= 0:
-                    return await func()
+        return async_wrapper if iscoroutinefunction(method) else wrapper
 
-                # create new cache in non blocking modal, and return stale data.
-                # set expire to get a "lock", and delay to run the task
-                real_time_delay = random.randrange(time_delay, max_time_delay)
-                get_client(False).expire(name, stale + real_time_delay + time_lock)
-                loop = asyncio.get_event_loop()
-                loop.run_until_complete(asyncio.sleep(real_time_delay, func()))
+    return decorate
 
-            return v
 
-        return async_wrapper if iscoroutinefunction(method) else wrapper
+app.config.setdefault("SINGLEFLIGHT_LOCK_TIMEOUT", 30)
+# 等待持有锁的 worker 的最长时间，和 http 请求的超时时间差不多，超时后自己调用
+app.config.setdefault("SINGLEFLIGHT_WAIT_TIMEOUT", 10)
+app.config.setdefault("SINGLEFLIGHT_RESULT_EXPIRE", 10)
 
-    return decorate
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls with the same key in this process.
+
+    The first caller runs the function, the others wait for it and share its
+    result (or exception). Nothing is cached after the call returns.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            incr_metrics("singleflight", "shared")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise e
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+
+_single_flight = SingleFlight()
+
+
+def redis_singleflight(key, func, *args, **kwargs):
+    """Coalesce concurrent calls with the same key across workers.
+
+    The worker which takes the redis lock runs the function and keeps the
+    result for SINGLEFLIGHT_RESULT_EXPIRE seconds, the workers which saw the
+    lock block on a pub/sub notification (at most SINGLEFLIGHT_WAIT_TIMEOUT
+    seconds) until it is released and read that result. Callers coming after
+    the lock is released run the function again, so results are not cached.
+    Fails open: the function is called directly when redis is not available,
+    or the result is missing (leader failed or result is not picklable).
+    """
+    name = f"singleflight:{key}"
+    lock_timeout = app.config["SINGLEFLIGHT_LOCK_TIMEOUT"]
+    try:
+        lock = binary_client.lock(f"{name}:lock", timeout=lock_timeout)
+        acquired = lock.acquire(blocking=False)
+    except Exception as e:
+        logging.error("singleflight lock %r %r", name, e)
+        return func(*args, **kwargs)
+
+    if acquired:
+        try:
+            # 清掉上一轮的结果，避免执行失败时等待的 worker 读到旧结果
+            binary_client.delete(f"{name}:result")
+            value = func(*args, **kwargs)
+            try:
+                binary_client.set(
+                    f"{name}:result",
+                    pickle.dumps(value),
+                    ex=app.config["SINGLEFLIGHT_RESULT_EXPIRE"],
+                )
+            except Exception as e:
+                logging.error("singleflight save %r %r", name, e)
+            return value
+        finally:
+            try:
+                lock.release()
+                binary_client.publish(f"{name}:done", 1)
+            except Exception as e:
+                logging.debug("singleflight release %r %r", name, e)
+
+    # 等持有锁的 worker 执行完成，读取它的结果
+    try:
+        _wait_singleflight(name)
+        raw = binary_client.get(f"{name}:result")
+        if raw:
+            incr_metrics("singleflight", "redis_shared")
+            return pickle.loads(raw)
+    except Exception as e:
+        logging.error("singleflight wait %r %r", name, e)
+    return func(*args, **kwargs)
+
+
+def _wait_singleflight(name):
+    """Block until the leader publishes `<name>:done`, or the wait times out."""
+    pubsub = binary_client.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(f"{name}:done")
+        # 订阅之后再检查一次锁，leader 可能在订阅之前就已经完成了
+        if not binary_client.exists(f"{name}:lock"):
+            return
+        deadline = time() + app.config["SINGLEFLIGHT_WAIT_TIMEOUT"]
+        while time() < deadline:
+            if pubsub.get_message(timeout=deadline - time()):
+                return
+        incr_metrics("singleflight", "wait_timeout")
+    finally:
+        pubsub.close()
+
+
+def singleflight(key, func, *args, distributed=False, **kwargs):
+    """Call func once for concurrent identical requests, share the result.
+
+    Only use it for idempotent calls.
+
+    Args:
+        key (str): Identify identical calls.
+        func (callable): The function to call.
+        distributed (bool): Also coalesce across workers with a redis lock,
+            the result must be picklable.
+    """
+    if distributed:
+        return _single_flight.do(key, redis_singleflight, key, func, *args, **kwargs)
+    return _single_flight.do(key, func, *args, **kwargs)
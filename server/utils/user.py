@@ -1,9 +1,14 @@
+from time import time
+
 from app import app, db
 from flask import abort
-from model.schema import BindUser, ObjID, User
-from model.team import add_team_member
-from utils.github.account import get_email, get_user_info
-from utils.github.application import oauth_by_code
+from model.schema import BindUser, ObjID, TeamMember, User
+from model.team import invalidate_team_identity_map
+from sqlalchemy import insert, update
+from utils.github.account import async_get_email, async_get_user_info
+from utils.github.application import get_token_expire_time, oauth_by_code
+from utils.github.bot import invalidate_user_token
+from utils.github.client import run_async
 
 
 def register(code: str) -> str | None:
@@ -23,22 +28,25 @@ def register(code: str) -> str | None:
         abort(500)
 
     access_token = oauth_info.get("access_token", None)[0]  # 这里要考虑取哪个，为什么会有多个？
-    # TODO: 预备好对 user_access_token 的刷新处理
+    # 开启了 token 过期的 GitHub App 会同时返回 refresh_token，用来刷新 access_token
+    refresh_token = oauth_info.get("refresh_token", [None])[0]
 
-    # 使用 oauth_info 中的 access_token 获取用户信息
-    user_info = get_user_info(access_token)
+    # 使用 oauth_info 中的 access_token 同时获取用户信息和邮箱
+    user_info, email = run_async(
+        async_get_user_info(access_token), async_get_email(access_token)
+    )
 
     # 查询 github_id 是否已经存在，若存在，则刷新 access_token，返回 user_id
     github_id = str(user_info.get("id", None))
 
-    email = get_email(access_token)
-
     new_user_id, _ = create_github_user(
         github_id=github_id,
         name=user_info.get("login", None),
         email=email,
         avatar=user_info.get("avatar_url", None),
         access_token=access_token,
+        refresh_token=refresh_token,
+        expire_time=get_token_expire_time(oauth_info),
         extra={"user_info": user_info, "oauth_info": oauth_info},
     )
 
@@ -53,6 +61,8 @@ def create_github_user(
     access_token: str = None,
     application_id: str = None,
     extra: dict = {},
+    refresh_token: str = None,
+    expire_time: int = None,
 ) -> (str, str):
     """Create a GitHub user.
 
@@ -61,6 +71,8 @@ def create_github_user(
         email (str): The email of the user.
         avatar (str): The avatar of the user.
         extra (dict): The extra of the user.
+        refresh_token (str): The refresh token of the access token.
+        expire_time (int): The expire timestamp of the access token.
 
     Returns:
         str: The id of the user.
@@ -79,6 +91,8 @@ def create_github_user(
         # 刷新 access_token
         if access_token is not None:
             bind_user.access_token = access_token
+            bind_user.refresh_token = refresh_token
+            bind_user.expire_time = expire_time
 
         # 刷新 email
         if email is not None:
@@ -89,6 +103,8 @@ def create_github_user(
         #     bind_user.application_id = application_id
 
         db.session.commit()
+        if access_token is not None:
+            invalidate_user_token(user.id)
         return user.id, bind_user.id
 
     new_user = User(
@@ -111,6 +127,8 @@ def create_github_user(
         name=name,
         avatar=avatar,
         access_token=access_token,
+        refresh_token=refresh_token,
+        expire_time=expire_time,
         # application_id=application_id,
         extra=extra.get("oauth_info", None),
     )
@@ -124,6 +142,10 @@ def create_github_user(
 
 def create_github_member(members: list, application_id: str, team_id: str) -> list:
     """Create GitHub members.
+
+    Users, bind users and team members are loaded once, the missing ones are
+    inserted in bulk and committed together.
+
     Args:
         members (list): The members of the GitHub.
         application_id (str): The id of the application.
@@ -131,19 +153,117 @@ def create_github_member(members: list, application_id: str, team_id: str) -> li
     Returns:
         list: The members.
     """
+    start = time()
+    members = list(members)
+    github_ids = list({str(member["id"]) for member in members})
+    users = (
+        {
+            unionid: user_id
+            for unionid, user_id in db.session.query(User.unionid, User.id).filter(
+                User.unionid.in_(github_ids),
+            )
+        }
+        if github_ids
+        else {}
+    )
+    bind_users = (
+        {
+            user_id: bind_user_id
+            for user_id, bind_user_id in db.session.query(
+                BindUser.user_id, BindUser.id
+            ).filter(
+                BindUser.user_id.in_(list(users.values())),
+                BindUser.platform == "github",
+            )
+        }
+        if users
+        else {}
+    )
+    team_members = {
+        code_user_id
+        for code_user_id, in db.session.query(TeamMember.code_user_id).filter(
+            TeamMember.team_id == team_id,
+            TeamMember.status == 0,
+        )
+    }
 
+    new_users, new_bind_users, new_team_members, emails = [], [], [], []
+    # 本次新建的 User
+    created = set()
     for member in members:
+        github_id = str(member["id"])
+        email = member.get("email", None)
         # 已存在的用户不会重复创建
-        _, new_bind_user_id = create_github_user(
-            github_id=str(member["id"]),
-            name=member["login"],
-            email=member.get("email", None),
-            avatar=member["avatar_url"],
-            access_token=None,
-            application_id=application_id,
-            extra={},
-        )
-
-        add_team_member(team_id, new_bind_user_id)
-
+        user_id = users.get(github_id)
+        if user_id is None:
+            user_id = users[github_id] = ObjID.new_id()
+            created.add(github_id)
+            new_users.append(
+                dict(
+                    id=user_id,
+                    unionid=github_id,
+                    email=email,
+                    name=member["login"],
+                    avatar=member["avatar_url"],
+                    extra=None,
+                )
+            )
+
+        bind_user_id = bind_users.get(user_id)
+        if bind_user_id is None:
+            if github_id not in created:
+                # 已存在的用户缺少 GitHub BindUser，补建一个，否则永远不会成为团队成员
+                app.logger.warning(
+                    f"Create missing bind user of github user {github_id}"
+                )
+            bind_user_id = bind_users[user_id] = ObjID.new_id()
+            new_bind_users.append(
+                dict(
+                    id=bind_user_id,
+                    user_id=user_id,
+                    platform="github",
+                    email=email,
+                    name=member["login"],
+                    avatar=member["avatar_url"],
+                    access_token=None,
+                    extra=None,
+                )
+            )
+        elif email is not None:
+            # 刷新 email
+            emails.append(dict(id=bind_user_id, email=email))
+
+        if bind_user_id not in team_members:
+            team_members.add(bind_user_id)
+            new_team_members.append(
+                dict(
+                    id=ObjID.new_id(),
+                    team_id=team_id,
+                    code_user_id=bind_user_id,
+                    im_user_id=None,
+                )
+            )
+
+    if new_users:
+        db.session.execute(insert(User), new_users)
+    if new_bind_users:
+        db.session.execute(insert(BindUser), new_bind_users)
+    if emails:
+        db.session.execute(update(BindUser), emails)
+    if new_team_members:
+        db.session.execute(insert(TeamMember), new_team_members)
+    db.session.commit()
+    if new_team_members:
+        invalidate_team_identity_map(team_id)
+
+    seconds = time() - start
+    rows = len(new_users) + len(new_bind_users) + len(emails) + len(new_team_members)
+    app.logger.info(
+        "create_github_member team %s: %d members, %d rows in %.2fs (%.1f rows/s)",
+        team_id,
+        len(members),
+        rows,
+        seconds,
+        rows / seconds if seconds > 0 else rows,
+    )
     return members
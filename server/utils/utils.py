@@ -14,8 +14,12 @@ def process_image(url, bot):
     return upload_image(url, bot)
 
 
-# 使用 stalecache 装饰器，以 url 作为缓存键
-@stalecache(expire=3600, stale=600)
+# 使用 stalecache 装饰器，以 url 作为缓存键，image_key 只在上传的应用内可用
+@stalecache(
+    key=lambda url, bot: f"image_key:{bot.app_id}:{url}",
+    expire=3600,
+    stale=600,
+)
 def upload_image(url, bot):
     logging.info("upload image: %s", url)
     response = httpx.get(url, follow_redirects=True)
@@ -38,7 +42,13 @@ def upload_image_binary(img_bin, bot):
     return response["data"]["image_key"]
 
 
-@stalecache(expire=3600, stale=600)
+@stalecache(
+    key=lambda file_key, message_id, bot, file_type="image": (
+        f"file:{file_type}:{file_key}"
+    ),
+    expire=3600,
+    stale=600,
+)
 def download_file(file_key, message_id, bot, file_type="image"):
     """
     获取消息中的资源文件，包括音频，视频，图片和文件，暂不支持表情包资源下载。当前仅支持 100M 以内的资源文件的下载